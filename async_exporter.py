@@ -0,0 +1,385 @@
+"""
+asyncio flavour of the SlackExporter, built on slack_sdk's AsyncWebClient (requires aiohttp).
+
+Every request is a latency-bound round trip, so instead of walking one conversation after the other
+we keep up to `max_concurrency` conversations in flight at the same time and let the per-method
+rate limiter decide when a call can go out.
+The paging helpers are async_iter_data/async_call_method: iter_data and call_method stay the blocking ones
+inherited from SlackExporter, used by the user directory and the conversation catalog.
+
+Usage:
+    exporter = AsyncSlackExporter("config.yaml")
+    convos = asyncio.run(exporter.get_conversations())
+    asyncio.run(exporter.export_conversation_data(convos, export_messages=True, export_members=True))
+"""
+
+import asyncio
+import time
+from datetime import datetime
+try:
+    from slack_sdk.web.async_client import AsyncWebClient
+except ImportError:
+    AsyncWebClient = None
+from slack_sdk.errors import SlackApiError
+from metrics import ExporterMetrics
+from retry_policy import RetryPolicy
+from files_fetcher import FilesFetcher
+from background_fetcher import AsyncBackgroundFetcher
+from http_transport import get_async_session
+from rate_coordinator import RemoteRateLimiter
+from history_shards import ShardedHistoryFetcher
+from slack_exporter import SlackExporter
+
+
+class AsyncSlackExporter(SlackExporter):
+    def __init__(self, config_filename=None, bot_token=None, max_concurrency=None, config=None):
+        super().__init__(config_filename, bot_token, config)
+        if AsyncWebClient is None:
+            raise ImportError("AsyncSlackExporter needs aiohttp, install it with: pip install aiohttp")
+        self._async_client = None
+        self._async_session = None
+        self._async_loop = None
+        self.export_threads = False
+        self.max_concurrency = max_concurrency if max_concurrency is not None else self.config.get("max_concurrency", 8)
+
+    @property
+    def async_client(self):
+        # Created on first use, like the blocking client. Its pooled session belongs to the event loop it was created
+        # in and every asyncio.run has its own loop, so a new loop gets a new client
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if self._async_client is None or (loop is not None and self._async_loop is not loop):
+            if self.bot_token is None and not self.is_offline():
+                raise ValueError("You need to provide a Slack BOT token!")
+            self._async_session = get_async_session(self.config) if loop is not None else None
+            self._async_client = AsyncWebClient(token=self.bot_token, base_url=self.api_url, timeout=self.config.get("http_timeout", 30), session=self._async_session)
+            self._async_loop = loop
+        return self._async_client
+
+    async def close_async_client(self):
+        if self._async_session is not None:
+            await self._async_session.close()
+        self._async_client = None
+        self._async_session = None
+        self._async_loop = None
+
+    async def async_check_rate_limit(self, method_name):
+        if isinstance(self.rate_limiter, RemoteRateLimiter):
+            # A round trip to the rate coordinator, in a worker thread (each one keeps its own connection)
+            waited = await asyncio.get_running_loop().run_in_executor(None, self.rate_limiter.reserve, method_name)
+        else:
+            # The local buckets never block
+            waited = self.rate_limiter.reserve(method_name)
+        self.metrics.record_throttle(method_name, waited)
+        if waited > 0:
+            await asyncio.sleep(waited)
+        elapsed = (datetime.now() - self.started_time)
+        return waited, elapsed
+
+    async def async_call_method(self, client_method, client_args):
+        method_name = client_method.__name__
+        data = self.get_cached_page(method_name, client_args)
+        if data is not None:
+            return data, 0, datetime.now() - self.started_time
+        attempt = 0
+        while True:
+            waited, elapsed = await self.async_check_rate_limit(method_name)
+            call_started = time.monotonic()
+            try:
+                result = await client_method(**client_args)
+                self.calls_counter += 1
+                self.metrics.record_call(method_name, time.monotonic() - call_started, ExporterMetrics.get_response_size(result))
+                self.cache_page(method_name, client_args, result)
+                return result, waited, elapsed
+            except Exception as e:
+                self.metrics.record_call(method_name, time.monotonic() - call_started, ExporterMetrics.get_response_size(getattr(e, "response", None)), error=True)
+                # Same classification and backoff as the blocking call_method, but only this task sleeps
+                if isinstance(self.rate_limiter, RemoteRateLimiter):
+                    # A 429 is reported to the rate coordinator
+                    delay = await asyncio.get_running_loop().run_in_executor(None, self.get_retry_delay, method_name, client_args, e, attempt)
+                else:
+                    delay = self.get_retry_delay(method_name, client_args, e, attempt)
+                attempt += 1
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+    async def async_iter_data(self, client_method, client_args, response_key = None, data_keys = None, limit=200, processed=-1, total=-1, cursor=None, return_cursor=False):
+        total_data = 0
+        method_name = client_method.__name__
+        while True:
+            result, waited, elapsed = await self.async_call_method(client_method, dict(client_args, limit=limit, cursor=cursor))
+            new_data = self.get_data_list(result, response_key, data_keys)
+            self.log_payload(method_name, client_args, new_data)
+            total_data += len(new_data)
+            cursor = result.get("response_metadata", {}).get("next_cursor", None)
+            if processed > 0 and total > 0:
+                print(f"{processed:>4}/{total:<4}", end="")
+            else:
+                print(f"{'-':>4}/{'-':<4}", end="")
+            print(f"{method_name:15}\t Total data: {total_data:<4} \t Cursor: {str(cursor):<10}\tWaited: {waited:>2.2f}s \tElapsed: {elapsed} \tArgs: {client_args}")
+            yield (new_data, cursor) if return_cursor else new_data
+            if cursor is None or cursor == "":
+                break
+
+    async def get_data(self, client_method, client_args, response_key = None, data_keys = None, limit=200, processed=-1, total=-1):
+        data_list = []
+        async for new_data in self.async_iter_data(client_method, client_args, response_key, data_keys, limit, processed, total):
+            data_list += new_data
+        return data_list
+
+    async def get_conversations(self, data_keys=None, types=None, is_member=None, is_archived=None, force_refresh=False):
+        # The conversation catalog is shared with the sync exporter, a refresh (if needed) runs in a worker thread
+        get_conversations = super().get_conversations
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: get_conversations(data_keys, types, is_member, is_archived, force_refresh))
+
+    def iter_conversation_history(self, conversation, data_keys=None, processed=-1, total=-1, oldest=None, cursor=None, return_cursor=False, **kwargs):
+        client_args = self.get_history_args(conversation, oldest)
+        shards = self.get_history_shards(conversation)
+        if isinstance(cursor, list) or (shards > 1 and cursor is None):
+            # Same cursors as SlackExporter.iter_conversation_history: the progress of every shard
+            progress = cursor if isinstance(cursor, list) else ShardedHistoryFetcher.new_progress(self.get_time_shards(conversation, client_args, shards))
+            return self.iter_history_shards(client_args, progress, data_keys, processed, total, return_cursor)
+        return self.async_iter_data(self.async_client.conversations_history, client_args, response_key="messages", data_keys=data_keys, processed=processed, total=total, cursor=cursor, return_cursor=return_cursor)
+
+    async def fetch_history_shard(self, semaphore, shard_queue, client_args, shard, data_keys, processed, total):
+        if not shard["done"]:
+            async with semaphore:
+                try:
+                    async for page in self.async_iter_data(self.async_client.conversations_history, dict(client_args, oldest=shard["oldest"], latest=shard["latest"]), response_key="messages", data_keys=data_keys, processed=processed, total=total, cursor=shard["cursor"], return_cursor=True):
+                        # Waits while the queue is full, a shard is never more than history_shard_buffer pages ahead
+                        await shard_queue.put(page)
+                except Exception as e:
+                    await shard_queue.put(e)
+        await shard_queue.put(None)
+
+    async def iter_history_shards(self, client_args, progress, data_keys=None, processed=-1, total=-1, return_cursor=False):
+        # Same as ShardedHistoryFetcher (history_shards.py): shards are paged concurrently, pages come out newest shard first
+        progress = [dict(shard) for shard in progress]
+        semaphore = asyncio.Semaphore(self.history_shard_workers)
+        queues = [asyncio.Queue(maxsize=max(1, self.history_shard_buffer)) for shard in progress]
+        tasks = [asyncio.ensure_future(self.fetch_history_shard(semaphore, queues[idx], client_args, shard, data_keys, processed, total)) for idx, shard in enumerate(progress)]
+        try:
+            for shard_idx, shard_queue in enumerate(queues):
+                while True:
+                    item = await shard_queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    page, next_cursor = item
+                    progress[shard_idx]["cursor"] = next_cursor if next_cursor else None
+                    progress[shard_idx]["done"] = not next_cursor
+                    yield (page, [dict(shard) for shard in progress]) if return_cursor else page
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_conversation_history(self, conversation, data_keys=None, processed=-1, total=-1, **kwargs):
+        channel_id = conversation["id"]
+        messages = []
+        async for page in self.iter_conversation_history(conversation, data_keys=data_keys, processed=processed, total=total):
+            messages += page
+        self.logger.info(f"{len(messages)} messages found in {channel_id}")
+        return messages
+
+    def iter_conversation_members(self, conversation, data_keys=None, processed=-1, total=-1, cursor=None, return_cursor=False, **kwargs):
+        client_args={"channel":conversation["id"]}
+        return self.async_iter_data(self.async_client.conversations_members, client_args, response_key="members", data_keys=data_keys, processed=processed, total=total, cursor=cursor, return_cursor=return_cursor)
+
+    async def get_conversation_members(self, conversation, data_keys=None, get_user_info=True, processed=-1, total=-1, **kwargs):
+        channel_id = conversation["id"]
+        members = []
+        async for page in self.iter_conversation_members(conversation, data_keys=data_keys, processed=processed, total=total):
+            members += page
+        self.logger.info(f"{len(members)} members in {channel_id}")
+        if get_user_info:
+            members = await self.get_users_info(members)
+        return members
+
+    async def iter_thread_replies(self, channel_id, thread_ts, data_keys=None, oldest=None, **kwargs):
+        client_args={"channel":channel_id, "ts":thread_ts}
+        if oldest is not None:
+            client_args["oldest"] = oldest
+        async for page in self.async_iter_data(self.async_client.conversations_replies, client_args, response_key="messages", data_keys=data_keys):
+            yield [message for message in page if message.get("ts", None) != thread_ts]
+
+    async def get_message_reactions(self, channel_id, msg_timestamp, **kwargs):
+        client_args={"channel":channel_id, "timestamp":msg_timestamp, "full":True}
+        try:
+            result, waited, elapsed = await self.async_call_method(self.async_client.reactions_get, client_args)
+        except SlackApiError as e:
+            print(f"Error in retreiving reactions of {msg_timestamp} in {channel_id}: {e}")
+            return None
+        return result.get("message", {}).get("reactions", [])
+
+    async def get_users_info(self, users_id_list, data_keys=None):
+        # Only the users missing from the user directory cost a users.info call
+        missing = [user_id for user_id in users_id_list if self.user_directory.get(user_id, fetch_missing=False) is None]
+        results = await asyncio.gather(*[self.async_call_method(self.async_client.users_info, {"user":user_id}) for user_id in missing], return_exceptions=True)
+        for result in results:
+            if not isinstance(result, Exception) and "user" in result[0]:
+                self.user_directory.user_fetched(result[0]["user"])
+        await asyncio.get_running_loop().run_in_executor(None, self.user_directory.save_changes)
+        users_data = []
+        for user_id in users_id_list:
+            user = self.user_directory.get(user_id, fetch_missing=False)
+            if user is not None and data_keys is not None:
+                user = {key: user.get(key, None) for key in data_keys}
+            users_data.append(user)
+        return users_data
+
+    async def export_conversation(self, semaphore, writers, conversation, export_members=False, members_as_graph=False, processed=-1, total=-1, deferred=None):
+        # Each page is written as soon as it arrives and without awaiting in between, so rows of different
+        # conversations may alternate page by page in the shared files but a page is never split
+        async with semaphore:
+            try:
+                await self.export_conversation_pages(writers, conversation, export_members, members_as_graph, processed, total)
+            except SlackApiError as e:
+                self.handle_export_error(conversation, e, deferred if deferred is not None else [])
+
+    async def export_conversation_pages(self, writers, conversation, export_members=False, members_as_graph=False, processed=-1, total=-1):
+        # Picks up where a previous failed attempt stopped, like SlackExporter.export_conversation
+        conversation_id = conversation["id"]
+        convo_info_prefix = self.get_conversation_prefix(conversation)
+        progress = self.export_progress.setdefault(conversation_id, {})
+        if export_members and not progress.get("members_done", False):
+            async for members, next_cursor in self.iter_conversation_members(conversation, processed=processed, total=total, cursor=progress.get("members_cursor", None), return_cursor=True):
+                self.write_members(writers, members, convo_info_prefix, members_as_graph)
+                progress["members_cursor"] = next_cursor
+            progress["members_done"] = True
+        if SlackExporter.ExportType.Messages in writers and self.checkpoints is not None:
+            oldest, cursor = self.checkpoints.start(conversation_id)
+            if self.export_threads and oldest is not None:
+                # New replies to the threads of the previous runs, see SlackExporter.export_conversation
+                for thread_ts, latest_reply in self.checkpoints.get_active_threads(conversation_id):
+                    await self.replies_fetcher.put(writers, conversation_id, {"ts": thread_ts}, convo_info_prefix, latest_reply)
+            async for messages, next_cursor in self.iter_conversation_history(conversation, processed=processed, total=total, oldest=oldest, cursor=cursor, return_cursor=True):
+                await self.write_messages(writers, conversation_id, messages, convo_info_prefix)
+                if self.checkpoints.page_done(conversation_id, messages, next_cursor, oldest):
+                    await self.async_save_checkpoints(writers)
+            self.checkpoints.conversation_done(conversation_id)
+            await self.async_save_checkpoints(writers)
+        elif SlackExporter.ExportType.Messages in writers:
+            async for messages, next_cursor in self.iter_conversation_history(conversation, processed=processed, total=total, cursor=progress.get("cursor", None), return_cursor=True):
+                await self.write_messages(writers, conversation_id, messages, convo_info_prefix)
+                progress["cursor"] = next_cursor
+        self.export_progress.pop(conversation_id, None)
+
+    async def write_messages(self, writers, conversation_id, messages, convo_info_prefix):
+        writers[SlackExporter.ExportType.Messages].write_data_batch(messages, self.message_formatter.format_messages, users_list=self.users_list, prefix=convo_info_prefix)
+        if self.files_fetcher is not None:
+            # File downloads are plain HTTP streams, they stay on the worker threads of the FilesFetcher
+            for message in messages:
+                for file in message.get("files", []):
+                    self.files_fetcher.put(writers, conversation_id, message, file, convo_info_prefix)
+        if self.export_threads:
+            for message in messages:
+                if self.is_thread_parent(message):
+                    await self.replies_fetcher.put(writers, conversation_id, message, convo_info_prefix)
+        if SlackExporter.ExportType.Reactions in writers:
+            for message in messages:
+                if self.needs_reactions_lookup(message):
+                    # Fetched in the background while the history keeps paging, waits while the queue is full
+                    await self.reactions_fetcher.put(writers, conversation_id, message, convo_info_prefix)
+                elif "reactions" in message:
+                    self.write_message_reactions(writers, message, message["reactions"], convo_info_prefix)
+
+    async def async_save_checkpoints(self, writers):
+        # Same as save_checkpoints, with the background work of the pages in asyncio queues. One save at a time, in the
+        # order of their snapshots, so an older snapshot never overwrites a newer one
+        async with self.checkpoints_lock:
+            checkpoints = self.checkpoints.snapshot()
+            # Replies first, they queue the reactions of the replies
+            if self.replies_fetcher is not None:
+                await self.replies_fetcher.wait()
+            if self.reactions_fetcher is not None:
+                await self.reactions_fetcher.wait()
+            loop = asyncio.get_running_loop()
+            if self.files_fetcher is not None:
+                await loop.run_in_executor(None, self.files_fetcher.wait)
+            await loop.run_in_executor(None, self.flush_export_writers, writers)
+            await loop.run_in_executor(None, self.checkpoints.save, checkpoints)
+
+    async def fetch_thread_replies(self, writers, conversation_id, message, convo_info_prefix, oldest=None):
+        # Same as RepliesFetcher.fetch
+        latest_reply = oldest
+        try:
+            async for replies in self.iter_thread_replies(conversation_id, message["ts"], oldest=oldest):
+                await self.write_messages(writers, conversation_id, replies, convo_info_prefix)
+                if len(replies) > 0:
+                    latest_reply = replies[-1]["ts"]
+                    if oldest is not None:
+                        self.checkpoints.thread_replied(conversation_id, message["ts"], latest_reply)
+        except SlackApiError as e:
+            self.record_thread_failure(conversation_id, convo_info_prefix, message["ts"], latest_reply, e)
+            return
+        if self.checkpoints is not None:
+            self.checkpoints.thread_fetched(conversation_id, message["ts"])
+
+    async def fetch_message_reactions(self, writers, conversation_id, message, convo_info_prefix):
+        msg_reactions = await self.get_message_reactions(conversation_id, message["ts"])
+        if msg_reactions is None:
+            msg_reactions = message.get("reactions", None)
+        self.write_message_reactions(writers, message, msg_reactions, convo_info_prefix)
+
+    def load_lookups(self):
+        # The user directory, the conversation catalog, the users list and the message formatter are loaded on
+        # first use, which can download from Slack and read or write their cache files
+        return self.users_list, self.message_formatter
+
+    async def export_conversation_data(self, conversations, export_messages=True, export_messages_reactions=False, export_members=False, members_as_graph=False, export_threads=False, export_files=False):
+        # Blocking file and network I/O runs in worker threads, before the concurrent tasks start and once they are done
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.load_lookups)
+        conversations, writers = await loop.run_in_executor(None, lambda: self.init_export_writers(conversations, export_messages, export_messages_reactions, export_members, members_as_graph, export_files and export_messages))
+        if SlackExporter.ExportType.Files in writers:
+            self.files_fetcher = FilesFetcher(self, self.get_files_store(), self.config.get("files_workers", 4), self.config.get("files_batch_size", 50), self.config.get("files_chunk_size", 1024*1024),
+                                             max_queue_size=self.config.get("fetcher_queue_size", 1000))
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.export_threads = export_messages and export_threads
+        # replies_workers/reactions_workers tasks fetch the threads and the truncated reactions of the pages
+        self.replies_fetcher = AsyncBackgroundFetcher(self.fetch_thread_replies, "replies_fetcher", self.config.get("replies_workers", 4), self.config.get("fetcher_queue_size", 1000)) if self.export_threads else None
+        self.reactions_fetcher = None
+        if SlackExporter.ExportType.Reactions in writers:
+            self.reactions_fetcher = AsyncBackgroundFetcher(self.fetch_message_reactions, "reactions_fetcher", self.config.get("reactions_workers", 2), self.config.get("fetcher_queue_size", 1000))
+        self.checkpoints_lock = asyncio.Lock()
+        self.failures = []
+        deferred = []
+        try:
+            await asyncio.gather(*[self.export_conversation(semaphore, writers, conversation, export_members, members_as_graph, processed=idx_c+1, total=len(conversations), deferred=deferred) for idx_c, conversation in enumerate(conversations)])
+            for retry_round in range(0, self.retry_rounds):
+                if len(deferred) == 0:
+                    break
+                print(f"Retrying {len(deferred)} deferred conversations (round {retry_round+1}/{self.retry_rounds})")
+                pending, deferred = deferred, []
+                for conversation, error in pending:
+                    self.retry_policy.reset_budget(conversation["id"])
+                await asyncio.gather(*[self.export_conversation(semaphore, writers, conversation, export_members, members_as_graph, processed=idx_c+1, total=len(pending), deferred=deferred) for idx_c, (conversation, error) in enumerate(pending)])
+            for conversation, error in deferred:
+                self.record_failure(conversation, error, RetryPolicy.RETRYABLE)
+            # Replies first, their reactions may still be queued
+            if self.replies_fetcher is not None:
+                await self.replies_fetcher.close()
+                self.replies_fetcher = None
+            if self.reactions_fetcher is not None:
+                await self.reactions_fetcher.close()
+                self.reactions_fetcher = None
+        finally:
+            # Only left running when the export failed
+            for fetcher in [self.replies_fetcher, self.reactions_fetcher]:
+                if fetcher is not None:
+                    fetcher.cancel()
+            self.replies_fetcher = None
+            self.reactions_fetcher = None
+            if self.files_fetcher is not None:
+                await loop.run_in_executor(None, self.files_fetcher.close)
+                self.files_fetcher = None
+            await loop.run_in_executor(None, self.close_export_writers, writers)
+            await self.close_async_client()
+        self.write_failure_report()
+
+    def export_all_conversations_history(self, conversations, export_reactions=True, **kwargs):
+        print("Exporting {} conversations".format(len(conversations)))
+        asyncio.run(self.export_conversation_data(conversations, export_messages=True, export_messages_reactions=export_reactions, **kwargs))
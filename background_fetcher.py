@@ -0,0 +1,147 @@
+"""
+Worker threads draining a queue of API calls in the background of an export.
+
+Every call still goes through the exporter (and so through its rate limiter), the workers only make sure
+the main thread can keep paging through conversations.history while these calls are in flight.
+Subclasses implement fetch(), which receives the arguments given to put(). put() blocks while the queue is full.
+wait() blocks until everything put so far has been fetched and written, e.g. before a checkpoint moves past it.
+AsyncBackgroundFetcher does the same with asyncio tasks, for the AsyncSlackExporter.
+"""
+
+import asyncio
+import queue
+import threading
+
+
+class BackgroundFetcher():
+    name = "fetcher"
+
+    def __init__(self, exporter, workers=2, batch_size=50, max_queue_size=1000):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        # Bounded like the writer queues: these calls are rate limited far below the pace of the history pages,
+        # once max_queue_size messages are waiting put() blocks and the history paging slows down to match
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.fetched_counter = 0
+        self.counter_lock = threading.Lock()
+        # Sequence numbers of the items put and not fetched yet, see wait()
+        self.put_counter = 0
+        self.pending = set()
+        self.pending_condition = threading.Condition()
+        self.threads = []
+        for i in range(0, workers):
+            thread = threading.Thread(target=self.worker, name=f"{self.name}_{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, *item):
+        with self.pending_condition:
+            self.put_counter += 1
+            sequence = self.put_counter
+            self.pending.add(sequence)
+        self.queue.put((sequence, item))
+
+    def wait(self):
+        # Blocks until every item put before this call has been fetched, items put in the meantime are not waited for
+        with self.pending_condition:
+            sequence = self.put_counter
+            self.pending_condition.wait_for(lambda: len(self.pending) == 0 or min(self.pending) > sequence)
+
+    def get_batch(self):
+        # Blocks for the first item, then takes whatever else is already waiting (up to batch_size)
+        # A None (stop signal) always ends the batch, so every worker gets exactly one of them
+        batch = [self.queue.get()]
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def worker(self):
+        while True:
+            batch = self.get_batch()
+            for item in batch:
+                try:
+                    if item is not None:
+                        self.fetch(*item[1])
+                        with self.counter_lock:
+                            self.fetched_counter += 1
+                except Exception as e:
+                    print(f"Error in {self.name}: {e}")
+                finally:
+                    if item is not None:
+                        with self.pending_condition:
+                            self.pending.discard(item[0])
+                            self.pending_condition.notify_all()
+                    self.queue.task_done()
+            if batch[-1] is None:
+                return
+
+    def fetch(self, *item):
+        raise NotImplementedError()
+
+    def close(self):
+        # Waits for every queued item to be fetched and written, then stops the workers
+        print(f"Waiting for {self.queue.qsize()} queued {self.name} calls...")
+        self.queue.join()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        print(f"{self.name}: {self.fetched_counter} calls completed")
+
+
+class AsyncBackgroundFetcher():
+    # Same as BackgroundFetcher for the asyncio exporter: `workers` tasks drain a bounded asyncio.Queue and await
+    # fetch(*item) for every item, so a large channel never has more than max_queue_size messages waiting and
+    # `workers` calls in flight. Must be created with the event loop running
+    def __init__(self, fetch, name="fetcher", workers=2, max_queue_size=1000):
+        self.fetch = fetch
+        self.name = name
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.fetched_counter = 0
+        self.put_counter = 0
+        self.pending = set()
+        self.pending_condition = asyncio.Condition()
+        self.tasks = [asyncio.ensure_future(self.worker()) for i in range(0, workers)]
+
+    async def put(self, *item):
+        # Waits while the queue is full
+        self.put_counter += 1
+        self.pending.add(self.put_counter)
+        await self.queue.put((self.put_counter, item))
+
+    async def wait(self):
+        sequence = self.put_counter
+        async with self.pending_condition:
+            await self.pending_condition.wait_for(lambda: len(self.pending) == 0 or min(self.pending) > sequence)
+
+    async def worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                if item is None:
+                    return
+                await self.fetch(*item[1])
+                self.fetched_counter += 1
+            except Exception as e:
+                print(f"Error in {self.name}: {e}")
+            finally:
+                if item is not None:
+                    async with self.pending_condition:
+                        self.pending.discard(item[0])
+                        self.pending_condition.notify_all()
+                self.queue.task_done()
+
+    async def close(self):
+        await self.queue.join()
+        for task in self.tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self.tasks)
+        print(f"{self.name}: {self.fetched_counter} calls completed")
+
+    def cancel(self):
+        # Stops the workers right away, e.g. when the export failed
+        for task in self.tasks:
+            task.cancel()
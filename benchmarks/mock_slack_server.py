@@ -0,0 +1,330 @@
+"""
+Local stand-in for the Slack Web API, serving a synthetic workspace.
+
+Covers conversations.list, conversations.history, conversations.members, conversations.replies,
+users.list, users.info and reactions.get with cursor pagination, an optional latency per request,
+randomly injected 429 responses (with a Retry-After header) and 500 responses.
+Conversations that do not exist answer with channel_not_found.
+Messages can have files attached, downloaded from /files/<file ID> (with Range support). Files with the same
+content are shared by many file IDs and `interrupt_rate` of the downloads are cut halfway through.
+Nothing is stored: every message is generated from its index, so huge workspaces cost no memory.
+Connections are kept alive (HTTP/1.1) and counted in `connections`, answers are gzipped for the clients that accept it.
+
+Run it on its own with:
+    python benchmarks/mock_slack_server.py --port 8765 --channels 100 --messages 10000
+and point the exporter to it with `slack_api_url: http://127.0.0.1:8765/api/` in the config file.
+"""
+
+import argparse
+import gzip
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class SyntheticWorkspace():
+    BASE_TS = 1600000000
+
+    def __init__(self, users=1000, channels=20, messages=5000, members=50, thread_every=10, replies=5, reactions_every=4, truncated_every=50,
+                 files_every=0, file_size=64*1024, distinct_files=10):
+        self.users = users
+        self.channels = channels
+        self.messages = messages
+        self.members = members
+        self.thread_every = thread_every
+        self.replies = replies
+        self.reactions_every = reactions_every
+        self.truncated_every = truncated_every
+        self.files_every = files_every
+        self.file_size = file_size
+        self.distinct_files = distinct_files
+        # Set by the server, files are downloaded from it
+        self.files_url = "http://127.0.0.1/files/"
+
+    def user_id(self, idx):
+        return f"U{idx % self.users:08d}"
+
+    def get_user(self, idx):
+        return {"id": self.user_id(idx), "name": f"user{idx}", "real_name": f"User {idx}", "deleted": False, "is_bot": False,
+                "updated": SyntheticWorkspace.BASE_TS, "profile": {"display_name": f"user{idx}", "real_name_normalized": f"User {idx}"}}
+
+    def get_conversation(self, idx):
+        return {"id": f"C{idx:08d}", "name": f"channel-{idx}", "is_channel": True, "is_private": False, "is_member": True,
+                "is_archived": False, "created": SyntheticWorkspace.BASE_TS, "updated": SyntheticWorkspace.BASE_TS, "num_members": self.members}
+
+    def channel_index(self, channel_id):
+        return int(channel_id[1:])
+
+    def ts(self, idx, reply=0):
+        # Newest message first, like conversations.history
+        return f"{SyntheticWorkspace.BASE_TS + (self.messages - idx) * 60}.{reply:06d}"
+
+    def get_reactions(self, channel_idx, idx, full=False):
+        if self.reactions_every <= 0 or idx % self.reactions_every != 0:
+            return None
+        users = [self.user_id(channel_idx + idx + i) for i in range(0, 3)]
+        count = len(users)
+        if not full and self.truncated_every > 0 and idx % self.truncated_every == 0:
+            # What conversations.history returns for very popular reactions
+            count = 60
+            users = users[:2]
+        return [{"name": "thumbsup", "users": users, "count": count}]
+
+    def get_message(self, channel_idx, idx, full=False):
+        ts = self.ts(idx)
+        message = {"type": "message", "ts": ts, "user": self.user_id(channel_idx * 31 + idx),
+                   "text": f"Message {idx} in channel {channel_idx} for <@{self.user_id(idx)}> in <#C{channel_idx:08d}|channel-{channel_idx}>"}
+        if self.thread_every > 0 and idx % self.thread_every == 0:
+            message["thread_ts"] = ts
+            message["reply_count"] = self.replies
+            message["latest_reply"] = self.ts(idx, self.replies)
+        reactions = self.get_reactions(channel_idx, idx, full)
+        if reactions is not None:
+            message["reactions"] = reactions
+        if self.files_every > 0 and idx % self.files_every == 0:
+            file_id = f"F{channel_idx:04d}{idx:08d}"
+            message["files"] = [{"id": file_id, "name": f"file{idx}.bin", "mimetype": "application/octet-stream", "size": self.file_size,
+                                 "url_private": f"{self.files_url}{file_id}", "url_private_download": f"{self.files_url}{file_id}?download=1"}]
+        return message
+
+    def get_file_content(self, file_id):
+        # Only distinct_files different contents, shared by all the file IDs
+        seed = int(file_id[1:]) % self.distinct_files
+        block = bytes([(seed + i) % 256 for i in range(0, 256)])
+        return (block * (self.file_size // 256 + 1))[:self.file_size]
+
+    def get_replies(self, channel_idx, thread_ts):
+        idx = self.messages - int((float(thread_ts) - SyntheticWorkspace.BASE_TS) / 60)
+        parent = self.get_message(channel_idx, idx)
+        replies = [parent]
+        for reply in range(1, self.replies + 1):
+            replies.append({"type": "message", "ts": self.ts(idx, reply), "thread_ts": thread_ts, "user": self.user_id(idx + reply), "text": f"Reply {reply} to {idx}"})
+        return replies
+
+
+class MockSlackServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, workspace, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, retry_after=1, page_size=None, server_error_rate=0.0, interrupt_rate=0.0):
+        super().__init__((host, port), MockSlackHandler)
+        self.workspace = workspace
+        self.workspace.files_url = f"http://{self.server_address[0]}:{self.server_address[1]}/files/"
+        self.interrupt_rate = interrupt_rate
+        self.interrupted = 0
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.server_error_rate = server_error_rate
+        self.calls = {}
+        self.errors = 0
+        self.server_errors = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(42)
+
+    def get_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/api/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count_call(self, method):
+        # Returns the HTTP status to fail the call with, None to answer it
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.error_rate > 0 and self.random.random() < self.error_rate:
+                self.errors += 1
+                return 429
+            if self.server_error_rate > 0 and self.random.random() < self.server_error_rate:
+                self.server_errors += 1
+                return 500
+            return None
+
+    def paginate(self, items_count, get_item, args, default_limit=100):
+        limit = int(args.get("limit", default_limit) or default_limit)
+        if self.page_size is not None:
+            limit = min(limit, self.page_size)
+        offset = int(args.get("cursor", "") or 0)
+        end = min(offset + limit, items_count)
+        items = [get_item(idx) for idx in range(offset, end)]
+        next_cursor = str(end) if end < items_count else ""
+        return items, {"next_cursor": next_cursor}
+
+    def handle_method(self, method, args):
+        workspace = self.workspace
+        if method == "users.list":
+            members, metadata = self.paginate(workspace.users, workspace.get_user, args)
+            return {"ok": True, "members": members, "response_metadata": metadata}
+        if method == "users.info":
+            return {"ok": True, "user": workspace.get_user(int(args["user"][1:]))}
+        if method == "conversations.list":
+            channels, metadata = self.paginate(workspace.channels, workspace.get_conversation, args)
+            return {"ok": True, "channels": channels, "response_metadata": metadata}
+        channel_idx = workspace.channel_index(args.get("channel", "C0"))
+        if channel_idx >= workspace.channels:
+            return {"ok": False, "error": "channel_not_found"}
+        if method == "conversations.members":
+            members, metadata = self.paginate(workspace.members, lambda idx: workspace.user_id(channel_idx + idx), args)
+            return {"ok": True, "members": members, "response_metadata": metadata}
+        if method == "conversations.history":
+            # Only oldest/latest as timestamps are supported, which is all the exporter uses
+            oldest = float(args.get("oldest", 0) or 0)
+            latest = float(args.get("latest", 0) or 0)
+            # Both bounds are exclusive, message idx has ts BASE_TS + (messages - idx) * 60
+            first = 0
+            last = workspace.messages
+            if latest > 0:
+                first = max(first, math.floor(workspace.messages - (latest - SyntheticWorkspace.BASE_TS) / 60) + 1)
+            if oldest > 0:
+                last = min(last, math.ceil(workspace.messages - (oldest - SyntheticWorkspace.BASE_TS) / 60))
+            last = max(first, last)
+            messages, metadata = self.paginate(last - first, lambda idx: workspace.get_message(channel_idx, first + idx), args)
+            return {"ok": True, "messages": messages, "has_more": metadata["next_cursor"] != "", "response_metadata": metadata}
+        if method == "conversations.replies":
+            replies = workspace.get_replies(channel_idx, args["ts"])
+            if args.get("oldest", None):
+                # The parent always comes first, the replies are the ones after oldest
+                replies = replies[:1] + [reply for reply in replies[1:] if float(reply["ts"]) > float(args["oldest"])]
+            messages, metadata = self.paginate(len(replies), lambda idx: replies[idx], args)
+            return {"ok": True, "messages": messages, "response_metadata": metadata}
+        if method == "reactions.get":
+            idx = workspace.messages - int((float(args["timestamp"]) - SyntheticWorkspace.BASE_TS) / 60)
+            return {"ok": True, "type": "message", "channel": args["channel"], "message": workspace.get_message(channel_idx, idx, full=True)}
+        return None
+
+
+class MockSlackHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately: without TCP_NODELAY a kept-alive connection waits for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        # One handler per connection: the number of connections the clients opened
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        if "gzip" in (self.headers.get("Accept-Encoding", "") or ""):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        body = self.rfile.read(length).decode("utf-8") if length > 0 else ""
+        args = {key: values[-1] for key, values in parse_qs(body).items()}
+        if "?" in self.path:
+            args.update({key: values[-1] for key, values in parse_qs(self.path.split("?", 1)[1]).items()})
+        self.handle_api(args)
+
+    def do_GET(self):
+        if self.path.startswith("/files/"):
+            self.handle_file()
+            return
+        args = {}
+        if "?" in self.path:
+            args = {key: values[-1] for key, values in parse_qs(self.path.split("?", 1)[1]).items()}
+        self.handle_api(args)
+
+    def handle_file(self):
+        server = self.server
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            self.send_json(403, {"ok": False, "error": "not_authed"})
+            return
+        file_id = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        server.count_call("files.download")
+        content = server.workspace.get_file_content(file_id)
+        start = 0
+        range_header = self.headers.get("Range", None)
+        if range_header is not None and range_header.startswith("bytes="):
+            start = int(range_header[len("bytes="):].split("-", 1)[0] or 0)
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        body = content[start:]
+        self.send_response(206 if start > 0 else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        if start > 0:
+            self.send_header("Content-Range", f"bytes {start}-{len(content)-1}/{len(content)}")
+        self.end_headers()
+        with server.lock:
+            interrupt = server.interrupt_rate > 0 and server.random.random() < server.interrupt_rate
+            server.interrupted += 1 if interrupt else 0
+        if interrupt:
+            # Half the body, then the connection drops
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+    def handle_api(self, args):
+        server = self.server
+        method = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        if server.latency > 0:
+            time.sleep(server.latency)
+        status = server.count_call(method)
+        if status == 429:
+            self.send_json(429, {"ok": False, "error": "ratelimited"}, {"Retry-After": str(server.retry_after)})
+            return
+        if status == 500:
+            self.send_json(500, {"ok": False, "error": "internal_error"})
+            return
+        try:
+            response = server.handle_method(method, args)
+        except (KeyError, ValueError) as e:
+            response = {"ok": False, "error": f"invalid_arguments: {e}"}
+        if response is None:
+            response = {"ok": False, "error": "unknown_method"}
+        self.send_json(200, response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Slack Web API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5000, help="messages per channel")
+    parser.add_argument("--members", type=int, default=50, help="members per channel")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 429")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument("--page-size", type=int, default=None, help="maximum page size, whatever limit is asked")
+    args = parser.parse_args()
+    workspace = SyntheticWorkspace(users=args.users, channels=args.channels, messages=args.messages, members=args.members)
+    server = MockSlackServer(workspace, port=args.port, latency=args.latency, error_rate=args.error_rate, page_size=args.page_size, server_error_rate=args.server_error_rate)
+    print(f"Mock Slack Web API listening on {server.get_url()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
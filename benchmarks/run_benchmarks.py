@@ -0,0 +1,181 @@
+"""
+Offline benchmarks of the exporter against the local mock Slack Web API (mock_slack_server.py).
+
+Every scenario runs in its own process (so the peak RSS is the one of that scenario only), starts a mock server
+with a synthetic workspace and reports:
+    messages/s:     message rows written per second
+    calls/s:        API calls answered by the mock server per second
+    connections:    TCP connections opened to the mock server (`--transport urllib` for slack_sdk's own transport)
+    peak RSS:       maximum resident memory of the scenario process
+    throttled:      seconds spent waiting on the rate limiter (including the Retry-After of the injected 429s)
+
+With --page-cache the API pages are recorded to (or replayed from) a page cache (see page_cache.py): record them once and
+replay them with `--page-cache-mode offline` to benchmark the formatting and writing on the exact same pages, without the server.
+
+Usage:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --scenario export --page-cache fixtures --page-cache-mode record
+    python benchmarks/run_benchmarks.py --scenario export --page-cache fixtures --page-cache-mode offline
+    python benchmarks/run_benchmarks.py --scenario export --channels 50 --messages 20000 --latency 0.05 --json results.json
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mock_slack_server import MockSlackServer, SyntheticWorkspace
+
+# Rate limits high enough to never throttle, to measure the exporter itself
+UNLIMITED_RATE_LIMITS = {method: 1000000 for method in ["conversations_list", "conversations_history", "conversations_members",
+                                                        "conversations_replies", "users_list", "users_info", "reactions_get"]}
+
+
+def make_exporter(server, folder, realistic_limits=False, exporter_class=None, config=None):
+    from slack_exporter import SlackExporter
+    exporter_class = exporter_class if exporter_class is not None else SlackExporter
+    exporter_config = {
+        "SLACK_BOT_TOKEN": "xoxb-benchmark",
+        "slack_api_url": server.get_url(),
+        "data_folder": os.path.join(folder, "export"),
+        "users_cache_file": os.path.join(folder, "users.json"),
+        "conversations_cache_file": os.path.join(folder, "conversations.json"),
+        "logger_name": "slack_exporter_benchmark",
+        "retry_delay": 1,
+    }
+    if not realistic_limits:
+        exporter_config["rate_limits"] = UNLIMITED_RATE_LIMITS
+    exporter_config.update(config or {})
+    config_filename = os.path.join(folder, "config.yaml")
+    with open(config_filename, "w") as outfile:
+        yaml.safe_dump(exporter_config, outfile)
+    # Keep the user directory download out of the measured time, like a warm cache would
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        return exporter_class(config_filename)
+    finally:
+        os.chdir(cwd)
+
+
+def count_rows(folder, pattern):
+    rows = 0
+    for filename in glob.glob(os.path.join(folder, "**", f"*{pattern}*.csv"), recursive=True):
+        with open(filename, encoding="utf-8") as infile:
+            rows += sum(1 for line in infile) - 1
+    return rows
+
+
+def scenario_get_data(exporter, server, folder, args):
+    # Raw paging speed of get_data over every channel's history
+    messages = 0
+    for conversation in exporter.get_conversations():
+        messages += len(exporter.get_data(exporter.client.conversations_history, {"channel": conversation["id"]}, response_key="messages"))
+    return messages
+
+
+def scenario_export(exporter, server, folder, args):
+    exporter.export_conversation_data(exporter.get_conversations(), export_messages=True, export_messages_reactions=True, export_members=True, export_threads=args.threads)
+    return count_rows(folder, "messages")
+
+
+def scenario_export_async(exporter, server, folder, args):
+    conversations = asyncio.run(exporter.get_conversations())
+    asyncio.run(exporter.export_conversation_data(conversations, export_messages=True, export_messages_reactions=True, export_members=True, export_threads=args.threads))
+    return count_rows(folder, "messages")
+
+
+SCENARIOS = {
+    "get_data": scenario_get_data,
+    "export": scenario_export,
+    "export_async": scenario_export_async,
+}
+
+
+def run_scenario(name, args, results):
+    workspace = SyntheticWorkspace(users=args.users, channels=args.channels, messages=args.messages, members=args.members)
+    server = MockSlackServer(workspace, latency=args.latency, error_rate=args.error_rate, retry_after=args.retry_after, page_size=args.page_size, server_error_rate=args.server_error_rate).start()
+    exporter_class = None
+    if name == "export_async":
+        from async_exporter import AsyncSlackExporter
+        exporter_class = AsyncSlackExporter
+    with tempfile.TemporaryDirectory() as folder:
+        exporter_config = {"http_transport": args.transport}
+        if args.page_cache is not None:
+            exporter_config.update({"page_cache_folder": os.path.abspath(args.page_cache), "page_cache_mode": args.page_cache_mode})
+        exporter = make_exporter(server, folder, args.realistic_limits, exporter_class, exporter_config)
+        server.calls = {}
+        server.connections = 0
+        started = time.monotonic()
+        messages = SCENARIOS[name](exporter, server, folder, args)
+        elapsed = time.monotonic() - started
+    server.stop()
+    calls = sum(server.calls.values())
+    results.put({
+        "scenario": name,
+        "seconds": elapsed,
+        "messages": messages,
+        "messages_per_second": messages / elapsed if elapsed > 0 else 0,
+        "api_calls": calls,
+        "api_calls_per_second": calls / elapsed if elapsed > 0 else 0,
+        "calls_per_method": server.calls,
+        "injected_429": server.errors,
+        "injected_500": server.server_errors,
+        "connections": server.connections,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "throttled_seconds": exporter.rate_limit_wait_time,
+        "metrics": exporter.metrics.snapshot(),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the Slack exporter")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS.keys()), help="scenario to run (can be repeated), all by default")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=2000, help="messages per channel")
+    parser.add_argument("--members", type=int, default=50, help="members per channel")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request by the mock server")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 429")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of the injected 429s")
+    parser.add_argument("--page-size", type=int, default=None)
+    parser.add_argument("--threads", action="store_true", help="also export the thread replies")
+    parser.add_argument("--realistic-limits", action="store_true", help="use the Slack tier limits instead of unlimited rate limits")
+    parser.add_argument("--transport", choices=["pooled", "urllib"], default="pooled", help="http_transport of the exporter")
+    parser.add_argument("--page-cache", default=None, help="page cache folder to record the API pages to or replay them from")
+    parser.add_argument("--page-cache-mode", choices=["record", "replay", "offline"], default="replay")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    scenarios = args.scenario if args.scenario else list(SCENARIOS.keys())
+    all_results = []
+    for name in scenarios:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_scenario, args=(name, args, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f"Scenario {name} failed with exit code {process.exitcode}")
+            continue
+        all_results.append(results.get())
+
+    print(f"\n{'scenario':<14}{'seconds':>10}{'messages':>10}{'msg/s':>12}{'calls':>8}{'calls/s':>10}{'conns':>7}{'429s':>6}{'RSS MB':>9}{'throttled s':>13}")
+    for result in all_results:
+        print(f"{result['scenario']:<14}{result['seconds']:>10.2f}{result['messages']:>10}{result['messages_per_second']:>12.1f}{result['api_calls']:>8}"
+              f"{result['api_calls_per_second']:>10.1f}{result['connections']:>7}{result['injected_429']:>6}{result['peak_rss_mb']:>9.1f}{result['throttled_seconds']:>13.2f}")
+    if args.json is not None:
+        with open(args.json, "w") as outfile:
+            json.dump(all_results, outfile, indent=1)
+
+
+if __name__ == "__main__":
+    main()
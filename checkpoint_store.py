@@ -0,0 +1,148 @@
+"""
+Persisted export checkpoints, one entry per conversation ID.
+
+For each conversation we keep:
+    latest_ts:  timestamp of the newest message exported by a completed run, the next run only asks for newer messages (oldest=latest_ts)
+    cursor:     next_cursor of the run in progress, so an interrupted run can resume from the last completed page
+                (for a sharded history, the progress of every shard, see history_shards.py)
+    oldest:     the oldest= used by the run in progress (a cursor is only valid with the same arguments)
+    pending_ts: newest message seen by the run in progress, it becomes latest_ts once the conversation is completed
+    threads:    ts -> latest reply of the threads replied to in the last `thread_window` seconds. oldest= hides their
+                parents from the next runs, so the next runs ask conversations.replies for their new replies instead
+    failed_threads: ts -> last reply written of the threads whose replies could not be fetched. latest_ts moves past
+                their parents all the same, the next runs fetch their replies again until it succeeds (whatever their age)
+
+conversations.history returns the newest messages first, so latest_ts can only move forward once the whole
+cursor chain has been walked, otherwise an interrupted run would leave a gap behind.
+
+page_done/conversation_done only update the checkpoints in memory. The exporter saves them once the rows they
+cover are on disk: every `save_every` pages or `save_interval` seconds (page_done tells when), after every completed
+conversation and at the end of the export. A crash loses at most the progress since the last save, those pages
+are fetched again.
+"""
+
+import copy
+import json
+import os
+import threading
+import time
+
+
+class CheckpointStore():
+    def __init__(self, filename, save_every=50, save_interval=30, thread_window=14*24*60*60):
+        self.filename = filename
+        self.thread_window = thread_window
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.checkpoints = {}
+        # Threads that failed during this run, added to every save: a snapshot taken before they failed must
+        # not let latest_ts move past them without them
+        self.failed_threads = {}
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as infile:
+                self.checkpoints = json.load(infile)
+        except (IOError, ValueError) as e:
+            print(f"Error reading checkpoints file {self.filename}: {e}")
+
+    def snapshot(self):
+        # Copy of the checkpoints as they are now, to save them later
+        with self.lock:
+            return copy.deepcopy(self.checkpoints)
+
+    def save(self, checkpoints=None):
+        # The current checkpoints, or a snapshot() taken earlier
+        with self.lock:
+            if checkpoints is None:
+                checkpoints = self.checkpoints
+            for conversation_id, threads in self.failed_threads.items():
+                checkpoints.setdefault(conversation_id, {}).setdefault("failed_threads", {}).update(threads)
+            # Write to a temporary file first, a crash while saving must not corrupt the existing checkpoints
+            tmp_filename = f"{self.filename}.tmp"
+            with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+                json.dump(checkpoints, outfile, indent=1)
+            os.replace(tmp_filename, self.filename)
+            self.unsaved = 0
+            self.saved_at = time.monotonic()
+
+    def get(self, conversation_id):
+        with self.lock:
+            return dict(self.checkpoints.get(conversation_id, {}))
+
+    def start(self, conversation_id):
+        # Returns the (oldest, cursor) to pass to conversations.history
+        checkpoint = self.get(conversation_id)
+        if checkpoint.get("cursor", None):
+            if isinstance(checkpoint["cursor"], list):
+                print(f"Resuming {conversation_id} from {sum(1 for shard in checkpoint['cursor'] if shard['done'])}/{len(checkpoint['cursor'])} history shards")
+            else:
+                print(f"Resuming {conversation_id} from cursor {checkpoint['cursor']}")
+            return checkpoint.get("oldest", None), checkpoint["cursor"]
+        return checkpoint.get("latest_ts", None), None
+
+    def page_done(self, conversation_id, messages, next_cursor, oldest=None):
+        # Returns True when the checkpoints are due to be saved
+        with self.lock:
+            checkpoint = self.checkpoints.setdefault(conversation_id, {})
+            for message in messages:
+                if "ts" in message and float(message["ts"]) > float(checkpoint.get("pending_ts", None) or 0):
+                    checkpoint["pending_ts"] = message["ts"]
+                latest_reply = message.get("latest_reply", None)
+                if latest_reply and message.get("thread_ts", None) == message.get("ts", None) and time.time() - float(latest_reply) <= self.thread_window:
+                    checkpoint.setdefault("threads", {})[message["ts"]] = latest_reply
+            checkpoint["cursor"] = next_cursor if next_cursor else None
+            checkpoint["oldest"] = oldest
+            self.unsaved += 1
+            return self.unsaved >= self.save_every or time.monotonic() - self.saved_at >= self.save_interval
+
+    def get_active_threads(self, conversation_id):
+        # (thread ts, latest reply ts) of the threads to ask for new replies, the failed ones from their last written reply
+        with self.lock:
+            checkpoint = self.checkpoints.get(conversation_id, {})
+            threads = dict(checkpoint.get("threads", {}))
+            for thread_ts, latest_reply in checkpoint.get("failed_threads", {}).items():
+                threads[thread_ts] = min(latest_reply, threads.get(thread_ts, latest_reply), key=float)
+            return list(threads.items())
+
+    def thread_replied(self, conversation_id, thread_ts, reply_ts):
+        with self.lock:
+            threads = self.checkpoints.setdefault(conversation_id, {}).setdefault("threads", {})
+            if float(reply_ts) > float(threads.get(thread_ts, 0)):
+                threads[thread_ts] = reply_ts
+
+    def thread_failed(self, conversation_id, thread_ts, latest_reply):
+        # latest_reply: the newest reply written before the failure, or the thread ts if there is none
+        with self.lock:
+            self.failed_threads.setdefault(conversation_id, {})[thread_ts] = latest_reply
+            self.checkpoints.setdefault(conversation_id, {}).setdefault("failed_threads", {})[thread_ts] = latest_reply
+
+    def thread_fetched(self, conversation_id, thread_ts):
+        # The replies of a thread that failed before are all written
+        with self.lock:
+            self.failed_threads.get(conversation_id, {}).pop(thread_ts, None)
+            checkpoint = self.checkpoints.get(conversation_id, {})
+            checkpoint.get("failed_threads", {}).pop(thread_ts, None)
+            if "failed_threads" in checkpoint and len(checkpoint["failed_threads"]) == 0:
+                del checkpoint["failed_threads"]
+
+    def conversation_done(self, conversation_id):
+        with self.lock:
+            checkpoint = self.checkpoints.setdefault(conversation_id, {})
+            # Threads without replies for thread_window seconds are not asked for new replies anymore
+            threads = checkpoint.pop("threads", {})
+            threads = {thread_ts: latest_reply for thread_ts, latest_reply in threads.items() if time.time() - float(latest_reply) <= self.thread_window}
+            if len(threads) > 0:
+                checkpoint["threads"] = threads
+            pending_ts = checkpoint.pop("pending_ts", None)
+            if pending_ts is not None and float(pending_ts) > float(checkpoint.get("latest_ts", None) or 0):
+                checkpoint["latest_ts"] = pending_ts
+            checkpoint["cursor"] = None
+            checkpoint["oldest"] = None
+            self.unsaved += 1
@@ -0,0 +1,148 @@
+"""
+Catalog of the workspace conversations, indexed by ID and by name and persisted to disk.
+
+Same approach as the UserDirectory: the catalog is saved to a JSON file with the time it was downloaded and
+conversations.list is only paged through again once the file is older than `ttl` seconds.
+On refresh only the conversations that changed are replaced and re-indexed, the ones that are not listed
+anymore (deleted, or we lost access) are dropped.
+
+DMs have no name, they are indexed by the name of the other user, resolved through the user directory.
+"""
+
+import json
+import os
+import threading
+import time
+from slack_sdk.errors import SlackApiError
+
+
+class ConversationCatalog():
+    # The type names of the Slack API (conversations.list types=), used to filter the catalog
+    TYPES = ["public_channel", "private_channel", "mpim", "im"]
+
+    def __init__(self, exporter, filename="slack_conversations.json", ttl=60*60, types="public_channel,private_channel,mpim,im"):
+        self.exporter = exporter
+        self.filename = filename
+        self.ttl = ttl
+        self.types = types
+        self.conversations = {}
+        self.names = {}
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as infile:
+                data = json.load(infile)
+            self.fetched_at = data.get("fetched_at", 0)
+            for conversation in data.get("conversations", []):
+                self.add_conversation(conversation)
+            print(f"Loaded {len(self.conversations)} conversations from {self.filename}")
+        except (IOError, ValueError) as e:
+            print(f"Error reading conversations catalog {self.filename}: {e}")
+
+    def save(self):
+        if self.filename is None:
+            return
+        # One temporary file per process, sharded exports share the same cache files
+        tmp_filename = f"{self.filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+            json.dump({"fetched_at": self.fetched_at, "conversations": list(self.conversations.values())}, outfile)
+        os.replace(tmp_filename, self.filename)
+
+    def is_stale(self):
+        return time.time() - self.fetched_at > self.ttl
+
+    def get_name(self, conversation):
+        if "name" in conversation:
+            return conversation["name"]
+        if "user" in conversation:
+            return self.exporter.user_directory.get_name(conversation["user"], conversation["user"])
+        return conversation["id"]
+
+    def add_conversation(self, conversation):
+        # Returns True if the conversation is new or changed since we last saw it
+        with self.lock:
+            current = self.conversations.get(conversation["id"], None)
+            if current == conversation:
+                return False
+            if current is not None:
+                self.names.pop(self.get_name(current), None)
+            self.conversations[conversation["id"]] = conversation
+            self.names[self.get_name(conversation)] = conversation
+            return True
+
+    def reindex_names(self):
+        # DM names depend on the user directory, called when it changed
+        with self.lock:
+            self.names = {self.get_name(conversation): conversation for conversation in self.conversations.values()}
+
+    def remove_conversation(self, conversation_id):
+        with self.lock:
+            conversation = self.conversations.pop(conversation_id, None)
+            if conversation is not None:
+                self.names.pop(self.get_name(conversation), None)
+
+    def refresh(self, force=False):
+        if not force and not self.is_stale():
+            return 0
+        print(f"Downloading conversations catalog to {self.filename}")
+        changed = 0
+        seen = set()
+        try:
+            for conversations in self.exporter.iter_data(self.exporter.client.conversations_list, {"types": self.types}, response_key="channels"):
+                for conversation in conversations:
+                    seen.add(conversation["id"])
+                    changed += self.add_conversation(conversation)
+        except SlackApiError as e:
+            print(f"Error downloading the conversations catalog: {e}")
+            return changed
+        for conversation_id in list(self.conversations.keys()):
+            if conversation_id not in seen:
+                self.remove_conversation(conversation_id)
+                changed += 1
+        self.fetched_at = time.time()
+        self.save()
+        print(f"{changed} conversations added, updated or removed, {len(self.conversations)} conversations in the catalog")
+        return changed
+
+    def get_by_id(self, conversation_id):
+        return self.conversations.get(conversation_id, None)
+
+    def get_by_name(self, name):
+        return self.names.get(name, None)
+
+    def get_type(conversation):
+        # Private channels are also is_group in older payloads, and MPIMs are is_group as well
+        if conversation.get("is_im", False):
+            return "im"
+        if conversation.get("is_mpim", False):
+            return "mpim"
+        if conversation.get("is_private", False) or conversation.get("is_group", False):
+            return "private_channel"
+        return "public_channel"
+
+    def parse_types(types):
+        # A comma separated string or a list of Slack type names, unknown names raise a ValueError
+        types = [conversation_type.strip() for conversation_type in (types.split(",") if isinstance(types, str) else types)]
+        unknown = [conversation_type for conversation_type in types if conversation_type not in ConversationCatalog.TYPES]
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown conversation type(s) {', '.join(unknown)}, expected {', '.join(ConversationCatalog.TYPES)}")
+        return types
+
+    def filter(self, types=None, is_member=None, is_archived=None):
+        # types: Slack API type names (e.g. ["public_channel", "im"]), see TYPES
+        types = ConversationCatalog.parse_types(types) if types is not None else None
+        res = []
+        for conversation in self.conversations.values():
+            if types is not None and ConversationCatalog.get_type(conversation) not in types:
+                continue
+            if is_member is not None and conversation.get("is_member", conversation.get("is_im", False)) != is_member:
+                continue
+            if is_archived is not None and conversation.get("is_archived", False) != is_archived:
+                continue
+            res.append(conversation)
+        return res
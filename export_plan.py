@@ -0,0 +1,95 @@
+"""
+Estimate of an export before running it (`python slack_exporter.py export --plan`): API calls per method and wall time.
+
+The estimate only uses what is already cached locally, the conversation catalog, the user directory and the
+checkpoints, nothing is fetched from Slack. Slack does not tell how many messages a conversation has, so the history
+assumes `plan_messages_per_day` messages per day (20 by default) over the exported range of each conversation: from its
+creation, the previous export (checkpoint) or timeframe.from, whichever is the latest, up to timeframe.to or now.
+Threads (`plan_thread_ratio` of the messages, 5% by default) and truncated reactions (`plan_reactions_ratio`, 1%) need
+one more call each. Files are plain downloads, they are not rate limited and not estimated.
+
+Every method has its own rate limit bucket and the replies/reactions fetchers run next to the history, so the wall
+time is the longest of: the slowest bucket to drain, and the calls of the main loop one after the other (`plan_latency`
+seconds each, 0.3 by default, divided by the number of conversations exported at the same time).
+"""
+
+import math
+import time
+from datetime import timedelta
+from rate_limiter import RateLimiter
+
+
+class ExportPlan():
+    PAGE_SIZE = 200
+    # Called one after the other by the main export loop, the other methods are called by background fetchers
+    MAIN_LOOP_METHODS = ["conversations_list", "users_list", "conversations_history", "conversations_members"]
+
+    def __init__(self, exporter, concurrency=1):
+        self.exporter = exporter
+        self.concurrency = concurrency
+        self.messages_per_day = exporter.config.get("plan_messages_per_day", 20)
+        self.thread_ratio = exporter.config.get("plan_thread_ratio", 0.05)
+        self.reactions_ratio = exporter.config.get("plan_reactions_ratio", 0.01)
+        self.latency = exporter.config.get("plan_latency", 0.3)
+        # The limits of the exporter, without a coordinator: a sharded export shares them anyway
+        self.rate_limiter = RateLimiter(exporter.config.get("rate_limits", None))
+        self.calls = {}
+        self.conversations = 0
+        self.messages = 0
+
+    def get_pages(count):
+        return max(1, math.ceil(count / ExportPlan.PAGE_SIZE))
+
+    def add_calls(self, method_name, calls):
+        self.calls[method_name] = self.calls.get(method_name, 0) + calls
+
+    def get_message_estimate(self, conversation):
+        now = time.time()
+        oldest = float(conversation.get("created", 0) or 0)
+        if self.exporter.timeframe_oldest is not None:
+            oldest = max(oldest, self.exporter.timeframe_oldest)
+        if self.exporter.checkpoints is not None:
+            oldest = max(oldest, float(self.exporter.checkpoints.get(conversation["id"]).get("latest_ts", None) or 0))
+        latest = min(now, self.exporter.timeframe_latest or now)
+        if oldest == 0:
+            # Creation time unknown: a year of history
+            oldest = latest - 365*24*60*60
+        return int(max(0, latest - oldest) / (24*60*60) * self.messages_per_day)
+
+    def add_export(self, conversations, export_messages=True, export_messages_reactions=False, export_members=False, export_threads=False):
+        # The caches the export refreshes first, if they expired
+        if self.exporter.conversation_catalog.is_stale():
+            self.add_calls("conversations_list", ExportPlan.get_pages(len(self.exporter.conversation_catalog.conversations)))
+        if self.exporter.user_directory.is_stale():
+            self.add_calls("users_list", ExportPlan.get_pages(len(self.exporter.user_directory.users)))
+        for conversation in conversations:
+            if export_members:
+                # IMs have no num_members, they have two
+                self.add_calls("conversations_members", ExportPlan.get_pages(conversation.get("num_members", 2)))
+            if export_messages:
+                messages = self.get_message_estimate(conversation)
+                self.messages += messages
+                # Every time shard costs at least one page
+                self.add_calls("conversations_history", max(self.exporter.get_history_shards(conversation), ExportPlan.get_pages(messages)))
+                if export_threads:
+                    self.add_calls("conversations_replies", round(messages * self.thread_ratio))
+                if export_messages_reactions:
+                    self.add_calls("reactions_get", round(messages * self.reactions_ratio))
+        self.conversations += len(conversations)
+        return self
+
+    def get_method_time(self, method_name):
+        # Seconds to get all the tokens of a method from its bucket
+        return self.calls[method_name] * 60.0 / self.rate_limiter.get_method_limit(method_name)
+
+    def get_wall_time(self):
+        rate_bound = max([self.get_method_time(method_name) for method_name in self.calls] or [0])
+        latency_bound = sum([calls for method_name, calls in self.calls.items() if method_name in ExportPlan.MAIN_LOOP_METHODS]) * self.latency / self.concurrency
+        return max(rate_bound, latency_bound)
+
+    def print_plan(self):
+        print(f"Export plan: {self.conversations} conversations, ~{self.messages} messages ({self.messages_per_day} per day)")
+        print(f"{'method':<24}{'calls':>10}{'limit/min':>12}{'time':>16}")
+        for method_name, calls in sorted(self.calls.items()):
+            print(f"{method_name:<24}{calls:>10}{self.rate_limiter.get_method_limit(method_name):>12}{str(timedelta(seconds=round(self.get_method_time(method_name)))):>16}")
+        print(f"Total: {sum(self.calls.values())} calls, estimated wall time {timedelta(seconds=round(self.get_wall_time()))}")
@@ -0,0 +1,86 @@
+"""
+Content-addressed store of the downloaded Slack files.
+
+Every file is stored once, under the sha256 of its content (objects/ab/abcdef...), whatever the number of
+messages, conversations or exports it shows up in. An index persisted to JSON maps the Slack file IDs to their
+content, so a file ID already in the index is never downloaded again and two IDs with the same content
+(e.g. the same attachment uploaded twice) share the same object.
+Downloads in progress are kept under partial/<file ID>.part, so an interrupted download can be resumed.
+"""
+
+import json
+import os
+import threading
+
+
+class FileStore():
+    def __init__(self, folder, save_every=100):
+        self.folder = folder
+        # The index is saved every save_every new files and on close(): after a crash the files missing from it
+        # are downloaded again, but their content is already in the store and is not duplicated
+        self.save_every = save_every
+        self.unsaved = 0
+        self.objects_folder = os.path.join(folder, "objects")
+        self.partial_folder = os.path.join(folder, "partial")
+        self.index_filename = os.path.join(folder, "index.json")
+        os.makedirs(self.objects_folder, exist_ok=True)
+        os.makedirs(self.partial_folder, exist_ok=True)
+        self.files = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.index_filename):
+            return
+        try:
+            with open(self.index_filename, 'r', encoding='utf-8') as infile:
+                self.files = json.load(infile)
+            print(f"Loaded {len(self.files)} files from {self.index_filename}")
+        except (IOError, ValueError) as e:
+            print(f"Error reading files index {self.index_filename}: {e}")
+
+    def save(self):
+        # Must be called holding the lock
+        tmp_filename = f"{self.index_filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+            json.dump(self.files, outfile)
+        os.replace(tmp_filename, self.index_filename)
+
+    def get(self, file_id):
+        # The index entry of a file that is in the store, None otherwise
+        with self.lock:
+            entry = self.files.get(file_id, None)
+        if entry is not None and not os.path.exists(self.get_object_path(entry["sha256"])):
+            return None
+        return entry
+
+    def get_object_path(self, sha256):
+        return os.path.join(self.objects_folder, sha256[:2], sha256)
+
+    def get_partial_path(self, file_id):
+        return os.path.join(self.partial_folder, f"{file_id}.part")
+
+    def add(self, file_id, partial_path, sha256, size, name=None, mimetype=None):
+        # Moves a completed download into the store, or drops it if the same content is already there
+        object_path = self.get_object_path(sha256)
+        with self.lock:
+            if os.path.exists(object_path):
+                os.remove(partial_path)
+                status = "deduplicated"
+            else:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.replace(partial_path, object_path)
+                status = "downloaded"
+            entry = {"sha256": sha256, "size": size, "name": name, "mimetype": mimetype}
+            self.files[file_id] = entry
+            self.unsaved += 1
+            if self.unsaved >= self.save_every:
+                self.save()
+                self.unsaved = 0
+        return entry, status
+
+    def close(self):
+        with self.lock:
+            if self.unsaved > 0:
+                self.save()
+                self.unsaved = 0
@@ -0,0 +1,197 @@
+"""
+Background downloads of the files attached to the exported messages.
+
+Messages with files[] are queued while the history is being paged, `workers` threads download their
+url_private_download into the FileStore (file_store.py):
+    - each worker keeps one keep-alive connection per host, so a download does not cost a new TCP/TLS handshake
+    - files are streamed to disk in `chunk_size` chunks and hashed on the way, never held in memory
+    - a file ID already in the store is not downloaded again, a file shared by several messages is downloaded once
+    - interrupted downloads are resumed with a Range request from what is already in partial/
+Every file of every message gets a row in the files manifest (see SlackExporter.write_file), with the path of its content in the store.
+"""
+
+import hashlib
+import http.client
+import os
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+from background_fetcher import BackgroundFetcher
+
+
+class DownloadError(Exception):
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    def is_permanent(self):
+        return self.status is not None and 400 <= self.status < 500 and self.status not in (408, 429)
+
+
+class FilesFetcher(BackgroundFetcher):
+    name = "files_fetcher"
+    # Files without content to download
+    SKIPPED_MODES = ["tombstone", "hidden_by_limit", "external"]
+
+    def __init__(self, exporter, store, workers=4, batch_size=50, chunk_size=1024*1024, timeout=60, max_queue_size=1000):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.local = threading.local()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        super().__init__(exporter, workers, batch_size, max_queue_size)
+
+    def get_connection(self, scheme, host, port):
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = {}
+            self.local.connections = connections
+        connection = connections.get((scheme, host, port), None)
+        if connection is None:
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(host, port, timeout=self.timeout)
+            connections[(scheme, host, port)] = connection
+        return connection
+
+    def drop_connection(self, scheme, host, port):
+        connection = getattr(self.local, "connections", {}).pop((scheme, host, port), None)
+        if connection is not None:
+            connection.close()
+
+    def request(self, url, headers, max_redirects=5):
+        # GET on this thread's connection to the host, following the redirects of the Slack file URLs
+        for redirect in range(0, max_redirects + 1):
+            parsed = urlsplit(url)
+            key = (parsed.scheme, parsed.hostname, parsed.port)
+            connection = self.get_connection(*key)
+            path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (OSError, http.client.HTTPException):
+                self.drop_connection(*key)
+                raise
+            if response.status not in (301, 302, 303, 307, 308):
+                return response, key
+            # The body must be read before the connection can be used again
+            response.read()
+            next_url = urljoin(url, response.getheader("Location", ""))
+            if urlsplit(next_url).hostname != parsed.hostname:
+                # The token is only sent to the host it was meant for
+                headers = {k: v for k, v in headers.items() if k != "Authorization"}
+            url = next_url
+        raise DownloadError(f"Too many redirects for {url}")
+
+    def download(self, file_id, url, expected_size=None, expected_mimetype=None):
+        # Streams the file to its partial file, resuming from what is already there. Returns (path, sha256, size)
+        partial_path = self.store.get_partial_path(file_id)
+        sha256 = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial_path):
+            with open(partial_path, 'rb') as infile:
+                for chunk in iter(lambda: infile.read(self.chunk_size), b""):
+                    sha256.update(chunk)
+                    offset += len(chunk)
+        headers = {"Authorization": f"Bearer {self.exporter.bot_token}", "Accept-Encoding": "identity"}
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+        response, key = self.request(url, headers)
+        if response.status == 416 and expected_size is not None and offset >= expected_size:
+            # Nothing left to download
+            response.read()
+            return partial_path, sha256.hexdigest(), offset
+        if response.status == 200:
+            mode = 'wb'
+            if offset > 0:
+                # Range ignored by the server: start over
+                sha256 = hashlib.sha256()
+                offset = 0
+        elif response.status == 206:
+            mode = 'ab'
+        else:
+            response.read()
+            retry_after = response.getheader("Retry-After", None)
+            raise DownloadError(f"HTTP {response.status} downloading {file_id}", response.status, float(retry_after) if retry_after else None)
+        content_type = response.getheader("Content-Type", "") or ""
+        if content_type.startswith("text/html") and expected_mimetype != "text/html":
+            # Without the files:read scope Slack answers with its login page
+            response.read()
+            raise DownloadError(f"Got a web page instead of {file_id}, does the token have the files:read scope?", 403)
+        try:
+            with open(partial_path, mode) as outfile:
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    outfile.write(chunk)
+                    sha256.update(chunk)
+                    offset += len(chunk)
+        except (OSError, http.client.HTTPException):
+            self.drop_connection(*key)
+            raise
+        if expected_size is not None and offset < expected_size:
+            self.drop_connection(*key)
+            raise DownloadError(f"Incomplete download of {file_id}: {offset}/{expected_size} bytes")
+        return partial_path, sha256.hexdigest(), offset
+
+    def download_file(self, file_id, url, file):
+        retry_policy = self.exporter.retry_policy
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                partial_path, sha256, size = self.download(file_id, url, file.get("size", None), file.get("mimetype", None))
+                self.exporter.metrics.record_call("files_download", time.monotonic() - started, size)
+                return self.store.add(file_id, partial_path, sha256, size, file.get("name", None), file.get("mimetype", None))
+            except (OSError, http.client.HTTPException, DownloadError) as e:
+                self.exporter.metrics.record_call("files_download", time.monotonic() - started, error=True)
+                if isinstance(e, DownloadError) and e.is_permanent():
+                    print(f"Error downloading file {file_id}: {e}.\t Not retrying")
+                    return None, "failed"
+                if attempt >= retry_policy.max_retries:
+                    print(f"Error downloading file {file_id}: {e}.\t Giving up after {attempt+1} attempts")
+                    return None, "failed"
+                delay = e.retry_after if isinstance(e, DownloadError) and e.retry_after is not None else retry_policy.get_delay(attempt)
+                attempt += 1
+                self.exporter.metrics.record_retry("files_download", "error")
+                print(f"Error downloading file {file_id}: {e}.\t Resuming in {delay:.1f}s")
+                time.sleep(delay)
+
+    def get_file(self, file):
+        # Returns the store entry of the file (None if it could not be downloaded) and what happened to it
+        file_id = file.get("id", None)
+        url = file.get("url_private_download", None) or file.get("url_private", None)
+        if file_id is None or url is None or file.get("mode", None) in FilesFetcher.SKIPPED_MODES:
+            return None, "skipped"
+        entry = self.store.get(file_id)
+        if entry is not None:
+            return entry, "cached"
+        # The same file in several messages: one worker downloads it, the others wait for it
+        with self.lock:
+            event = self.in_flight.get(file_id, None)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                self.in_flight[file_id] = event
+        if not owner:
+            event.wait()
+            entry = self.store.get(file_id)
+            return entry, "cached" if entry is not None else "failed"
+        try:
+            return self.download_file(file_id, url, file)
+        finally:
+            with self.lock:
+                self.in_flight.pop(file_id, None)
+            event.set()
+
+    def fetch(self, writers, conversation_id, message, file, convo_info_prefix):
+        entry, status = self.get_file(file)
+        self.exporter.write_file(writers, message, file, entry, status, convo_info_prefix)
+
+    def close(self):
+        super().close()
+        self.store.close()
@@ -0,0 +1,91 @@
+"""
+Pages a single conversation's history through several time shards at the same time.
+
+The [oldest, latest] range is split in consecutive shards (see SlackExporter.get_time_shards), every shard is its own
+conversations.history cursor chain and up to `workers` of them are paged at the same time by worker threads.
+Pages are yielded shard by shard, newest shard first, so the output keeps the order of an unsharded fetch
+(newest message first) while the later shards are fetched in the background.
+Up to `buffer` pages of a shard that is not being consumed yet are buffered in memory, then its worker waits.
+
+With return_cursor=True the pages come with the progress of every shard instead of a single next_cursor:
+a list of {"oldest", "latest", "cursor", "done"}, one per shard. Passed back as `progress`, the shards already
+done are skipped and the current one resumes from its cursor, with the same bounds as the interrupted fetch.
+"""
+
+import queue
+import threading
+
+
+class ShardedHistoryFetcher():
+    def __init__(self, exporter, client_method, client_args, progress, workers=4, data_keys=None, processed=-1, total=-1, buffer=10, return_cursor=False):
+        self.exporter = exporter
+        self.client_method = client_method
+        self.client_args = client_args
+        # Copied, the progress of an interrupted fetch is left as it was
+        self.progress = [dict(shard) for shard in progress]
+        self.workers = max(1, min(workers, len(self.progress)))
+        self.data_keys = data_keys
+        self.processed = processed
+        self.total = total
+        self.return_cursor = return_cursor
+        self.queues = [queue.Queue(maxsize=max(1, buffer)) for shard in self.progress]
+        self.next_shard = 0
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def new_progress(shards):
+        # Progress of a fresh fetch of the (oldest, latest) time shards
+        return [{"oldest": oldest, "latest": latest, "cursor": None, "done": False} for oldest, latest in shards]
+
+    def put(self, shard_idx, item):
+        # Waits for room in the queue of the shard, unless the consumer stopped
+        while not self.stopped:
+            try:
+                self.queues[shard_idx].put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def worker(self):
+        while not self.stopped:
+            with self.lock:
+                shard_idx = self.next_shard
+                self.next_shard += 1
+            if shard_idx >= len(self.progress):
+                return
+            shard = self.progress[shard_idx]
+            if not shard["done"]:
+                client_args = dict(self.client_args, oldest=shard["oldest"], latest=shard["latest"])
+                try:
+                    for page in self.exporter.iter_data(self.client_method, client_args, response_key="messages", data_keys=self.data_keys, processed=self.processed, total=self.total, cursor=shard["cursor"], return_cursor=True):
+                        self.put(shard_idx, page)
+                        if self.stopped:
+                            break
+                except Exception as e:
+                    # Handed over to the consumer, which raises it when it gets to this shard
+                    self.put(shard_idx, e)
+            self.put(shard_idx, None)
+
+    def __iter__(self):
+        threads = []
+        for i in range(0, self.workers):
+            thread = threading.Thread(target=self.worker, name=f"history_shard_{i}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        try:
+            for shard_idx, shard_queue in enumerate(self.queues):
+                while True:
+                    item = shard_queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    page, next_cursor = item
+                    # Updated before the page is handed over: once the caller records this progress the shard
+                    # resumes after the page, and a shard is done with its last page
+                    self.progress[shard_idx]["cursor"] = next_cursor if next_cursor else None
+                    self.progress[shard_idx]["done"] = not next_cursor
+                    yield (page, [dict(shard) for shard in self.progress]) if self.return_cursor else page
+        finally:
+            # Also reached when the consumer stops early: workers finish their current page and exit
+            self.stopped = True
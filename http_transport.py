@@ -0,0 +1,160 @@
+"""
+Pooled HTTP transport of the Slack Web API calls.
+
+By default slack_sdk's WebClient sends every call through urllib.urlopen, with a new connection (and TLS handshake)
+per call: for the tens of thousands of small calls of an export, the connection setup is a large part of each call.
+PooledWebClient sends them through a ConnectionPool shared by all the threads of the exporter instead:
+    - at most `max_size` connections (`http_pool_size`, 16 by default) are open, callers wait for a free one
+    - connections are kept alive between calls and closed after `idle_timeout` seconds without use (`http_idle_timeout`, 60)
+    - responses are asked gzip compressed (`http_gzip`)
+    - `http_connect_timeout` (10s) to open a connection, `http_timeout` (30s) to wait for the answer
+A kept-alive connection the server closed in the meantime is replaced and the call sent again, once.
+AsyncWebClient gets the same settings through a shared aiohttp session (see get_async_session).
+
+Set `http_transport: urllib` in the config file to go back to slack_sdk's own transport.
+"""
+
+import gzip
+import http.client
+import io
+import ssl
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from slack_sdk import WebClient
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class ConnectionPool():
+    def __init__(self, max_size=16, timeout=30, connect_timeout=10, idle_timeout=60, use_gzip=True, ssl_context=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.use_gzip = use_gzip
+        self.ssl_context = ssl_context if ssl_context is not None else ssl.create_default_context()
+        # Connections in use + idle connections never exceed max_size
+        self.semaphore = threading.BoundedSemaphore(max_size)
+        self.idle = {}
+        # Connections handed out and not released yet, under the lock
+        self.in_use = 0
+        self.lock = threading.Lock()
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    def acquire(self, key):
+        # Returns (connection, reused), waiting while max_size connections are in use
+        self.semaphore.acquire()
+        now = time.monotonic()
+        with self.lock:
+            self.in_use += 1
+            idle = self.idle.get(key, [])
+            while len(idle) > 0:
+                connection, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    self.connections_reused += 1
+                    return connection, True
+                connection.close()
+            # Another host may hold the idle connections: the oldest one is closed to make room
+            idle_count = sum([len(connections) for connections in self.idle.values()])
+            if idle_count > 0 and idle_count + self.in_use > self.max_size:
+                oldest_key = min([k for k in self.idle if len(self.idle[k]) > 0], key=lambda k: self.idle[k][0][1])
+                self.idle[oldest_key].pop(0)[0].close()
+            self.connections_created += 1
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.connect_timeout, context=self.ssl_context), False
+        return http.client.HTTPConnection(host, port, timeout=self.connect_timeout), False
+
+    def release(self, key, connection, reusable):
+        with self.lock:
+            self.in_use -= 1
+            if reusable:
+                self.idle.setdefault(key, []).append((connection, time.monotonic()))
+        if not reusable:
+            connection.close()
+        self.semaphore.release()
+
+    def request(self, method, url, body=None, headers=None):
+        # Returns (status, headers, body bytes), with the body already decompressed
+        parsed = urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+        headers = dict(headers or {})
+        if self.use_gzip:
+            headers["Accept-Encoding"] = "gzip"
+        for attempt in range(0, 2):
+            connection, reused = self.acquire(key)
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    # connect_timeout was for the connection, the answer gets timeout
+                    connection.sock.settimeout(self.timeout)
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (ConnectionResetError, BrokenPipeError, http.client.BadStatusLine, http.client.CannotSendRequest):
+                self.release(key, connection, False)
+                if reused and attempt == 0:
+                    # The server closed the idle connection, nothing was answered: send it again on a new one
+                    continue
+                raise
+            except BaseException:
+                self.release(key, connection, False)
+                raise
+            self.release(key, connection, not response.will_close)
+            if (response.getheader("Content-Encoding", "") or "").lower() == "gzip":
+                data = gzip.decompress(data)
+            return response.status, response.headers, data
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection, last_used in connections:
+                    connection.close()
+            self.idle = {}
+
+
+class PooledWebClient(WebClient):
+    # Replaces the urllib call at the bottom of slack_sdk's BaseClient, everything above it (request building,
+    # retry handlers, SlackResponse) is untouched
+    def __init__(self, *args, pool=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool if pool is not None else ConnectionPool(timeout=self.timeout, ssl_context=self.ssl)
+
+    def _perform_urllib_http_request_internal(self, url, req):
+        if self.proxy is not None or not url.lower().startswith("http"):
+            return super()._perform_urllib_http_request_internal(url, req)
+        status, headers, data = self.pool.request(req.get_method(), url, req.data, dict(req.header_items()))
+        if status >= 400:
+            # Handled (429, Retry-After...) by BaseClient like the errors of urlopen
+            raise HTTPError(url, status, http.client.responses.get(status, ""), headers, io.BytesIO(data))
+        if headers.get_content_type() == "application/gzip":
+            return {"status": status, "headers": headers, "body": data}
+        return {"status": status, "headers": headers, "body": data.decode(headers.get_content_charset() or "utf-8")}
+
+
+def get_pool(config):
+    return ConnectionPool(config.get("http_pool_size", 16), config.get("http_timeout", 30), config.get("http_connect_timeout", 10),
+                          config.get("http_idle_timeout", 60), config.get("http_gzip", True))
+
+
+def get_web_client(token, base_url, config, pool=None):
+    # The WebClient of the configured http_transport (pooled by default)
+    if config.get("http_transport", "pooled") == "urllib":
+        return WebClient(token=token, base_url=base_url, timeout=config.get("http_timeout", 30))
+    return PooledWebClient(token=token, base_url=base_url, timeout=config.get("http_timeout", 30), pool=pool if pool is not None else get_pool(config))
+
+
+def get_async_session(config):
+    # aiohttp session with the same pool size, keep-alive and timeouts, must be created (and closed) in the event loop
+    if aiohttp is None or config.get("http_transport", "pooled") == "urllib":
+        return None
+    connector = aiohttp.TCPConnector(limit=config.get("http_pool_size", 16), keepalive_timeout=config.get("http_idle_timeout", 60))
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=config.get("http_connect_timeout", 10), sock_read=config.get("http_timeout", 30))
+    headers = {"Accept-Encoding": "gzip"} if config.get("http_gzip", True) else {"Accept-Encoding": "identity"}
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
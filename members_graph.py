@@ -0,0 +1,91 @@
+"""
+Co-membership graph of the workspace: which users share channels, and how many.
+
+Members are collected as (user, conversation) pairs of a sparse user x conversation incidence matrix while the
+members are exported. The user x user co-membership matrix is then a single sparse product (incidence @ incidence.T),
+whose entries are the number of shared conversations, so the cost grows with the number of edges and not with
+the square of the channel sizes.
+
+The graph is written as a weighted edge list (csv: user_id, user_name, user_id2, user_name2, shared_conversations,
+every pair once) or as a scipy sparse matrix (.npz, upper triangle) with the user IDs of its rows and columns
+in a `<filename>.users.csv` file next to it.
+Requires numpy and scipy.
+"""
+
+import array
+import csv
+import threading
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy = None
+
+
+class MembersGraph():
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("The members graph needs numpy and scipy, install them with: pip install numpy scipy")
+        self.users = {}
+        self.conversations = {}
+        self.rows = array.array("q")
+        self.cols = array.array("q")
+        self.lock = threading.Lock()
+
+    def get_index(self, indexes, key):
+        index = indexes.get(key, None)
+        if index is None:
+            index = len(indexes)
+            indexes[key] = index
+        return index
+
+    def add_members(self, conversation_id, members):
+        with self.lock:
+            conversation_idx = self.get_index(self.conversations, conversation_id)
+            for member in members:
+                self.rows.append(self.get_index(self.users, member))
+                self.cols.append(conversation_idx)
+
+    def get_incidence_matrix(self):
+        with self.lock:
+            rows = numpy.frombuffer(self.rows, dtype=numpy.int64).copy()
+            cols = numpy.frombuffer(self.cols, dtype=numpy.int64).copy()
+            shape = (len(self.users), len(self.conversations))
+        incidence = scipy.sparse.csr_matrix((numpy.ones(len(rows), dtype=numpy.int32), (rows, cols)), shape=shape)
+        # A member listed twice (e.g. a conversation exported twice) still counts once
+        incidence.sum_duplicates()
+        incidence.data[:] = 1
+        return incidence
+
+    def get_comembership_matrix(self):
+        # Upper triangle (each pair once, no self loops) of the shared conversations count
+        incidence = self.get_incidence_matrix()
+        return scipy.sparse.triu(incidence @ incidence.T, k=1).tocoo()
+
+    def get_user_ids(self):
+        user_ids = [None] * len(self.users)
+        for user_id, index in self.users.items():
+            user_ids[index] = user_id
+        return user_ids
+
+    def write_edge_list(self, filename, users_list=None, min_weight=1):
+        users_list = users_list if users_list is not None else {}
+        matrix = self.get_comembership_matrix()
+        keep = matrix.data >= min_weight
+        user_ids = numpy.array(self.get_user_ids(), dtype=object)
+        user_names = numpy.array([users_list.get(user_id, "None") for user_id in user_ids], dtype=object)
+        rows = matrix.row[keep]
+        cols = matrix.col[keep]
+        with open(filename, 'w', newline='', encoding='utf-8') as outfile:
+            writer = csv.writer(outfile, quoting=csv.QUOTE_ALL)
+            writer.writerow(["user_id", "user_name", "user_id2", "user_name2", "shared_conversations"])
+            writer.writerows(zip(user_ids[rows].tolist(), user_names[rows].tolist(), user_ids[cols].tolist(), user_names[cols].tolist(), matrix.data[keep].tolist()))
+        return int(keep.sum())
+
+    def write_matrix(self, filename, users_list=None):
+        users_list = users_list if users_list is not None else {}
+        scipy.sparse.save_npz(filename, self.get_comembership_matrix().tocsr())
+        with open(f"{filename}.users.csv", 'w', newline='', encoding='utf-8') as outfile:
+            writer = csv.writer(outfile, quoting=csv.QUOTE_ALL)
+            writer.writerow(["index", "user_id", "user_name"])
+            writer.writerows([(index, user_id, users_list.get(user_id, "None")) for index, user_id in enumerate(self.get_user_ids())])
@@ -0,0 +1,99 @@
+"""
+Rows of the messages export, a whole page of messages at a time.
+
+Formatting is where the CPU time goes once the API calls run in parallel, so the per message work is kept small:
+    - the datetime column is built from a cache of the formatted minutes, only the seconds are formatted per message
+    - mentions, channel links, special mentions and links of the message text are resolved in a single pass of one
+      precompiled regex, against the user directory (users_list) and the conversation catalog:
+        <@U123> / <@U123|bob>           -> @bob
+        <#C123> / <#C123|general>       -> #general
+        <!subteam^S123|@team>           -> @team
+        <!here> <!channel> <!everyone>  -> @here @channel @everyone
+        <!date^1392734382^...|Feb 18>   -> Feb 18
+        <https://example.com|example>   -> example (https://example.com)
+        &lt; &gt; &amp;                 -> < > &
+Set resolve_mentions: false in the config to keep the text as Slack sent it (the jsonl raw objects always keep it).
+"""
+
+import functools
+import re
+from datetime import datetime
+
+
+# A Slack token (<...>, with an optional |label) or one of the three HTML entities Slack escapes in the text
+TOKEN_PATTERN = re.compile(r"<([@#!]?)([^<>|]*)(?:\|([^<>]*))?>|&(amp|lt|gt);")
+ENTITIES = {"amp": "&", "lt": "<", "gt": ">"}
+SPECIAL_MENTIONS = ["here", "channel", "everyone"]
+
+
+@functools.lru_cache(maxsize=64*1024)
+def format_minute(minute):
+    return datetime.fromtimestamp(minute * 60).strftime('%Y-%m-%d %H:%M')
+
+
+def ts_to_dt(ts):
+    # Same as datetime.fromtimestamp(float(ts)).strftime('%Y-%m-%d %H:%M:%S') (time zones are offset by whole minutes)
+    seconds = int(float(ts))
+    return f"{format_minute(seconds // 60)}:{seconds % 60:02d}"
+
+
+class MessageFormatter():
+    def __init__(self, conversation_catalog=None, resolve_mentions=True):
+        self.conversation_catalog = conversation_catalog
+        self.resolve_mentions = resolve_mentions
+
+    def get_conversation_name(self, conversation_id, label=None):
+        conversation = self.conversation_catalog.get_by_id(conversation_id) if self.conversation_catalog is not None else None
+        if conversation is not None:
+            return self.conversation_catalog.get_name(conversation)
+        return label or conversation_id
+
+    def resolve_text(self, text, users_list):
+        def replace(match):
+            sigil, target, label, entity = match.groups()
+            if entity is not None:
+                return ENTITIES[entity]
+            if sigil == "@":
+                return "@" + users_list.get(target, label or target)
+            if sigil == "#":
+                return "#" + self.get_conversation_name(target, label)
+            if sigil == "!":
+                command = target.split("^", 1)
+                if command[0] in SPECIAL_MENTIONS:
+                    return "@" + command[0]
+                # subteam, date and the other special tokens come with the text Slack shows for them
+                return label or "@" + command[-1]
+            # A link: <url> or <url|label>
+            if not label or target.split(":", 1)[-1].lstrip("/") == label:
+                return label or target
+            return f"{label} ({target})"
+        return TOKEN_PATTERN.sub(replace, text)
+
+    def format_messages(self, messages, users_list=None, prefix=None):
+        # One list of rows per message, see SlackWriter.write_data_batch
+        prefix = prefix if prefix != None else []
+        users_list = users_list if users_list != None else {}
+        resolve = self.resolve_mentions
+        rows_list = []
+        for message in messages:
+            ts = message.get("ts", None)
+            if ts is None:
+                print(f"Skipping message without ts: {message}")
+                rows_list.append([])
+                continue
+            user = message.get("user", None)
+            text = message.get("text", "") or ""
+            if resolve and ("<" in text or "&" in text):
+                text = self.resolve_text(text, users_list)
+            rows_list.append([prefix + [
+                message.get("subtype", "None"),
+                text,
+                user if user is not None else "None",
+                # Bots and integrations have no user, only the name they posted with
+                users_list.get(user, "None") if user is not None else message.get("username", "None"),
+                ts,
+                ts_to_dt(ts),
+                # Replies point to the ts of their thread's parent (parents point to themselves)
+                message.get("thread_ts", "None"),
+            ]])
+        return rows_list
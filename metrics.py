@@ -0,0 +1,145 @@
+"""
+Metrics of an export: what every API method cost and what every output file received.
+
+Per API method (the WebClient method name):
+    calls, errors, latency histogram, bytes received, retries (split by reason) and time spent blocked by the rate limiter,
+    pages replayed from the page cache (not counted as calls)
+Per output file:
+    rows and bytes written
+
+snapshot() returns all of it as a dict, write_json() and write_prometheus() dump it to a JSON file or to a
+Prometheus textfile (for the node_exporter textfile collector).
+"""
+
+import json
+import os
+import threading
+import time
+
+
+class ExporterMetrics():
+    # Upper bounds (seconds) of the latency histogram buckets, the last one is +Inf
+    LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.methods = {}
+        self.writers = []
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+
+    def get_method(self, method_name):
+        # Must be called holding the lock
+        method = self.methods.get(method_name, None)
+        if method is None:
+            method = {"calls": 0, "errors": 0, "bytes_received": 0, "latency_sum": 0.0,
+                      "latency_buckets": [0] * (len(ExporterMetrics.LATENCY_BUCKETS) + 1),
+                      "retries": {}, "throttled_seconds": 0.0, "cache_hits": 0}
+            self.methods[method_name] = method
+        return method
+
+    def get_response_size(response):
+        # Size of the response body as announced by the server, 0 if unknown (e.g. chunked responses)
+        headers = getattr(response, "headers", None) or {}
+        for key, value in headers.items():
+            if key.lower() == "content-length":
+                try:
+                    return int(value[0] if isinstance(value, list) else value)
+                except ValueError:
+                    return 0
+        return 0
+
+    def record_call(self, method_name, latency, bytes_received=0, error=False):
+        with self.lock:
+            method = self.get_method(method_name)
+            method["calls"] += 1
+            method["errors"] += 1 if error else 0
+            method["bytes_received"] += bytes_received
+            method["latency_sum"] += latency
+            bucket = len(ExporterMetrics.LATENCY_BUCKETS)
+            for idx, upper_bound in enumerate(ExporterMetrics.LATENCY_BUCKETS):
+                if latency <= upper_bound:
+                    bucket = idx
+                    break
+            method["latency_buckets"][bucket] += 1
+
+    def record_retry(self, method_name, reason):
+        with self.lock:
+            retries = self.get_method(method_name)["retries"]
+            retries[reason] = retries.get(reason, 0) + 1
+
+    def record_cache_hit(self, method_name):
+        with self.lock:
+            self.get_method(method_name)["cache_hits"] += 1
+
+    def record_throttle(self, method_name, seconds):
+        if seconds <= 0:
+            return
+        with self.lock:
+            self.get_method(method_name)["throttled_seconds"] += seconds
+
+    def register_writer(self, writer):
+        with self.lock:
+            self.writers.append(writer)
+
+    def get_total(self, key):
+        with self.lock:
+            return sum([method[key] for method in self.methods.values()])
+
+    def snapshot(self):
+        with self.lock:
+            methods = {}
+            for method_name, method in self.methods.items():
+                methods[method_name] = dict(method, retries=dict(method["retries"]), latency_buckets=list(method["latency_buckets"]))
+            files = {writer.filename: {"rows_written": writer.rows_written, "bytes_written": writer.bytes_written} for writer in self.writers}
+        return {
+            "started_at": self.started_at,
+            "elapsed_seconds": time.time() - self.started_at,
+            "latency_buckets": ExporterMetrics.LATENCY_BUCKETS,
+            "methods": methods,
+            "files": files,
+        }
+
+    def write_json(self, filename):
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+            json.dump(self.snapshot(), outfile, indent=1)
+        os.replace(tmp_filename, filename)
+
+    def to_prometheus(self, prefix="slack_exporter"):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join([key + '="' + str(label).replace("\\", "\\\\").replace('"', '\\"') + '"' for key, label in labels])
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}")
+
+        methods = snapshot["methods"]
+        metric("api_calls_total", "counter", "Slack API calls per method", [([("method", m)], v["calls"]) for m, v in methods.items()])
+        metric("api_errors_total", "counter", "Failed Slack API calls per method", [([("method", m)], v["errors"]) for m, v in methods.items()])
+        metric("api_bytes_received_total", "counter", "Bytes received per method", [([("method", m)], v["bytes_received"]) for m, v in methods.items()])
+        metric("rate_limit_wait_seconds_total", "counter", "Seconds spent blocked by the rate limiter per method", [([("method", m)], v["throttled_seconds"]) for m, v in methods.items()])
+        metric("page_cache_hits_total", "counter", "Pages replayed from the page cache per method", [([("method", m)], v["cache_hits"]) for m, v in methods.items()])
+        metric("api_retries_total", "counter", "Retried Slack API calls per method and reason", [([("method", m), ("reason", r)], c) for m, v in methods.items() for r, c in v["retries"].items()])
+        lines.append(f"# HELP {prefix}_api_latency_seconds Latency of the Slack API calls per method")
+        lines.append(f"# TYPE {prefix}_api_latency_seconds histogram")
+        for method_name, method in methods.items():
+            cumulative = 0
+            for upper_bound, count in zip(ExporterMetrics.LATENCY_BUCKETS + ["+Inf"], method["latency_buckets"]):
+                cumulative += count
+                lines.append(f'{prefix}_api_latency_seconds_bucket{{method="{method_name}",le="{upper_bound}"}} {cumulative}')
+            lines.append(f'{prefix}_api_latency_seconds_sum{{method="{method_name}"}} {method["latency_sum"]}')
+            lines.append(f'{prefix}_api_latency_seconds_count{{method="{method_name}"}} {method["calls"]}')
+        files = snapshot["files"]
+        metric("rows_written_total", "counter", "Rows written per output file", [([("file", os.path.basename(f))], v["rows_written"]) for f, v in files.items()])
+        metric("bytes_written_total", "counter", "Bytes written per output file", [([("file", os.path.basename(f))], v["bytes_written"]) for f, v in files.items()])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename, prefix="slack_exporter"):
+        # Written to a temporary file and renamed, so the textfile collector never reads half a file
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+            outfile.write(self.to_prometheus(prefix))
+        os.replace(tmp_filename, filename)
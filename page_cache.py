@@ -0,0 +1,211 @@
+"""
+Record/replay cache of the raw Slack API pages.
+
+Every page returned by call_method can be kept on disk, so an export can be run again (a new output format, a
+formatter fix...) from the pages of a previous run instead of downloading everything from Slack again:
+    - a page is keyed by the API method and its arguments, cursor included: the sha256 of method + sorted JSON arguments
+    - pages are stored gzipped under the sha256 of their content (pages/ab/abcdef....json.gz), identical pages
+      (e.g. the empty last page of many conversations) are stored once
+    - an index persisted to JSON (index.json) maps the keys to their page, with when it was stored and last used
+    - `max_bytes` bounds the (compressed) size of the pages, the least recently used ones are evicted first
+    - `ttl` (seconds) is a number for every method or a dict keyed by method name (with an optional "default"),
+      e.g. {"users_list": 86400, "conversations_list": 3600}: older pages are fetched again. None never expires
+Modes (`page_cache_mode`):
+    record:  every call goes to Slack and its page is stored (replacing the cached one). The default: a cached first
+             page of conversations.history or conversations.list would hide the new messages and channels
+    replay:  cached pages are served from disk, without network or rate limit cost, the others are fetched and stored
+    offline: only cached pages are served, a page that is not in the cache raises a PageCacheMissError
+Errors are never cached, and the arguments must be the same to replay a page (e.g. the oldest= of a checkpoint).
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from slack_sdk.errors import SlackApiError
+
+
+class PageCacheMissError(SlackApiError):
+    # A SlackApiError, so an offline export handles a missing page like any other failed call
+    def __init__(self, message):
+        super().__init__(message, None)
+
+
+class PageCache():
+    RECORD = "record"
+    REPLAY = "replay"
+    OFFLINE = "offline"
+    MODES = [RECORD, REPLAY, OFFLINE]
+
+    def __init__(self, folder, mode="record", max_bytes=1024*1024*1024, ttl=None, compression_level=6, save_every=100):
+        if mode not in PageCache.MODES:
+            raise ValueError(f"Unknown page cache mode {mode}, expected one of {', '.join(PageCache.MODES)}")
+        self.folder = folder
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.compression_level = compression_level
+        # Like the file store, the index is saved every save_every new pages and on close(): pages stored since
+        # the last save are only orphans after a crash, they are fetched again (and stored once)
+        self.save_every = save_every
+        self.unsaved = 0
+        self.pages_folder = os.path.join(folder, "pages")
+        self.index_filename = os.path.join(folder, "index.json")
+        os.makedirs(self.pages_folder, exist_ok=True)
+        self.entries = {}
+        # Number of entries pointing to every page and its size, and the total size of the pages
+        self.pages = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.index_filename):
+            return
+        try:
+            with open(self.index_filename, 'r', encoding='utf-8') as infile:
+                self.entries = json.load(infile)
+            print(f"Loaded {len(self.entries)} cached pages from {self.index_filename}")
+        except (IOError, ValueError) as e:
+            print(f"Error reading page cache index {self.index_filename}: {e}")
+        for entry in self.entries.values():
+            self.add_reference(entry)
+
+    def save(self):
+        # Must be called holding the lock
+        tmp_filename = f"{self.index_filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+            json.dump(self.entries, outfile)
+        os.replace(tmp_filename, self.index_filename)
+
+    def get_key(method_name, client_args):
+        # None arguments are not sent to Slack (e.g. the cursor of a first page), they are not part of the key
+        args = {key: value for key, value in client_args.items() if value is not None}
+        return hashlib.sha256(f"{method_name}\n{json.dumps(args, sort_keys=True, default=str)}".encode("utf-8")).hexdigest()
+
+    def get_page_path(self, sha256):
+        return os.path.join(self.pages_folder, sha256[:2], f"{sha256}.json.gz")
+
+    def get_ttl(self, method_name):
+        if isinstance(self.ttl, dict):
+            return self.ttl.get(method_name, self.ttl.get("default", None))
+        return self.ttl
+
+    def add_reference(self, entry):
+        # Must be called holding the lock
+        page = self.pages.get(entry["page"], None)
+        if page is None:
+            page = {"references": 0, "size": entry["size"]}
+            self.pages[entry["page"]] = page
+            self.total_bytes += entry["size"]
+        page["references"] += 1
+
+    def remove_entry(self, key):
+        # Must be called holding the lock. The page is deleted with its last entry
+        entry = self.entries.pop(key)
+        page = self.pages[entry["page"]]
+        page["references"] -= 1
+        if page["references"] > 0:
+            return
+        del self.pages[entry["page"]]
+        self.total_bytes -= page["size"]
+        try:
+            os.remove(self.get_page_path(entry["page"]))
+        except FileNotFoundError:
+            pass
+
+    def get(self, method_name, client_args):
+        # The cached data of the call, None if there is none (or it expired, or it must be fetched again)
+        if self.mode == PageCache.RECORD:
+            return None
+        key = PageCache.get_key(method_name, client_args)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key, None)
+            ttl = self.get_ttl(method_name)
+            if entry is not None and ttl is not None and now - entry["stored"] > ttl:
+                self.remove_entry(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            entry["used"] = now
+        try:
+            with gzip.open(self.get_page_path(entry["page"]), 'rt', encoding='utf-8') as infile:
+                data = json.load(infile)
+        except (IOError, ValueError, EOFError) as e:
+            # Evicted in the meantime or corrupt: fetched again
+            print(f"Error reading cached page {entry['page']} of {method_name}: {e}")
+            with self.lock:
+                if key in self.entries:
+                    self.remove_entry(key)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, method_name, client_args, data):
+        if self.mode == PageCache.OFFLINE:
+            return
+        content = json.dumps(data, sort_keys=True).encode("utf-8")
+        sha256 = hashlib.sha256(content).hexdigest()
+        page_path = self.get_page_path(sha256)
+        key = PageCache.get_key(method_name, client_args)
+        with self.lock:
+            stored = sha256 in self.pages
+        size = None
+        if not stored:
+            compressed = gzip.compress(content, compresslevel=self.compression_level)
+            os.makedirs(os.path.dirname(page_path), exist_ok=True)
+            # Several threads can store the same page at the same time, each one through its own temporary file
+            tmp_filename = f"{page_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_filename, 'wb') as outfile:
+                outfile.write(compressed)
+            os.replace(tmp_filename, page_path)
+            size = len(compressed)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry["page"] == sha256:
+                # Same page as before (e.g. recorded again)
+                entry["stored"] = now
+                entry["used"] = now
+                return
+            if entry is not None:
+                self.remove_entry(key)
+            page = self.pages.get(sha256, None)
+            if page is not None:
+                # Already stored, possibly by another thread in the meantime
+                size = page["size"]
+            elif size is None:
+                # Evicted since it was found stored, it will be fetched again
+                return
+            entry = {"method": method_name, "args": {k: v for k, v in client_args.items() if v is not None},
+                     "page": sha256, "size": size, "stored": now, "used": now}
+            self.entries[key] = entry
+            self.add_reference(entry)
+            if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                self.evict()
+            self.unsaved += 1
+            if self.unsaved >= self.save_every:
+                self.save()
+                self.unsaved = 0
+
+    def evict(self):
+        # Must be called holding the lock. Down to 90% of max_bytes, so the next pages do not evict one by one
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["used"]):
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            self.remove_entry(key)
+
+    def close(self):
+        with self.lock:
+            self.save()
+            self.unsaved = 0
+        if self.hits + self.misses > 0:
+            print(f"Page cache {self.folder}: {self.hits} pages replayed, {self.misses} fetched, {len(self.entries)} pages ({self.total_bytes} bytes) cached")
@@ -0,0 +1,134 @@
+"""
+Rate limit coordinator shared by several exporter processes (or hosts).
+
+Slack's limits are per workspace and app, not per process: exporters running side by side must share one
+budget. The coordinator owns the RateLimiter and answers over a plain TCP socket, one line per request:
+
+    reserve <method_name> <tokens>      ->  <seconds to wait before calling>
+    retry_after <method_name> <seconds> ->  ok
+
+RemoteRateLimiter has the same reserve/acquire/retry_after methods as RateLimiter, so an exporter only needs
+its rate_limiter replaced to take part. Run a standalone coordinator with:
+    python rate_coordinator.py --host 0.0.0.0 --port 8766 --config config.yaml
+"""
+
+import argparse
+import socket
+import socketserver
+import threading
+import time
+import yaml
+from rate_limiter import RateLimiter
+
+
+class RateLimitHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        rate_limiter = self.server.rate_limiter
+        for line in self.rfile:
+            parts = line.decode("utf-8").split()
+            try:
+                if len(parts) == 3 and parts[0] == "reserve":
+                    response = f"{rate_limiter.reserve(parts[1], float(parts[2])):.6f}"
+                elif len(parts) == 3 and parts[0] == "retry_after":
+                    rate_limiter.retry_after(parts[1], float(parts[2]))
+                    response = "ok"
+                else:
+                    response = "error unknown request"
+            except ValueError as e:
+                response = f"error {e}"
+            self.wfile.write(f"{response}\n".encode("utf-8"))
+
+
+class RateLimitCoordinator(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, method_limits=None):
+        super().__init__((host, port), RateLimitHandler)
+        self.rate_limiter = RateLimiter(method_limits)
+
+    def get_address(self):
+        return f"{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RemoteRateLimiter():
+    def __init__(self, address, timeout=30):
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.timeout = timeout
+        # One connection per thread, requests of a connection are answered in order
+        self.local = threading.local()
+
+    def get_connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+            connection = (sock, sock.makefile("rb"))
+            self.local.connection = connection
+        return connection
+
+    def close_connection(self):
+        connection = getattr(self.local, "connection", None)
+        self.local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def request(self, line):
+        # Retried once on a fresh connection, e.g. after the coordinator closed an idle one
+        for attempt in range(0, 2):
+            try:
+                sock, reader = self.get_connection()
+                sock.sendall(f"{line}\n".encode("utf-8"))
+                response = reader.readline().decode("utf-8").strip()
+                if response == "":
+                    raise ConnectionError("connection closed by the coordinator")
+                if response.startswith("error"):
+                    raise ValueError(f"Rate limit coordinator: {response}")
+                return response
+            except (OSError, ConnectionError) as e:
+                self.close_connection()
+                if attempt > 0:
+                    raise ConnectionError(f"Rate limit coordinator {self.address[0]}:{self.address[1]} unreachable: {e}")
+
+    def reserve(self, method_name, tokens=1):
+        return float(self.request(f"reserve {method_name} {tokens}"))
+
+    def acquire(self, method_name, tokens=1):
+        wait = self.reserve(method_name, tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def retry_after(self, method_name, seconds):
+        self.request(f"retry_after {method_name} {seconds}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rate limit coordinator shared by several Slack exporters")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--config", default=None, help="config file to read rate_limits from")
+    args = parser.parse_args()
+    method_limits = None
+    if args.config is not None:
+        method_limits = (yaml.safe_load(open(args.config)) or {}).get("rate_limits", None)
+    coordinator = RateLimitCoordinator(args.host, args.port, method_limits)
+    print(f"Rate limit coordinator listening on {coordinator.get_address()}")
+    try:
+        coordinator.serve_forever()
+    except KeyboardInterrupt:
+        coordinator.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Per-method token-bucket rate limiting for the Slack Web API.
+
+Slack assigns every Web API method to a rate limit tier (https://api.slack.com/docs/rate-limits)
+and each method has its own budget, so a busy conversations.history loop should not slow down
+users.info or reactions.get calls. Every method gets its own bucket, sized from its tier.
+"""
+
+import threading
+import time
+
+
+class TokenBucket():
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate_per_minute = rate_per_minute
+        self.rate = rate_per_minute / 60.0
+        # By default allow a burst of a few seconds worth of calls (but always at least one)
+        self.capacity = burst if burst is not None else max(1.0, self.rate * 3)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reserve(self, tokens=1):
+        # Takes the tokens straight away (possibly going into debt) and returns how long the caller
+        # has to wait before using them. This never blocks, so it works for threads and asyncio alike.
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= tokens
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.blocked_until - now)
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def block_for(self, seconds):
+        # Slack told us to back off (HTTP 429 + Retry-After): nobody gets a token until then
+        with self.lock:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = min(self.tokens, 0)
+            self.last_refill = max(self.last_refill, now)
+
+
+class RateLimiter():
+    # Minimum calls per minute guaranteed by each tier
+    TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+
+    # Keyed by the WebClient method name (i.e. client_method.__name__)
+    METHOD_TIERS = {
+        "conversations_list": 2,
+        "conversations_history": 3,
+        "conversations_members": 4,
+        "conversations_replies": 3,
+        "conversations_info": 3,
+        "users_list": 2,
+        "users_info": 4,
+        "reactions_get": 3,
+    }
+
+    def __init__(self, method_limits=None, tiers=None, default_tier=3):
+        self.tiers = dict(RateLimiter.TIERS)
+        if tiers is not None:
+            self.tiers.update(tiers)
+        self.method_limits = method_limits if method_limits is not None else {}
+        self.default_tier = default_tier
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_method_limit(self, method_name):
+        if method_name in self.method_limits:
+            return self.method_limits[method_name]
+        return self.tiers[RateLimiter.METHOD_TIERS.get(method_name, self.default_tier)]
+
+    def get_bucket(self, method_name):
+        with self.lock:
+            bucket = self.buckets.get(method_name, None)
+            if bucket is None:
+                bucket = TokenBucket(self.get_method_limit(method_name))
+                self.buckets[method_name] = bucket
+            return bucket
+
+    def reserve(self, method_name, tokens=1):
+        return self.get_bucket(method_name).reserve(tokens)
+
+    def acquire(self, method_name, tokens=1):
+        return self.get_bucket(method_name).acquire(tokens)
+
+    def retry_after(self, method_name, seconds):
+        self.get_bucket(method_name).block_for(seconds)
+
+    def get_retry_after(error, default=None):
+        # Reads the Retry-After header (in seconds) out of a SlackApiError, if it was a 429
+        response = getattr(error, "response", None)
+        if response is None or getattr(response, "status_code", None) != 429:
+            return None
+        headers = {k.lower(): v for k, v in response.headers.items()}
+        try:
+            return float(headers.get("retry-after", default))
+        except (TypeError, ValueError):
+            return default
@@ -0,0 +1,21 @@
+"""
+Background queue for the reactions.get calls of an export.
+
+Only messages whose inline reactions are truncated end up here (see SlackExporter.needs_reactions_lookup).
+The worker threads pick them up in batches and go through SlackExporter.get_message_reactions,
+so every call still takes a token from the reactions_get bucket of the rate limiter,
+while the main thread keeps paging through conversations.history.
+"""
+
+from background_fetcher import BackgroundFetcher
+
+
+class ReactionsFetcher(BackgroundFetcher):
+    name = "reactions_fetcher"
+
+    def fetch(self, writers, conversation_id, message, convo_info_prefix):
+        msg_reactions = self.exporter.get_message_reactions(conversation_id, message["ts"])
+        if msg_reactions is None:
+            # Better the truncated reactions than none at all
+            msg_reactions = message.get("reactions", None)
+        self.exporter.write_message_reactions(writers, message, msg_reactions, convo_info_prefix)
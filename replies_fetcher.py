@@ -0,0 +1,32 @@
+"""
+Background queue for the conversations.replies calls of an export.
+
+conversations.history only returns the parent message of each thread. The parents with reply_count > 0
+are queued here while the history is still being paged, the worker threads fetch the whole thread
+(going through the conversations_replies bucket of the rate limiter) and write the replies to the messages output.
+Threads of previous incremental runs are queued with their latest known reply as oldest=, only their new replies are fetched.
+Failed threads are reported to the exporter (failure report, and kept in the checkpoints to be fetched again).
+"""
+
+from slack_sdk.errors import SlackApiError
+from background_fetcher import BackgroundFetcher
+
+
+class RepliesFetcher(BackgroundFetcher):
+    name = "replies_fetcher"
+
+    def fetch(self, writers, conversation_id, message, convo_info_prefix, oldest=None):
+        # Replies come oldest first, a failed thread is fetched again from the last reply written
+        latest_reply = oldest
+        try:
+            for replies in self.exporter.iter_thread_replies(conversation_id, message["ts"], oldest=oldest):
+                self.exporter.write_messages(writers, conversation_id, replies, convo_info_prefix)
+                if len(replies) > 0:
+                    latest_reply = replies[-1]["ts"]
+                    if oldest is not None:
+                        self.exporter.checkpoints.thread_replied(conversation_id, message["ts"], latest_reply)
+        except SlackApiError as e:
+            self.exporter.record_thread_failure(conversation_id, convo_info_prefix, message["ts"], latest_reply, e)
+            return
+        if self.exporter.checkpoints is not None:
+            self.exporter.checkpoints.thread_fetched(conversation_id, message["ts"])
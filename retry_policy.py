@@ -0,0 +1,97 @@
+"""
+When (and for how long) a failed Slack API call is retried.
+
+Errors fall in three classes:
+    rate_limited:   HTTP 429, retried after the Retry-After Slack asked for, retry_delay without one (handled by the rate limiter)
+    permanent:      retrying cannot help (channel_not_found, not_in_channel, missing_scope...), raised straight away
+    retryable:      network errors, timeouts, 5xx and Slack's internal errors, retried with exponential backoff and full jitter
+
+Retries of the calls of a conversation (keyed by the "channel" argument) share a budget of `conversation_budget`
+seconds of backoff. Once a call runs out of attempts or of budget a RetriesExhaustedError is raised, the export
+moves on to the next conversation and tries the failed one again at the end (see SlackExporter.export_conversation_data).
+"""
+
+import random
+import threading
+from slack_sdk.errors import SlackApiError
+from rate_limiter import RateLimiter
+
+
+class RetriesExhaustedError(SlackApiError):
+    # A SlackApiError, so everything that handles API errors handles this one as well
+    def __init__(self, message, error):
+        super().__init__(message, getattr(error, "response", None))
+        self.error = error
+
+
+class RetryPolicy():
+    RATE_LIMITED = "rate_limited"
+    PERMANENT = "permanent"
+    RETRYABLE = "retryable"
+
+    # Slack "error" values that will not go away by asking again
+    PERMANENT_ERRORS = set([
+        "channel_not_found", "not_in_channel", "missing_scope", "invalid_auth", "not_authed", "account_inactive",
+        "token_revoked", "token_expired", "no_permission", "access_denied", "ekm_access_denied", "team_access_not_granted",
+        "method_not_supported_for_channel_type", "thread_not_found", "message_not_found", "user_not_found",
+        "invalid_arguments", "invalid_arg_name", "invalid_cursor", "invalid_ts_latest", "invalid_ts_oldest",
+        "not_allowed_token_type", "is_archived", "org_login_required", "unknown_method",
+    ])
+    # Slack "error" values of transient failures on Slack's side
+    RETRYABLE_ERRORS = set(["internal_error", "fatal_error", "service_unavailable", "request_timeout"])
+
+    def __init__(self, max_retries=5, base_delay=1, max_delay=60, conversation_budget=300):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.conversation_budget = conversation_budget
+        self.spent = {}
+        self.lock = threading.Lock()
+
+    def classify(self, error):
+        if RateLimiter.get_retry_after(error) is not None:
+            return RetryPolicy.RATE_LIMITED
+        response = getattr(error, "response", None)
+        if isinstance(error, SlackApiError) and response is not None:
+            status_code = getattr(response, "status_code", 200) or 200
+            try:
+                slack_error = response.get("error", None)
+            except (AttributeError, TypeError):
+                slack_error = None
+            if slack_error in RetryPolicy.RETRYABLE_ERRORS or status_code >= 500:
+                return RetryPolicy.RETRYABLE
+            if status_code == 429 or slack_error == "ratelimited":
+                # A 429 without (or with an unreadable) Retry-After is still rate limited, not a permanent 4xx
+                return RetryPolicy.RATE_LIMITED
+            if slack_error in RetryPolicy.PERMANENT_ERRORS or 400 <= status_code < 500:
+                return RetryPolicy.PERMANENT
+            # An ok: false with an error we do not know: asking again gets the same answer
+            return RetryPolicy.PERMANENT if slack_error is not None else RetryPolicy.RETRYABLE
+        # Connection errors, timeouts, broken responses...
+        return RetryPolicy.RETRYABLE
+
+    def get_delay(self, attempt):
+        # Full jitter: anywhere between 0 and the exponential backoff, so parallel retries spread out
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def get_budget_key(self, client_args):
+        return client_args.get("channel", None)
+
+    def next_delay(self, attempt, client_args):
+        # Seconds to wait before the next attempt, or None once the attempts or the conversation budget are used up
+        if attempt >= self.max_retries:
+            return None
+        delay = self.get_delay(attempt)
+        key = self.get_budget_key(client_args)
+        if key is None:
+            return delay
+        with self.lock:
+            spent = self.spent.get(key, 0)
+            if spent + delay > self.conversation_budget:
+                return None
+            self.spent[key] = spent + delay
+        return delay
+
+    def reset_budget(self, key):
+        with self.lock:
+            self.spent.pop(key, None)
@@ -0,0 +1,164 @@
+"""
+Sharded export: the conversations are partitioned across worker processes, on one or several hosts.
+
+Conversation IDs are hashed (crc32, stable across processes and hosts) into `shards` partitions, each shard is exported
+by its own SlackExporter process into `<output_folder>/shard_<N>` and described by a `shard_<N>.json` manifest.
+All the workers take their rate limit tokens from a single RateLimitCoordinator (rate_coordinator.py), so together they
+stay within the limits of the workspace. Once every shard is done, merge_shards concatenates the shard files into one
+file per export type.
+
+On a single host everything is started by:
+    python sharded_export.py run --config config.yaml --shards 8 --messages --members
+Across hosts, start a coordinator (python rate_coordinator.py --host 0.0.0.0) and on every host:
+    python sharded_export.py worker --config config.yaml --shards 8 --shard 3 --coordinator coordinator-host:8766 --output shared/export
+then, with all the shard folders in the same place:
+    python sharded_export.py merge --output shared/export
+
+Checkpoints (and metrics files, SQLite databases) are kept per shard, incremental runs must keep the same number of shards.
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import zlib
+import yaml
+from rate_coordinator import RateLimitCoordinator
+from slack_exporter import SlackExporter, conversation_types
+from slack_writers import merge_files
+
+
+def get_shard(conversation_id, shards):
+    return zlib.crc32(conversation_id.encode("utf-8")) % shards
+
+
+def get_shard_name(shard):
+    return f"shard_{shard:03d}"
+
+
+def get_shard_config(config, shard, shards, output_folder, coordinator_address=None):
+    # Overrides of the config file for the worker of a shard
+    shard_config = {"data_folder": os.path.join(output_folder, get_shard_name(shard))}
+    if coordinator_address is not None:
+        shard_config["rate_coordinator"] = coordinator_address
+    for key in ["checkpoint_file", "metrics_file", "metrics_prometheus_file", "sqlite_file", "page_cache_folder"]:
+        if config.get(key, None):
+            shard_config[key] = f"{config[key]}.{shard:03d}of{shards:03d}"
+    return shard_config
+
+
+def run_shard(config_filename, shard, shards, output_folder, coordinator_address=None, types=None, is_member=None, export_options=None):
+    config = yaml.safe_load(open(config_filename)) or {}
+    exporter = SlackExporter(config_filename, config=get_shard_config(config, shard, shards, output_folder, coordinator_address))
+    conversations = [conversation for conversation in exporter.get_conversations(types=types, is_member=is_member) if get_shard(conversation["id"], shards) == shard]
+    print(f"Shard {shard}/{shards}: exporting {len(conversations)} conversations")
+    exporter.export_conversation_data(conversations, **(export_options or {}))
+    manifest = {
+        "shard": shard,
+        "shards": shards,
+        "output_format": exporter.output_format,
+        "export_time": exporter.config["last_export_time"],
+        "conversations": [conversation["id"] for conversation in conversations],
+        # Relative to the output folder, so the shard folders can be gathered from several hosts
+        "files": {export_type: os.path.relpath(filename, output_folder) for export_type, filename in exporter.export_files.items()},
+    }
+    manifest_filename = os.path.join(output_folder, f"{get_shard_name(shard)}.json")
+    with open(manifest_filename, 'w', encoding='utf-8') as outfile:
+        json.dump(manifest, outfile, indent=1)
+    return manifest_filename
+
+
+def merge_shards(output_folder):
+    # One file per export type out of all the shard manifests found in output_folder
+    manifests = []
+    for manifest_filename in sorted(glob.glob(os.path.join(output_folder, "shard_*.json"))):
+        with open(manifest_filename, 'r', encoding='utf-8') as infile:
+            manifests.append(json.load(infile))
+    if len(manifests) == 0:
+        print(f"No shard manifests found in {output_folder}")
+        return {}
+    shards = manifests[0]["shards"]
+    missing = set(range(0, shards)) - set([manifest["shard"] for manifest in manifests])
+    if len(missing) > 0:
+        print(f"Warning: shards {sorted(missing)} of {shards} are missing, their conversations are not in the merged files")
+    output_format = manifests[0]["output_format"]
+    export_time = manifests[0]["export_time"]
+    merged = {}
+    for export_type in sorted(set([export_type for manifest in manifests for export_type in manifest["files"]])):
+        filenames = [os.path.join(output_folder, manifest["files"][export_type]) for manifest in manifests if export_type in manifest["files"]]
+        output_filename = os.path.join(output_folder, f"{export_type}_all_{export_time}.{output_format}")
+        if output_format == "sqlite":
+            # The shard databases hold every export type, they are merged once
+            output_filename = os.path.join(output_folder, f"slack_export_all_{export_time}.db")
+            if output_filename in merged.values():
+                merged[export_type] = output_filename
+                continue
+        merged[export_type] = merge_files(filenames, output_filename, output_format)
+        print(f"Merged {len(filenames)} {export_type} shard files into {output_filename}")
+    return merged
+
+
+def export_sharded(config_filename, shards, output_folder=None, coordinator_address=None, types=None, is_member=None, **export_options):
+    # Runs every shard in its own local process, then merges their files
+    exporter = SlackExporter(config_filename)
+    # Workers load the user directory and the conversation catalog from the cache files refreshed here
+    exporter.get_conversations()
+    if output_folder is None:
+        output_folder = os.path.join(exporter.config.get("data_folder", "slack_export"), f"sharded_{exporter.config['last_export_time']}")
+    os.makedirs(output_folder, exist_ok=True)
+    coordinator = None
+    if coordinator_address is None:
+        coordinator = RateLimitCoordinator(method_limits=exporter.config.get("rate_limits", None)).start()
+        coordinator_address = coordinator.get_address()
+    processes = []
+    for shard in range(0, shards):
+        process = multiprocessing.Process(target=run_shard, args=(config_filename, shard, shards, output_folder, coordinator_address, types, is_member, export_options), name=get_shard_name(shard))
+        process.start()
+        processes.append(process)
+    failed = []
+    for shard, process in enumerate(processes):
+        process.join()
+        if process.exitcode != 0:
+            failed.append(shard)
+    if coordinator is not None:
+        coordinator.stop()
+    if len(failed) > 0:
+        print(f"Shards {failed} failed, run them again with: python sharded_export.py worker --shard N ... and merge again")
+    return merge_shards(output_folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded export of a Slack workspace")
+    parser.add_argument("command", choices=["run", "worker", "merge"])
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--shards", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--shard", type=int, action="append", help="shard(s) run by this worker (can be repeated)")
+    parser.add_argument("--coordinator", default=None, help="host:port of a running rate_coordinator.py")
+    parser.add_argument("--output", default=None, help="folder of the shard files")
+    parser.add_argument("--types", type=conversation_types, default=None, help="comma separated conversation types, e.g. public_channel,private_channel")
+    parser.add_argument("--member-only", action="store_true", help="only the conversations the bot is a member of")
+    parser.add_argument("--messages", action="store_true")
+    parser.add_argument("--reactions", action="store_true")
+    parser.add_argument("--members", action="store_true")
+    parser.add_argument("--threads", action="store_true")
+    args = parser.parse_args()
+
+    types = args.types
+    is_member = True if args.member_only else None
+    export_options = {"export_messages": args.messages, "export_messages_reactions": args.reactions, "export_members": args.members, "export_threads": args.threads}
+    if args.command == "run":
+        export_sharded(args.config, args.shards, args.output, args.coordinator, types, is_member, **export_options)
+    elif args.command == "worker":
+        if args.output is None or args.coordinator is None or not args.shard:
+            parser.error("worker needs --output, --coordinator and at least one --shard")
+        for shard in args.shard:
+            run_shard(args.config, shard, args.shards, args.output, args.coordinator, types, is_member, export_options)
+    elif args.command == "merge":
+        if args.output is None:
+            parser.error("merge needs --output")
+        merge_shards(args.output)
+
+
+if __name__ == "__main__":
+    main()
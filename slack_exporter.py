@@ -15,143 +15,45 @@ How to run it:
     group_messages_file: group_messages.csv
     logger_name: slack_bot_log.txt
 
-4. Get the conversation you want with:
-    convos = get_conversations(types="public_channel,private_channel,im,mpim")
-5. Export the data to csb with:
-    export_all_conversations_history(convos)
+4. List the conversations and export them with:
+    python slack_exporter.py list
+    python slack_exporter.py export --reactions --members
+   (python slack_exporter.py export --plan estimates the API calls and time of an export without running it), or from Python:
+    exporter = SlackExporter("config.yaml")
+    exporter.export_conversation_data(exporter.get_conversations(types=["public_channel"]), export_messages=True)
 """
 
-from datetime import datetime
+from datetime import datetime, date, timedelta
 import os
 # Import WebClient from Python SDK (github.com/slackapi/python-slack-sdk)
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 import yaml
 import logging
+import argparse
+import asyncio
 # import utils
 import csv
-import os
-import concurrent.futures
 import time
-
-class SlackCSVWriter():
-    def __init__(self, filename, headers=None):
-        self.filename = filename
-        self.initialized = False
-        self.file = open(self.filename, 'w', newline='', encoding='utf-8')
-        self.csv_writer = csv.writer(self.file, delimiter=',', quoting=csv.QUOTE_ALL)
-        self.headers = headers
-        self.creation_time = datetime.now()
-        if self.headers is not None:
-            self.init(self.headers)
-    
-    def init(self, headers = None):
-        # self.make_folder()
-        # self.csv_writer.writerow(["convo_id", "convo_name", "convo_type", "msg_subtype", "msg_text", "msg_user_id", "msg_user_name", "msg_timestamp", "msg_datetime"])  
-        if not self.initialized and headers is not None:
-            self.csv_writer.writerow(headers)  
-            self.initialized = True
-
-    def close(self):
-        self.file.close()
-
-
-    def write_data(self, data_list, formatter=None, **kwargs):
-        if not isinstance(data_list, list):
-            data_list = [data_list]
-        for data in data_list:
-            if formatter is None:
-                self.csv_writer.writerows(data)
-            else:
-                self.csv_writer.writerows(formatter(data, **kwargs))
-            self.file.flush()
-    
-    def close(self):
-        self.file.close()
-
-    def dt_to_ts(datetime_str):
-        # datetime_str = '2018-06-29 08:15:27.243860'
-        datetime_obj = datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S')
-        return datetime.timestamp(datetime_obj)
-
-    def ts_to_dt(ts):
-        return datetime.fromtimestamp(float(ts)).strftime('%Y-%m-%d %H:%M:%S')
-        
-    def format_message(message, users_list=None, prefix=None):
-        prefix = prefix if prefix != None else []
-        users_list = users_list if users_list != None else []
-        rows = []
-        try:
-            row = []
-            # row.append(message["message_id"])
-            try:
-                row.append(message["subtype"])
-            except Exception as e:
-                row.append("None")
-            row.append(message["text"])
-            try:
-                row.append(message["user"])
-            except Exception as e:
-                row.append("None")
-            try:
-                row.append(users_list.get(user, "None"))
-            except:
-                row.append("None")
-            row.append(message["ts"])
-            row.append(SlackCSVWriter.ts_to_dt(message["ts"]))
-            # print(f"{self.ts_to_dt(message['ts'])}\t{message['client_msg_id']}\t{message['type']}\t{message['user']}\t{message['team']}\t{message['text']}")
-            rows.append(prefix+row)
-        except Exception as e:
-            print(f"error while writing to file: {e}")
-        return rows
-
-    def format_reaction(reaction, users_list=None, prefix=None):
-        prefix = prefix if prefix != None else []
-        users_list = users_list if users_list != None else []
-        rows = []
-        for user in reaction["users"]:
-            try:
-                row = []
-                try:
-                    row.append(reaction["name"])
-                except Exception as e:
-                    row.append("None")
-                try:
-                    row.append(user)
-                except Exception as e:
-                    row.append("None")            
-                try:
-                    row.append(users_list.get(user, "None"))
-                except:
-                    row.append("None")
-                # print(f"{self.ts_to_dt(message['ts'])}\t{message['client_msg_id']}\t{message['type']}\t{message['user']}\t{message['team']}\t{message['text']}")
-                rows.append(prefix+msg_prefix+row)
-            except Exception as e:
-                print(f"Error while writing to file: {e}")
-        return rows
-
-    def format_member(member, users_list=None, as_graph=False, prefix=None):      
-        prefix = prefix if prefix != None else []
-        users_list = users_list if users_list != None else []
-        rows = []
-        user_name = "None"
-        try:
-            user_name = users_list.get(user, "None")
-        except Exception as e:
-            print(f"Error getting {member} user_name: {e}")
-
-        if as_graph:
-            for p_member in members:
-                p_user_name = "None"
-                try:
-                    p_user_name = users_list[p_member]
-                except Exception as e:
-                    print(f"Error getting second user {p_user_name} user_name: {e}")
-                rows.append(prefix + [member, user_name, p_member, p_user_name])
-        else:
-            rows.append(prefix + [member,user_name])
-        return rows
-        
+import random
+from rate_limiter import RateLimiter
+from rate_coordinator import RemoteRateLimiter
+from http_transport import get_web_client
+from page_cache import PageCache, PageCacheMissError
+from retry_policy import RetryPolicy, RetriesExhaustedError
+from metrics import ExporterMetrics
+from checkpoint_store import CheckpointStore
+from reactions_fetcher import ReactionsFetcher
+from replies_fetcher import RepliesFetcher
+from files_fetcher import FilesFetcher
+from file_store import FileStore
+from user_directory import UserDirectory
+from conversation_catalog import ConversationCatalog
+from history_shards import ShardedHistoryFetcher
+from members_graph import MembersGraph
+from message_formatter import MessageFormatter
+from slack_writers import SlackWriter, open_writer
+from export_plan import ExportPlan
 
 class SlackExporter():
     class ExportType:
@@ -160,43 +62,130 @@ class SlackExporter():
         Files = "files"
         Members = "members"
 
-    def __init__(self, config_filename=None, bot_token=None):
+    def __init__(self, config_filename=None, bot_token=None, config=None):
         self.config = {}
         self.config_filename = config_filename
 
         if self.config_filename is not None:
             self.config = yaml.safe_load(open(self.config_filename))
+        # Overrides of the config file values (e.g. the per shard settings of sharded_export.py)
+        self.config.update(config or {})
         
         self.bot_token = self.config.get("SLACK_BOT_TOKEN", None)
         if self.bot_token is None:
-            if bot_token is None:
-                print("You need to provide a Slack BOT token!")
-                return 
             self.bot_token = bot_token
 
-        self.client = WebClient(token=self.bot_token)
-            
+        # Only needed to point the exporter to a stand-in of the Slack Web API (see benchmarks/mock_slack_server.py)
+        self.api_url = self.config.get("slack_api_url", WebClient.BASE_URL)
+        # Nothing is fetched (or even connected) here: the client, the user directory and the conversation catalog
+        # are created the first time something needs them (see the properties below), so a short job only pays for what it uses
+        self._client = None
+        self._users_list = None
+        self._user_directory = None
+        self._conversation_catalog = None
+        self._message_formatter = None
+
         self.config['last_export_time'] = self.formatted_now()
-        self.base_path = self.config.get("data_folder", "slack_export") +"\\" + self.config["last_export_time"]
-        self.rate_limit = self.config.get("rate_limit", 80)
-        self.rate_limit_wait = self.config.get("wait_time", 10)
+        self.base_path = os.path.join(self.config.get("data_folder", "slack_export"), self.config["last_export_time"])
+        # Calls per minute for specific API methods (e.g. conversations_history: 50), anything else uses its Slack tier limit
+        self.rate_limiter = RateLimiter(self.config.get("rate_limits", None))
+        if self.config.get("rate_coordinator", None):
+            # host:port of a RateLimitCoordinator shared with other exporters (see rate_coordinator.py and sharded_export.py)
+            self.rate_limiter = RemoteRateLimiter(self.config["rate_coordinator"])
         self.retry_delay = self.config.get("retry_delay", 5)
+        # Exponential backoff (from retry_delay up to max_retry_delay) of the transient errors, within retry_budget seconds per conversation
+        self.retry_policy = RetryPolicy(self.config.get("max_retries", 5), self.retry_delay, self.config.get("max_retry_delay", 60), self.config.get("retry_budget", 300))
+        # Conversations that ran out of retries are exported again at the end, up to retry_rounds times
+        self.retry_rounds = self.config.get("retry_rounds", 1)
+        # csv, csv.gz, csv.zst, jsonl, jsonl.gz, jsonl.zst, parquet or sqlite (see slack_writers.py)
+        self.output_format = self.config.get("output_format", "csv")
+        # With a checkpoint file, exports only fetch the messages newer than the previous run and resume interrupted ones
+        if self.output_format == "parquet" and self.config.get("checkpoint_file", None):
+            # A parquet file is unreadable until it is closed, a checkpoint could move past rows lost in a crash
+            raise ValueError("checkpoint_file cannot be used with the parquet output format, use csv, jsonl or sqlite")
+        self.checkpoints = CheckpointStore(self.config["checkpoint_file"], self.config.get("checkpoint_save_every", 50), self.config.get("checkpoint_save_interval", 30), self.config.get("thread_rescan_days", 14)*24*60*60) if self.config.get("checkpoint_file", None) else None
+        # Raw API pages kept on disk, to export again from them instead of Slack (page_cache_mode: record, replay or offline, see page_cache.py)
+        self.page_cache = None
+        if self.config.get("page_cache_folder", None) or self.config.get("page_cache_mode", None):
+            self.page_cache = PageCache(self.config.get("page_cache_folder", "slack_page_cache"), self.config.get("page_cache_mode", PageCache.RECORD),
+                                        self.config.get("page_cache_max_bytes", 1024*1024*1024), self.config.get("page_cache_ttl", None))
+        # timeframe from/to of the config file, applied by conversations.history itself (oldest/latest)
+        self.timeframe_oldest, self.timeframe_latest = self.get_timeframe()
+        # Number of time shards paged at the same time for a single conversation: a number for all of them or
+        # a dict keyed by conversation ID or name (e.g. {"announcements": 24, "default": 1})
+        self.history_shards = self.config.get("history_shards", 1)
+        self.history_shard_workers = self.config.get("history_shard_workers", 4)
+        # Pages fetched ahead by a shard that is not being written yet, then its worker waits
+        self.history_shard_buffer = self.config.get("history_shard_buffer", 10)
         self.logger_name = self.config.get("logger_name", "slack_log.log")
         self.logger = logging.getLogger(self.logger_name)
         self.calls_counter = 0
+        # Per method calls, latency, bytes, retries and rate limit waits, per file rows (see metrics.py)
+        self.metrics = ExporterMetrics()
+        # Dumping every page to the log is expensive, only a sample of them is logged when log_payloads is enabled
+        self.log_payloads = self.config.get("log_payloads", False)
+        self.log_payloads_sample = self.config.get("log_payloads_sample", 0.01)
         self.started_time = datetime.now()
         self.processed_counter = 0
-        self.users_list = None
         self.folder_created = False
-        self.get_users_list()          
+        self.reactions_fetcher = None
+        self.replies_fetcher = None
+        self.files_fetcher = None
+        self.export_files = {}
+        self.members_graph = None
+        # Where a failed conversation export stopped (cursors, or the progress of every shard of a sharded history),
+        # so its retry does not write the same rows again
+        self.export_progress = {}
+        self.failures = []
+
+    @property
+    def client(self):
+        if self._client is None:
+            if self.bot_token is None and not self.is_offline():
+                raise ValueError("You need to provide a Slack BOT token!")
+            # Pooled keep-alive connections shared by all the threads of the export (see http_transport.py)
+            self._client = get_web_client(self.bot_token, self.api_url, self.config)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    @property
+    def user_directory(self):
+        if self._user_directory is None:
+            self._user_directory = UserDirectory(self, self.config.get("users_cache_file", "slack_users_directory.json"), self.config.get("users_cache_ttl", 24*60*60))
+        return self._user_directory
+
+    @property
+    def conversation_catalog(self):
+        if self._conversation_catalog is None:
+            self._conversation_catalog = ConversationCatalog(self, self.config.get("conversations_cache_file", "slack_conversations.json"), self.config.get("conversations_cache_ttl", 60*60))
+        return self._conversation_catalog
+
+    @property
+    def users_list(self):
+        # user ID -> name, refreshed from Slack the first time it is needed if the directory cache expired
+        if self._users_list is None:
+            self.update_users_list()
+        return self._users_list
+
+    @users_list.setter
+    def users_list(self, users_list):
+        self._users_list = users_list
+
+    @property
+    def message_formatter(self):
+        if self._message_formatter is None:
+            # Mentions and channel links of the messages text are replaced by names unless resolve_mentions is false
+            self._message_formatter = MessageFormatter(self.conversation_catalog, self.config.get("resolve_mentions", True))
+        return self._message_formatter
 
     def make_folder(self):
         if self.folder_created:
             return
-        else:
-            if not os.path.exists(self.base_path):
-                os.makedirs(self.base_path)
-            self.base_path += "\\"
+        os.makedirs(self.base_path, exist_ok=True)
+        self.folder_created = True
         # Put users into the dict
     def users_to_dict(self, users_array):
         for user in users_array:
@@ -219,15 +208,16 @@ class SlackExporter():
             except IOError as e:
                 print(f"Error reading users file: {e}")
 
-    def update_users_list(self, filename=None):
+    def update_users_list(self, filename=None, force=False):
+        # Refreshes the user directory if its cache expired (or if forced) and exports it to csv when something changed
         csv_users_file = filename
         if csv_users_file is None:
             csv_users_file = "slack_users_list.csv"
-        print(f"Downloading user dictionary to {csv_users_file}")
-        self.users_list = {}
-        try:
-            result = self.client.users_list()
-            self.users_to_dict(result["members"])
+        changed = self.user_directory.refresh(force)
+        self.users_list = self.user_directory.names
+        if changed > 0:
+            self.conversation_catalog.reindex_names()
+        if changed > 0 or not os.path.exists(csv_users_file):
             try:
                 with open(csv_users_file, 'w', newline='') as csvfile:
                     csvwriter = csv.writer(csvfile, delimiter=',')
@@ -236,21 +226,24 @@ class SlackExporter():
                         csvwriter.writerow([key, value])
             except IOError as e:
                 print(f"Error writing users file: {e}")
-        except SlackApiError as e:
-            self.logger.error("Error creating conversation: {}".format(e))
         return self.users_list
         
-    def get_conversation_by_id(self, channel_id, conversations):
+    def get_conversation_by_id(self, channel_id, conversations=None):
+        # Without a list of conversations the lookup goes through the catalog index
+        if conversations is None:
+            self.conversation_catalog.refresh()
+            return self.conversation_catalog.get_by_id(channel_id)
         res = next(filter(lambda x: 'id' in x and channel_id == x['id'], conversations), None)
         return res
 
-    def get_conversation_by_name(self, channel_name, conversations):
+    def get_conversation_by_name(self, channel_name, conversations=None):
+        if conversations is None:
+            self.conversation_catalog.refresh()
+            return self.conversation_catalog.get_by_name(channel_name)
         res = next(filter(lambda x: 'name' in x and channel_name == x['name'], conversations), None)
         return res
 
     def get_users_list(self):
-        if self.users_list is None:
-            self.update_users_list()
         return self.users_list
         
     def dt_to_ts(self, datetime_str):
@@ -261,6 +254,31 @@ class SlackExporter():
     def ts_to_dt(self, ts):
         return datetime.fromtimestamp(float(ts)).strftime('%Y-%m-%d %H:%M:%S')
 
+    def to_timestamp(self, value, end_of_day=False):
+        # Timestamp of a date, datetime, 'YYYY-MM-DD[ HH:MM:SS]' string or number
+        # With end_of_day a plain date means the end of that day, so that timeframe.to is inclusive
+        if value is None or value == "":
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, str):
+            value = value.strip()
+            if len(value) > 10:
+                return self.dt_to_ts(value)
+            value = datetime.strptime(value, '%Y-%m-%d').date()
+        if isinstance(value, datetime):
+            return value.timestamp()
+        if isinstance(value, date):
+            day = datetime.combine(value, datetime.min.time())
+            if end_of_day:
+                day += timedelta(days=1)
+            return day.timestamp()
+        raise ValueError(f"Unsupported timestamp {value}")
+
+    def get_timeframe(self):
+        timeframe = self.config.get("timeframe", None) or {}
+        return self.to_timestamp(timeframe.get("from", None)), self.to_timestamp(timeframe.get("to", None), end_of_day=True)
+
     def formatted_now(self, sepDate="_", sepTime="_", sep="_"):
         return datetime.now().strftime('%Y{0}%m{0}%d{2}%H{1}%M{1}%S'.format(sepDate, sepTime, sep))
 
@@ -270,20 +288,27 @@ class SlackExporter():
             time.sleep(1)
         print(f"{message} {sleep_time} seconds...")
 
-    def check_rate_limit(self, started_time, rate_limit, wait_time):
-        elapsed = (datetime.now() - started_time)
-        elapsed_mins, elapsed_seconds= divmod(elapsed.seconds, 60)
-        elapsed_mins += elapsed_seconds/60
-        current_rate = 0 if elapsed_mins <= 0 else self.calls_counter/elapsed_mins
-        # Just avoiding this to trigger at the start. Obviously if we did not even sent rate_limit calls we can't be over the limit
-        if elapsed_mins > 0 and self.calls_counter > self.rate_limit:
-            while current_rate > self.rate_limit:
-                self.retry_wait(self.rate_limit_wait, f"Elapsed: {elapsed}, Calls: {self.calls_counter}, Rate: {current_rate:.2f}pm, Waiting")
-                elapsed = (datetime.now() - started_time)
-                elapsed_mins, elapsed_seconds= divmod(elapsed.seconds, 60)
-                elapsed_mins += elapsed_seconds/60
-                current_rate = 0 if elapsed_mins <= 0 else self.calls_counter/elapsed_mins
-        return current_rate, elapsed
+    @property
+    def rate_limit_wait_time(self):
+        return self.metrics.get_total("throttled_seconds")
+
+    def write_metrics(self):
+        # JSON snapshot and/or Prometheus textfile of the metrics, if configured
+        if self.config.get("metrics_file", None):
+            self.metrics.write_json(self.config["metrics_file"])
+        if self.config.get("metrics_prometheus_file", None):
+            self.metrics.write_prometheus(self.config["metrics_prometheus_file"])
+
+    def log_payload(self, method_name, client_args, data):
+        if self.log_payloads and random.random() < self.log_payloads_sample:
+            self.logger.info(f"{method_name} {client_args}: {data}")
+
+    def check_rate_limit(self, method_name):
+        # Takes a token from the method's bucket, sleeping until one is available
+        waited = self.rate_limiter.acquire(method_name)
+        self.metrics.record_throttle(method_name, waited)
+        elapsed = (datetime.now() - self.started_time)
+        return waited, elapsed
     
     def get_data_list(self, result, response_key=None, data_keys=None):
         response = result
@@ -296,93 +321,235 @@ class SlackExporter():
         for data in response:
             res = {}
             for key in data_keys:
-                res[key] = data[data_key]
+                res[key] = data.get(key, None)
             data_list.append(res)
         return data_list
 
+    def is_offline(self):
+        # Replaying the page cache only, nothing is sent to Slack
+        return self.page_cache is not None and self.page_cache.mode == PageCache.OFFLINE
+
+    def get_cached_page(self, method_name, client_args):
+        # The page of the call in the page cache, None if it has to be fetched from Slack
+        if self.page_cache is None:
+            return None
+        data = self.page_cache.get(method_name, client_args)
+        if data is not None:
+            self.metrics.record_cache_hit(method_name)
+            return data
+        if self.page_cache.mode == PageCache.OFFLINE:
+            raise PageCacheMissError(f"{method_name} {client_args} is not in the page cache {self.page_cache.folder}")
+        return None
+
+    def cache_page(self, method_name, client_args, result):
+        if self.page_cache is not None:
+            self.page_cache.put(method_name, client_args, getattr(result, "data", result))
+
+    def call_method(self, client_method, client_args):
+        # A single rate limited API call. 429s and transient errors are retried (see retry_policy.py),
+        # permanent errors and calls out of retries raise a SlackApiError
+        method_name = client_method.__name__
+        # A replayed page costs no call and no rate limit token
+        data = self.get_cached_page(method_name, client_args)
+        if data is not None:
+            return data, 0, datetime.now() - self.started_time
+        attempt = 0
+        while True:
+            waited, elapsed = self.check_rate_limit(method_name)
+            call_started = time.monotonic()
+            try:
+                result = client_method(**client_args)
+                # result = self.client.conversations_list(types="public_channel,private_channel,mpim,im", limit=200, cursor=cursor)
+                self.calls_counter += 1
+                self.metrics.record_call(method_name, time.monotonic() - call_started, ExporterMetrics.get_response_size(result))
+                self.cache_page(method_name, client_args, result)
+                return result, waited, elapsed
+            except Exception as e:
+                self.metrics.record_call(method_name, time.monotonic() - call_started, ExporterMetrics.get_response_size(getattr(e, "response", None)), error=True)
+                delay = self.get_retry_delay(method_name, client_args, e, attempt)
+                attempt += 1
+                if delay > 0:
+                    time.sleep(delay)
+
+    def get_retry_delay(self, method_name, client_args, error, attempt):
+        # Seconds to wait before retrying a failed call, raises if it must not be retried
+        classification = self.retry_policy.classify(error)
+        if classification == RetryPolicy.RATE_LIMITED:
+            # HTTP 429: Slack tells us exactly how long to back off for this method, the rate limiter makes the next call wait
+            retry_after = RateLimiter.get_retry_after(error, self.retry_delay)
+            print(f"Rate limited on {method_name}, Slack asked to wait {retry_after} seconds")
+            self.metrics.record_retry(method_name, "rate_limited")
+            self.rate_limiter.retry_after(method_name, retry_after)
+            return 0
+        if classification == RetryPolicy.PERMANENT:
+            print(f"Error getting request {method_name}: {error}.\t Not retrying")
+            raise error
+        delay = self.retry_policy.next_delay(attempt, client_args)
+        if delay is None:
+            raise RetriesExhaustedError(f"{method_name} failed after {attempt+1} attempts: {error}", error)
+        self.metrics.record_retry(method_name, "error")
+        print(f"Exception getting request {method_name}: {error}.\t Retrying in {delay:.1f}s")
+        return delay
+
+    def iter_data(self, client_method, client_args, response_key = None, data_keys = None, limit=200, processed=-1, total=-1, cursor=None, return_cursor=False):
+        # Yields one page of data at a time, so callers never need to hold more than a page in memory
+        # With return_cursor=True it yields (page, next_cursor) tuples instead, to checkpoint the progress
+        total_data = 0
+        while True:
+            # Call the conversations.list method using the WebClient
+            result, waited, elapsed = self.call_method(client_method, dict(client_args, limit=limit, cursor=cursor))
+            new_data = self.get_data_list(result, response_key, data_keys)  
+            self.log_payload(client_method.__name__, client_args, new_data)
+            total_data += len(new_data)
+            if "response_metadata" in result:
+                cursor = result["response_metadata"].get("next_cursor", None)
+            else:
+                cursor = None
+            if processed > 0 and total > 0:
+                print(f"{processed:>4}/{total:<4}", end="")
+            else:                    
+                print(f"{'-':>4}/{'-':<4}", end="")
+            print(f"{client_method.__name__:15}\t Total data: {total_data:<4} \t Cursor: {str(cursor):<10}\tWaited: {waited:>2.2f}s \tElapsed: {elapsed} \tArgs: {client_args}")
+            yield (new_data, cursor) if return_cursor else new_data
+            if cursor is None or cursor == "":
+                break
+
     def get_data(self, client_method, client_args, response_key = None, data_keys = None, limit=200, processed=-1, total=-1):
         data_list = []
-        result = {}
-        method_name = client_method.__name__
         try:
-            cursor = None
-            while True:
-                # Call the conversations.list method using the WebClient
-                rate, elapsed = self.check_rate_limit(self.started_time, self.rate_limit, self.rate_limit_wait)
-                try:
-                    result = client_method(**client_args, limit=limit, cursor=cursor )
-                    # result = self.client.conversations_list(types="public_channel,private_channel,mpim,im", limit=200, cursor=cursor)
-                    self.calls_counter += 1
-                except Exception as e:
-                    print(f"Exception getting request {method_name}: {e}.\t Retrying in {self.retry_delay}")
-                    if 'error' in result and result['error'] == 'account_inactive':
-                        raise SlackApiError()
-                        return
-                    else:
-                        self.retry_wait(self.retry_delay, f"Trying again in")
-                        continue
-                new_data = self.get_data_list(result, response_key, data_keys)  
-                self.logger.info(new_data)
-                # print(new_data[0])
-                # print(new_data[0]["id"], new_data[-1]["id"])
+            for new_data in self.iter_data(client_method, client_args, response_key, data_keys, limit, processed, total):
                 data_list += new_data
-                if "response_metadata" in result:
-                    cursor = result["response_metadata"].get("next_cursor", None)
-                else:
-                    cursor = None
-                    # print(f"Exception getting conversations: {e}\t {len(convos)}")
-                if processed > 0 and total > 0:
-                    print(f"{processed:>4}/{total:<4}", end="")
-                else:                    
-                    print(f"{'-':>4}/{'-':<4}", end="")
-                print(f"{client_method.__name__:15}\t Total data: {len(data_list):<4} \t Cursor: {str(cursor):<10}\tRate: {rate:>2.2f}\{self.rate_limit:<3} \tElapsed: {elapsed} \tArgs: {client_args}")
-                if cursor is None or cursor == "":
-                    break
             return data_list        
         except SlackApiError as e:
-            print(f"Error in retreiving data from Slack API ({method_name}): {e}")
+            print(f"Error in retreiving data from Slack API ({client_method.__name__}): {e}")
 
-    def get_conversations(self, data_keys=None):
-        client_args={"types":"public_channel,private_channel,mpim,im"}
-        return self.get_data(self.client.conversations_list, client_args, response_key="channels", data_keys=None)
+    def get_conversations(self, data_keys=None, types=None, is_member=None, is_archived=None, force_refresh=False):
+        # Served by the conversation catalog, conversations.list is only paged through when its cache expired
+        self.conversation_catalog.refresh(force_refresh)
+        conversations = self.conversation_catalog.filter(types, is_member, is_archived)
+        if data_keys is not None:
+            conversations = [{key: conversation.get(key, None) for key in data_keys} for conversation in conversations]
+        return conversations
 
     """
     channel_id: ID of the channel you want to send the message to
     """
-    def get_conversation_history(self, conversation, data_keys=None, processed=-1, total=-1, **kwargs):
-        channel_id = conversation["id"]
-        # print(f"ID2: {channel_id}")
-        client_args={"channel":channel_id}
+    def get_history_args(self, conversation, oldest=None, latest=None):
+        # oldest/latest are narrowed down to the configured timeframe
+        client_args={"channel":conversation["id"]}
+        if self.timeframe_oldest is not None and (oldest is None or float(oldest) < self.timeframe_oldest):
+            oldest = self.timeframe_oldest
+        if self.timeframe_latest is not None and (latest is None or float(latest) > self.timeframe_latest):
+            latest = self.timeframe_latest
+        if oldest is not None:
+            client_args["oldest"] = oldest
+        if latest is not None:
+            client_args["latest"] = latest
+        return client_args
+
+    def get_history_shards(self, conversation):
+        if isinstance(self.history_shards, dict):
+            shards = self.history_shards.get(conversation["id"], self.history_shards.get(self.conversation_catalog.get_name(conversation), self.history_shards.get("default", 1)))
+            return max(1, int(shards))
+        return max(1, int(self.history_shards))
+
+    def get_time_shards(self, conversation, client_args, shards):
+        # Splits the oldest/latest range of client_args in equal time shards, newest first.
+        # Both bounds of conversations.history are exclusive, so each shard's latest is a microsecond past
+        # the next shard's oldest: a message right on a boundary belongs to exactly one shard.
+        oldest = float(client_args.get("oldest", 0) or 0)
+        # Nothing can be older than the conversation itself
+        oldest = max(oldest, float(conversation.get("created", 0) or 0) - 1)
+        latest = float(client_args.get("latest", 0) or 0) or time.time()
+        if shards <= 1 or latest - oldest <= shards:
+            return [(client_args.get("oldest", None), client_args.get("latest", None))]
+        step = (latest - oldest) / shards
+        bounds = [oldest + step * i for i in range(0, shards)] + [latest]
+        time_shards = []
+        for i in range(shards - 1, -1, -1):
+            shard_latest = f"{bounds[i+1]:.6f}" if i == shards - 1 else f"{bounds[i+1] + 0.000001:.6f}"
+            time_shards.append((f"{bounds[i]:.6f}", shard_latest))
+        return time_shards
+
+    def iter_conversation_history(self, conversation, data_keys=None, processed=-1, total=-1, oldest=None, cursor=None, return_cursor=False, **kwargs):
+        client_args = self.get_history_args(conversation, oldest)
+        shards = self.get_history_shards(conversation)
+        if isinstance(cursor, list) or (shards > 1 and cursor is None):
+            # The cursor of a sharded fetch is the progress of its shards (see history_shards.py), a resumed
+            # sharded fetch keeps its shards. A resumed unsharded one has a single cursor chain to finish
+            progress = cursor if isinstance(cursor, list) else ShardedHistoryFetcher.new_progress(self.get_time_shards(conversation, client_args, shards))
+            return iter(ShardedHistoryFetcher(self, self.client.conversations_history, client_args, progress, self.history_shard_workers, data_keys, processed, total, self.history_shard_buffer, return_cursor))
         # Call the conversations.history method using the WebClient
         # conversations.history returns the first 100 messages by default
         # These results are paginated, see: https://api.slack.com/methods/conversations.history$pagination
-        messages = self.get_data(self.client.conversations_history, client_args, response_key="messages", data_keys=data_keys, processed=processed, total=total)
+        return self.iter_data(self.client.conversations_history, client_args, response_key="messages", data_keys=data_keys, processed=processed, total=total, cursor=cursor, return_cursor=return_cursor)
+
+    def get_conversation_history(self, conversation, data_keys=None, processed=-1, total=-1, **kwargs):
+        channel_id = conversation["id"]
+        # print(f"ID2: {channel_id}")
+        messages = []
+        for page in self.iter_conversation_history(conversation, data_keys=data_keys, processed=processed, total=total):
+            messages += page
         self.logger.info(f"{len(messages)} messages found in {channel_id}")
         return messages
 
     
+    def iter_conversation_members(self, conversation, data_keys=None, processed=-1, total=-1, cursor=None, return_cursor=False, **kwargs):
+        client_args={"channel":conversation["id"]}
+        return self.iter_data(self.client.conversations_members, client_args, response_key="members", data_keys=data_keys, processed=processed, total=total, cursor=cursor, return_cursor=return_cursor)
+
     def get_conversation_members(self, conversation, data_keys=None, get_user_info=True, processed=-1, total=-1, **kwargs):
         channel_id = conversation["id"]
-        client_args={"channel":channel_id}
-        members = self.get_data(self.client.conversations_members, client_args, response_key="members", data_keys=data_keys, processed=processed, total=total)
+        members = []
+        for page in self.iter_conversation_members(conversation, data_keys=data_keys, processed=processed, total=total):
+            members += page
         self.logger.info(f"{len(members)} members in {channel_id}")
         if get_user_info:
             members = self.get_users_info(members)
 
         return members
     
-    def get_message_reactions(self, channel_id, msg_timestamp, data_keys=None, processed=-1, total=-1, **kwargs):
-        channel_id = conversation["id"]
-        client_args={"channel":channel_id, "timestamp":msg_timestamp}
-        reactions = self.get_data(self.client.reactions_get, client_args, response_key="message", data_keys=data_keys, processed=processed, total=total)
-        self.logger.info(f"{len(reactions)} members in {channel_id}")
+    def is_thread_parent(self, message):
+        return message.get("reply_count", 0) > 0 and message.get("thread_ts", message["ts"]) == message["ts"]
+
+    def iter_thread_replies(self, channel_id, thread_ts, data_keys=None, oldest=None, **kwargs):
+        # conversations.replies returns the parent message too, only the replies are yielded
+        client_args={"channel":channel_id, "ts":thread_ts}
+        if oldest is not None:
+            client_args["oldest"] = oldest
+        for page in self.iter_data(self.client.conversations_replies, client_args, response_key="messages", data_keys=data_keys):
+            yield [message for message in page if message.get("ts", None) != thread_ts]
+
+    def get_message_reactions(self, channel_id, msg_timestamp, **kwargs):
+        # reactions.get is not paginated, full=True returns the complete list of users for every reaction
+        client_args={"channel":channel_id, "timestamp":msg_timestamp, "full":True}
+        try:
+            result, waited, elapsed = self.call_method(self.client.reactions_get, client_args)
+        except SlackApiError as e:
+            print(f"Error in retreiving reactions of {msg_timestamp} in {channel_id}: {e}")
+            return None
+        reactions = result.get("message", {}).get("reactions", [])
+        self.logger.info(f"{len(reactions)} reactions to {msg_timestamp} in {channel_id}")
         return reactions
+
+    def needs_reactions_lookup(self, message):
+        # conversations.history already returns the reactions of each message, but the list of users
+        # of a reaction is truncated when too many people used it (count > len(users))
+        for reaction in message.get("reactions", []):
+            if "users" not in reaction or reaction.get("count", 0) > len(reaction["users"]):
+                return True
+        return False
     
     def get_users_info(self, users_id_list, data_keys=None):
+        # Answered by the user directory, users.info is only called for users it does not know
         users_data = []
-        for idx, user_id in enumerate(users_id_list):
-            client_args = {"user":user_id}
-            users_data.append(self.get_data(self.client.users_info, client_args, response_key="user", data_keys=data_keys, processed=idx+1, total=len(users_id_list)))
+        for user_id in users_id_list:
+            user = self.user_directory.get(user_id)
+            if user is not None and data_keys is not None:
+                user = {key: user.get(key, None) for key in data_keys}
+            users_data.append(user)
+        # The users fetched for this batch are saved once
+        self.user_directory.save_changes()
         return users_data
 
     def print_conversations_list(self, convos):
@@ -413,98 +580,269 @@ class SlackExporter():
         return convo_type
 
     def get_conversation_name(self, conversation, users_list=None):
-        convo_name = ""
-        try:
-            convo_name = conversation["name"]
-        except KeyError as e:
-            convo_name = conversation["user"]
-            if users_list:
-                convo_name = users_list[conversation["user"]]
-        return convo_name
-
-
-    def export_conversation_data(self, conversations, export_messages=True, export_messages_reactions=False, export_members=False, members_as_graph=False):
+        if "name" in conversation:
+            return conversation["name"]
+        # DMs are named after the other user, who may be missing from the users list (external or deleted users of
+        # Slack Connect channels): their ID is used instead, like ConversationCatalog.get_name does
+        user_id = conversation.get("user", None)
+        if user_id is None:
+            return conversation["id"]
+        return (users_list or {}).get(user_id, user_id)
+
+
+    def init_export_writers(self, conversations, export_messages=True, export_messages_reactions=False, export_members=False, members_as_graph=False, export_files=False):
+        # Returns the list of conversations to export and the writers to use, keyed by ExportType
         self.make_folder()
-        members_filename = f"{self.base_path}members_all_{self.config['last_export_time']}.csv"
-        messages_filename = f"{self.base_path}messages_all_{self.config['last_export_time']}.csv"
-        reactions_filename = f"{self.base_path}reactions_all_{self.config['last_export_time']}.csv"
+        members_filename = os.path.join(self.base_path, f"members_all_{self.config['last_export_time']}")
+        messages_filename = os.path.join(self.base_path, f"messages_all_{self.config['last_export_time']}")
+        reactions_filename = os.path.join(self.base_path, f"reactions_all_{self.config['last_export_time']}")
+        files_filename = os.path.join(self.base_path, f"files_all_{self.config['last_export_time']}")
+        self.members_graph_filename = os.path.join(self.base_path, f"members_graph_{self.config['last_export_time']}")
         if not isinstance(conversations, list):
             convo_name = self.get_conversation_name(conversations, users_list=self.users_list)
             conversations = [conversations]
-            members_filename = f"{self.base_path}{convo_name}_members_{self.config['last_export_time']}.csv"
-            messages_filename = f"{self.base_path}{convo_name}_messages_{self.config['last_export_time']}.csv"
-            reactions_filename = f"{self.base_path}{convo_name}_reactions_{self.config['last_export_time']}.csv"
-    
+            members_filename = os.path.join(self.base_path, f"{convo_name}_members_{self.config['last_export_time']}")
+            messages_filename = os.path.join(self.base_path, f"{convo_name}_messages_{self.config['last_export_time']}")
+            reactions_filename = os.path.join(self.base_path, f"{convo_name}_reactions_{self.config['last_export_time']}")
+            files_filename = os.path.join(self.base_path, f"{convo_name}_files_{self.config['last_export_time']}")
+            self.members_graph_filename = os.path.join(self.base_path, f"{convo_name}_members_graph_{self.config['last_export_time']}")
+
+        # Flush policy of the writer threads: every flush_rows rows, flush_bytes bytes or flush_interval seconds
+        # Compression level and rotation of the parts (max_part_rows, max_part_bytes, partition_by: channel and/or day)
+        writer_options = {key: self.config[key] for key in ["flush_rows", "flush_bytes", "flush_interval", "fsync", "compression_level", "max_part_rows", "max_part_bytes", "partition_by", "max_open_parts"] if key in self.config}
+        if self.output_format == "sqlite":
+            # Every export type and every export goes to the same database, exporting again updates it
+            writer_options["database"] = self.config.get("sqlite_file", None) or os.path.join(self.config.get("data_folder", "slack_export"), "slack_export.db")
+        writers = {}
         if export_members:
             headers = ["convo_id", "convo_name", "convo_type", "user_id","user_name"]
             if members_as_graph:
-                headers += ["user_id2","user_name2"]
-            members_csv = SlackCSVWriter(members_filename, headers)
+                # Built from the members rows, written when the writers are closed
+                self.members_graph = MembersGraph()
+            writers[SlackExporter.ExportType.Members] = open_writer(members_filename, headers, self.output_format, **writer_options)
         if export_messages:
-            headers = ["convo_id", "convo_name", "convo_type", "msg_subtype", "msg_text", "msg_user_id", "msg_user_name", "msg_timestamp", "msg_datetime"]
-            messages_csv = SlackCSVWriter(messages_filename, headers)
+            headers = ["convo_id", "convo_name", "convo_type", "msg_subtype", "msg_text", "msg_user_id", "msg_user_name", "msg_timestamp", "msg_datetime", "msg_thread_ts"]
+            writers[SlackExporter.ExportType.Messages] = open_writer(messages_filename, headers, self.output_format, **writer_options)
             if export_messages_reactions:
                 headers = ["convo_id", "convo_name", "convo_type", "msg_timestamp", "msg_datetime", "reaction_name", "reaction_user", "reaction_username"]
-                reactions_csv = SlackCSVWriter(reactions_filename, headers)
-
-        for idx_c, conversation in enumerate(conversations):
-            total=len(conversations)        
-            processed=idx_c+1            
-            conversation_id = conversation["id"]
-            convo_info_prefix = [conversation_id, convo_name, self.get_conversation_type_string(conversation)]
-            if export_members:
-                members = self.get_conversation_members(conversation, processed=processed, total=total)
-                members_csv.write_data(members, SlackCSVWriter.format_member, users_list=self.users_list, as_graph=members_as_graph, prefix=convo_info_prefix)
-            if export_messages:
-                messages = self.get_conversation_history(conversation, limit=200, processed=processed, total=total)
-                for idx_m, message in enumerate(messages):
-                    total=len(messages)
-                    processed=idx_m+1
-                    messages_csv.write_data(message, SlackCSVWriter.format_message, users_list=self.users_list, prefix=convo_info_prefix)
-                    if export_messages_reactions:
-                        msg_reactions = self.get_message_reactions(conversation_id, message["ts"], processed=processed, total=total)
-                        if "reactions" in message:
-                            msg_reactions = message["reactions"]
-                            if msg_reactions is not None:
-                                msg_prefix = []
-                                msg_prefix.append(message["ts"])
-                                msg_prefix.append(self.ts_to_dt(message["ts"]))
-                                reactions_csv.write_data(msg_reactions, SlackCSVWriter.format_reaction, prefix=convo_info_prefix+msg_prefix)
-            if export_members:
-                print(f"------- MEMBERS EXPORT {os.path.basename(members_filename)} COMPLETED AT {self.formatted_now()} -------")
-                members_csv.close()
-            if export_messages:
-                print(f"------- MESSAGES EXPORT {os.path.basename(messages_filename)} COMPLETED AT {self.formatted_now()} -------")
-                messages_csv.close()
-            if export_messages_reactions:
-                print(f"------- REACTIONS EXPORT {os.path.basename(reactions_filename)} COMPLETED AT {self.formatted_now()} -------")
-                reactions_csv.close()
+                writers[SlackExporter.ExportType.Reactions] = open_writer(reactions_filename, headers, self.output_format, **writer_options)
+            if export_files:
+                # Manifest of the message attachments, their content is in the file store
+                headers = ["convo_id", "convo_name", "convo_type", "msg_timestamp", "msg_datetime", "file_id", "file_name", "file_mimetype", "file_size", "file_sha256", "file_path", "file_status"]
+                writers[SlackExporter.ExportType.Files] = open_writer(files_filename, headers, self.output_format, **writer_options)
+        for writer in writers.values():
+            self.metrics.register_writer(writer)
+        # Rotated writers are described by the manifest of their parts
+        self.export_files = {export_type: writer.manifest_filename or writer.filename for export_type, writer in writers.items()}
+        return conversations, writers
+
+    def flush_export_writers(self, writers):
+        for writer in writers.values():
+            writer.flush()
+
+    def wait_background_work(self):
+        # Replies first, they queue the reactions and files of the replies
+        for fetcher in [self.replies_fetcher, self.reactions_fetcher, self.files_fetcher]:
+            if fetcher is not None:
+                fetcher.wait()
+
+    def save_checkpoints(self, writers):
+        # The rows must be on disk before the checkpoints move past them, including the replies, reactions and files
+        # of the pages that the background fetchers are still working on
+        checkpoints = self.checkpoints.snapshot()
+        self.wait_background_work()
+        self.flush_export_writers(writers)
+        self.checkpoints.save(checkpoints)
+
+    def close_export_writers(self, writers):
+        for export_type, writer in writers.items():
+            print(f"------- {export_type.upper()} EXPORT {os.path.basename(writer.filename)} COMPLETED AT {self.formatted_now()} -------")
+            writer.close()
+        if self.checkpoints is not None:
+            self.checkpoints.save()
+        if self._user_directory is not None:
+            self._user_directory.save_changes()
+        if self.members_graph is not None:
+            self.write_members_graph()
+        self.write_metrics()
+        if self.page_cache is not None:
+            self.page_cache.close()
+
+    def write_members_graph(self):
+        # members_graph_format: csv (weighted edge list) or npz (scipy sparse matrix)
+        graph_format = self.config.get("members_graph_format", "csv")
+        filename = f"{self.members_graph_filename}.{graph_format}"
+        if graph_format == "npz":
+            self.members_graph.write_matrix(filename, self.users_list)
+            print(f"------- MEMBERS GRAPH {os.path.basename(filename)} ({len(self.members_graph.users)} users) COMPLETED AT {self.formatted_now()} -------")
+        else:
+            edges = self.members_graph.write_edge_list(filename, self.users_list, self.config.get("members_graph_min_weight", 1))
+            print(f"------- MEMBERS GRAPH {os.path.basename(filename)} ({edges} edges) COMPLETED AT {self.formatted_now()} -------")
+        self.members_graph = None
+
+    def get_conversation_prefix(self, conversation):
+        return [conversation["id"], self.get_conversation_name(conversation, users_list=self.users_list), self.get_conversation_type_string(conversation)]
+
+    def write_members(self, writers, members, convo_info_prefix, members_as_graph=False):
+        writers[SlackExporter.ExportType.Members].write_data(members, SlackWriter.format_member, users_list=self.users_list, prefix=convo_info_prefix)
+        if members_as_graph and self.members_graph is not None:
+            self.members_graph.add_members(convo_info_prefix[0], members)
+
+    def write_message_reactions(self, writers, message, msg_reactions, convo_info_prefix):
+        if msg_reactions is not None:
+            msg_prefix = []
+            msg_prefix.append(message["ts"])
+            msg_prefix.append(self.ts_to_dt(message["ts"]))
+            writers[SlackExporter.ExportType.Reactions].write_data(msg_reactions, SlackWriter.format_reaction, users_list=self.users_list, prefix=convo_info_prefix+msg_prefix)
+
+    def write_file(self, writers, message, file, entry, status, convo_info_prefix):
+        msg_prefix = [message["ts"], self.ts_to_dt(message["ts"])]
+        path = self.files_fetcher.store.get_object_path(entry["sha256"]) if entry is not None else None
+        writers[SlackExporter.ExportType.Files].write_data([file], SlackWriter.format_file, entry=entry, path=path, status=status, prefix=convo_info_prefix+msg_prefix)
+
+    def get_files_store(self):
+        # Shared by all the exports, so files already downloaded by a previous export are not downloaded again
+        return FileStore(self.config.get("files_folder", None) or os.path.join(self.config.get("data_folder", "slack_export"), "files"))
+
+    def write_messages(self, writers, conversation_id, messages, convo_info_prefix):
+        # Writes one page of messages (and their reactions) as soon as it arrives
+        writers[SlackExporter.ExportType.Messages].write_data_batch(messages, self.message_formatter.format_messages, users_list=self.users_list, prefix=convo_info_prefix)
+        if self.files_fetcher is not None:
+            for message in messages:
+                for file in message.get("files", []):
+                    self.files_fetcher.put(writers, conversation_id, message, file, convo_info_prefix)
+        if self.replies_fetcher is not None:
+            for message in messages:
+                if self.is_thread_parent(message):
+                    self.replies_fetcher.put(writers, conversation_id, message, convo_info_prefix)
+        if SlackExporter.ExportType.Reactions in writers:
+            for message in messages:
+                if self.needs_reactions_lookup(message):
+                    # Only the truncated ones cost a reactions.get call, and it happens in the background
+                    self.reactions_fetcher.put(writers, conversation_id, message, convo_info_prefix)
+                elif "reactions" in message:
+                    self.write_message_reactions(writers, message, message["reactions"], convo_info_prefix)
+
+    def export_conversation(self, writers, conversation, export_messages=True, export_members=False, members_as_graph=False, processed=-1, total=-1):
+        # Picks up where a previous failed attempt stopped (see export_progress)
+        conversation_id = conversation["id"]
+        convo_info_prefix = self.get_conversation_prefix(conversation)
+        progress = self.export_progress.setdefault(conversation_id, {})
+        if export_members and not progress.get("members_done", False):
+            for members, next_cursor in self.iter_conversation_members(conversation, processed=processed, total=total, cursor=progress.get("members_cursor", None), return_cursor=True):
+                self.write_members(writers, members, convo_info_prefix, members_as_graph)
+                progress["members_cursor"] = next_cursor
+            progress["members_done"] = True
+        if export_messages and self.checkpoints is not None:
+            # Incremental export: only messages newer than the last run, or resume an interrupted one
+            oldest, cursor = self.checkpoints.start(conversation_id)
+            if self.replies_fetcher is not None and oldest is not None:
+                # oldest= only returns the threads started since the last run, the new replies to older threads are asked separately
+                for thread_ts, latest_reply in self.checkpoints.get_active_threads(conversation_id):
+                    self.replies_fetcher.put(writers, conversation_id, {"ts": thread_ts}, convo_info_prefix, latest_reply)
+            for messages, next_cursor in self.iter_conversation_history(conversation, processed=processed, total=total, oldest=oldest, cursor=cursor, return_cursor=True):
+                self.write_messages(writers, conversation_id, messages, convo_info_prefix)
+                if self.checkpoints.page_done(conversation_id, messages, next_cursor, oldest):
+                    self.save_checkpoints(writers)
+            self.checkpoints.conversation_done(conversation_id)
+            self.save_checkpoints(writers)
+        elif export_messages:
+            for messages, next_cursor in self.iter_conversation_history(conversation, processed=processed, total=total, cursor=progress.get("cursor", None), return_cursor=True):
+                self.write_messages(writers, conversation_id, messages, convo_info_prefix)
+                progress["cursor"] = next_cursor
+        self.export_progress.pop(conversation_id, None)
+
+    def handle_export_error(self, conversation, error, deferred):
+        # Conversations out of retries are deferred, the ones with permanent errors go straight to the failure report
+        print(f"Error in exporting conversation {conversation['id']}: {error}")
+        if isinstance(error, RetriesExhaustedError):
+            deferred.append((conversation, error))
+        else:
+            self.record_failure(conversation, error, RetryPolicy.PERMANENT)
 
-        
-    def export_all_conversations_history(self,conversations, export_reactions=True, multi_threaded=True, **kwargs):
+    def record_failure(self, conversation, error, classification, convo_name=None, message=None):
+        slack_error = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                slack_error = response.get("error", None)
+            except (AttributeError, TypeError):
+                pass
+        if convo_name is None:
+            convo_name = self.get_conversation_name(conversation, users_list=self.users_list)
+        self.failures.append({"convo_id": conversation["id"], "convo_name": convo_name, "classification": classification,
+                              "slack_error": slack_error, "message": message or str(error), "time": self.formatted_now()})
+
+    def record_thread_failure(self, conversation_id, convo_info_prefix, thread_ts, latest_reply, error):
+        # Called by the replies fetchers: the thread goes to the failure report, and with checkpoints it is kept so
+        # the next runs fetch its replies again (from latest_reply, the last one written) instead of skipping them
+        print(f"Error in retreiving the replies to {thread_ts} in {conversation_id}: {error}")
+        classification = RetryPolicy.RETRYABLE if isinstance(error, RetriesExhaustedError) else RetryPolicy.PERMANENT
+        self.record_failure({"id": conversation_id}, error, classification, convo_info_prefix[1], f"Replies to {thread_ts}: {error}")
+        if self.checkpoints is not None:
+            self.checkpoints.thread_failed(conversation_id, thread_ts, latest_reply or thread_ts)
+
+    def write_failure_report(self):
+        if len(self.failures) == 0:
+            return None
+        filename = self.config.get("failure_report_file", None) or os.path.join(self.base_path, f"failures_{self.config['last_export_time']}.csv")
+        with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
+            csvwriter = csv.DictWriter(csvfile, fieldnames=["convo_id", "convo_name", "classification", "slack_error", "message", "time"], quoting=csv.QUOTE_ALL)
+            csvwriter.writeheader()
+            csvwriter.writerows(self.failures)
+        print(f"------- {len(self.failures)} CONVERSATIONS OR THREADS FAILED, SEE {filename} -------")
+        return filename
+
+    def export_conversation_data(self, conversations, export_messages=True, export_messages_reactions=False, export_members=False, members_as_graph=False, export_threads=False, export_files=False):
+        conversations, writers = self.init_export_writers(conversations, export_messages, export_messages_reactions, export_members, members_as_graph, export_files and export_messages)
+        if SlackExporter.ExportType.Files in writers:
+            self.files_fetcher = FilesFetcher(self, self.get_files_store(), self.config.get("files_workers", 4), self.config.get("files_batch_size", 50), self.config.get("files_chunk_size", 1024*1024),
+                                             max_queue_size=self.config.get("fetcher_queue_size", 1000))
+        if export_messages and export_threads:
+            self.replies_fetcher = RepliesFetcher(self, self.config.get("replies_workers", 4), self.config.get("replies_batch_size", 50), self.config.get("fetcher_queue_size", 1000))
+        if SlackExporter.ExportType.Reactions in writers:
+            self.reactions_fetcher = ReactionsFetcher(self, self.config.get("reactions_workers", 2), self.config.get("reactions_batch_size", 50), self.config.get("fetcher_queue_size", 1000))
+        self.failures = []
+        deferred = []
+        try:
+            for idx_c, conversation in enumerate(conversations):
+                try:
+                    self.export_conversation(writers, conversation, export_messages, export_members, members_as_graph, processed=idx_c+1, total=len(conversations))
+                except SlackApiError as e:
+                    self.handle_export_error(conversation, e, deferred)
+            # The conversations that kept failing get another go once everything else is exported
+            for retry_round in range(0, self.retry_rounds):
+                if len(deferred) == 0:
+                    break
+                print(f"Retrying {len(deferred)} deferred conversations (round {retry_round+1}/{self.retry_rounds})")
+                pending, deferred = deferred, []
+                for idx_c, (conversation, error) in enumerate(pending):
+                    self.retry_policy.reset_budget(conversation["id"])
+                    try:
+                        self.export_conversation(writers, conversation, export_messages, export_members, members_as_graph, processed=idx_c+1, total=len(pending))
+                    except SlackApiError as e:
+                        self.handle_export_error(conversation, e, deferred)
+            for conversation, error in deferred:
+                self.record_failure(conversation, error, RetryPolicy.RETRYABLE)
+        finally:
+            # Also reached when the export fails, so the fetcher threads stop and the files are complete
+            # Replies come first, their reactions may still end up in the reactions queue
+            if self.replies_fetcher is not None:
+                self.replies_fetcher.close()
+                self.replies_fetcher = None
+            if self.reactions_fetcher is not None:
+                self.reactions_fetcher.close()
+                self.reactions_fetcher = None
+            if self.files_fetcher is not None:
+                self.files_fetcher.close()
+                self.files_fetcher = None
+            self.close_export_writers(writers)
+        self.write_failure_report()
+
+    def export_all_conversations_history(self, conversations, export_reactions=True, **kwargs):
+        # For concurrent exports use AsyncSlackExporter (async_exporter.py) instead
         print("Exporting {} conversations".format(len(conversations)))
-        f, csvwriter = init_csv_writer()
-        if export_reactions:
-            f_reactions, reactions_csvwriter = init_reactions_csv_writer()
-
-        if multi_threaded:
-            with concurrent.futures.ThreadPoolExecutor() as executor: # optimally defined number of threads
-                res = []
-                for i in range(0, len(conversations)):
-                    res.append(executor.submit(self.export_conversation_history, conversations[i], csv_writer=csvwriter, export_reactions=True, reactions_csv_writer=reactions_csvwriter, messages=None, **kwargs))
-                    if i > 0 and i % rate_limit == 0:
-                        concurrent.futures.wait(res)
-                        print(f"Waiting for the rate-limit of {i} every {sleep_time} seconds...")
-                        for t in range(0, sleep_time):
-                            print(f"Trying again in {sleep_time-t} seconds", end="\r", flush=True)
-                            time.sleep(1)
-        else:
-            for conversation in conversations:
-                self.export_conversation_history(conversation, csv_writer=csvwriter, export_reactions=True, reactions_csv_writer=reactions_csvwriter, messages=None, **kwargs)
-        print(f"------- EXPORT {os.path.basename(f.name)} COMPLETED AT {self.formatted_now()} -------")
-        print(f"------- REACTIONS EXPORT {os.path.basename(f_reactions.name)} COMPLETED AT {self.formatted_now()} -------")
-        f.close()
-        f_reactions.close()
+        self.export_conversation_data(conversations, export_messages=True, export_messages_reactions=export_reactions, **kwargs)
 
     def export_all(self):
         print(f"Exporting All data:")
@@ -539,25 +877,99 @@ class SlackExporter():
     # global total_processed
     # total_processed = 0
 
-def main():
-    # init()
-    convos = get_conversations(types="public_channel,private_channel,im,mpim")
-    print_conversations_list(convos)
-    # test = get_conversation_by_name("test", convos)
-    # test_messages = get_conversation_history(test,
-    #     inclusive=True,
-    #     oldest=self.dt_to_ts("2018-01-01 01:00:00"),
-    #     limit=100000000)
-    # print(len(test_messages))
-    # print(test_messages[0].keys())
-    # export_conversation_history(test, messages=test_messages)
-    # export_all_conversations_history(convos, multi_threaded=False,
-    #     oldest=self.dt_to_ts("2018-01-01 01:00:00"),
-    #     limit=100000000)
-
-    export_all_conversations_members(convos, True)
+def conversation_types(value):
+    # --types of the command lines
+    try:
+        return ConversationCatalog.parse_types(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def add_selection_arguments(parser):
+    parser.add_argument("--conversation", action="append", help="ID or name of a conversation to export (can be repeated), all of them by default")
+    parser.add_argument("--types", type=conversation_types, default=None, help="comma separated conversation types, e.g. public_channel,private_channel,im,mpim")
+    parser.add_argument("--member-only", action="store_true", help="only the conversations the bot is a member of")
+    parser.add_argument("--exclude-archived", action="store_true")
+    parser.add_argument("--refresh", action="store_true", help="refresh the conversation catalog even if its cache did not expire")
+
+
+def select_conversations(exporter, args, refresh=True):
+    # With refresh=False only the cached catalog is used (--plan)
+    catalog = exporter.conversation_catalog
+    if refresh:
+        catalog.refresh(args.refresh)
+    conversations = catalog.filter(args.types, True if args.member_only else None, False if args.exclude_archived else None)
+    if args.conversation:
+        selected = [conversation["id"] for conversation in conversations]
+        conversations = []
+        for key in args.conversation:
+            conversation = catalog.get_by_id(key) or catalog.get_by_name(key)
+            if conversation is None or conversation["id"] not in selected:
+                print(f"Conversation {key} not found")
+            else:
+                conversations.append(conversation)
+    return conversations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the conversations, members and users of a Slack workspace")
+    parser.add_argument("--config", default=None, help="config file (config.yaml if there is one)")
+    parser.add_argument("--token", default=None, help="Slack bot token, if it is not in the config file")
+    parser.add_argument("--page-cache", choices=PageCache.MODES, default=None, help="record the API pages to the page cache, replay them from it, or only replay them (offline)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_parser = subparsers.add_parser("list", help="list the conversations")
+    add_selection_arguments(list_parser)
+    users_parser = subparsers.add_parser("users", help="refresh the user directory and write it to csv")
+    users_parser.add_argument("--output", default=None, help="csv file (slack_users_list.csv by default)")
+    users_parser.add_argument("--refresh", action="store_true", help="refresh the user directory even if its cache did not expire")
+    export_parser = subparsers.add_parser("export", help="export messages (and reactions, threads, files, members)")
+    members_parser = subparsers.add_parser("members", help="export the members of the conversations")
+    for command_parser in [export_parser, members_parser]:
+        add_selection_arguments(command_parser)
+        command_parser.add_argument("--graph", action="store_true", help="also write the co-membership graph (needs numpy and scipy)")
+        command_parser.add_argument("--plan", action="store_true", help="only print the estimated API calls and wall time, from the cached catalog")
+        command_parser.add_argument("--async", dest="use_async", action="store_true", help="export several conversations at the same time (needs aiohttp)")
+    export_parser.add_argument("--reactions", action="store_true")
+    export_parser.add_argument("--threads", action="store_true")
+    export_parser.add_argument("--files", action="store_true")
+    export_parser.add_argument("--members", action="store_true")
+    args = parser.parse_args(argv)
+
+    config_filename = args.config if args.config is not None else ("config.yaml" if os.path.exists("config.yaml") else None)
+    exporter_class = SlackExporter
+    if getattr(args, "use_async", False) and not getattr(args, "plan", False):
+        from async_exporter import AsyncSlackExporter
+        exporter_class = AsyncSlackExporter
+    exporter = exporter_class(config_filename, args.token, config={"page_cache_mode": args.page_cache} if args.page_cache else None)
+
+    if args.command == "list":
+        exporter.print_conversations_list(select_conversations(exporter, args))
+    elif args.command == "users":
+        exporter.update_users_list(args.output, args.refresh)
+        print(f"{len(exporter.users_list)} users written to {args.output or 'slack_users_list.csv'}")
+    else:
+        export_options = {"export_messages": args.command == "export", "export_members": args.command == "members" or getattr(args, "members", False), "members_as_graph": args.graph}
+        if args.command == "export":
+            export_options.update({"export_messages_reactions": args.reactions, "export_threads": args.threads, "export_files": args.files})
+        if args.plan:
+            conversations = select_conversations(exporter, args, refresh=False)
+            if len(exporter.conversation_catalog.conversations) == 0:
+                print(f"The conversation catalog ({exporter.conversation_catalog.filename}) is empty, run the list command once to cache it")
+                return
+            concurrency = exporter.config.get("max_concurrency", 8) if args.use_async else 1
+            ExportPlan(exporter, concurrency).add_export(conversations, export_options["export_messages"], export_options.get("export_messages_reactions", False),
+                                                         export_options["export_members"], export_options.get("export_threads", False)).print_plan()
+            return
+        conversations = select_conversations(exporter, args)
+        print(f"Exporting {len(conversations)} conversations")
+        if args.use_async:
+            asyncio.run(exporter.export_conversation_data(conversations, **export_options))
+        else:
+            exporter.export_conversation_data(conversations, **export_options)
+    if args.command in ["list", "users"] and exporter.page_cache is not None:
+        # Exports close it with their writers
+        exporter.page_cache.close()
 
 
 if __name__ == "__main__":
     main()
-
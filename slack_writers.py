@@ -0,0 +1,732 @@
+"""
+Output writers of the exports.
+
+All the writers can be shared by many producer threads (or asyncio tasks): write_data formats the rows in the caller
+and only queues them, a single writer thread per file drains the queue and writes the rows in large batches.
+The file is flushed (and optionally fsynced) every `flush_rows` rows, `flush_bytes` bytes or `flush_interval` seconds,
+whichever comes first, and whenever flush() is called.
+
+Available formats (see get_writer_class):
+    csv:        SlackCSVWriter, one quoted row per record
+    csv.gz:     SlackCSVWriter compressed with gzip
+    csv.zst:    SlackCSVWriter compressed with zstandard (requires zstandard)
+    jsonl:      SlackJSONLWriter, one JSON object per record, with the original Slack object under "raw"
+    jsonl.gz:   SlackJSONLWriter compressed with gzip
+    jsonl.zst:  SlackJSONLWriter compressed with zstandard (requires zstandard)
+    parquet:    SlackParquetWriter, typed columns written in record batches (requires pyarrow)
+    sqlite:     SlackSQLiteWriter, upserts into the normalized tables of one SQLite database shared by all the exports
+
+Compression happens on the fly in the writer thread. With max_part_rows, max_part_bytes and/or partition_by (channel, day)
+a writer writes parts instead of a single file, in a folder named after the file (e.g. messages_all_<time>/channel=C123/
+day=2024-01-31/part-00000.csv.gz), each of them complete (with its header, its own compressed stream...) so they can be
+processed in parallel; the parts are listed with their partition, rows and size in <file>.manifest.json.
+"""
+
+from datetime import datetime
+from decimal import Decimal
+import csv
+import gzip
+import io
+import json
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import message_formatter
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class SlackWriter():
+    extension = ""
+    # Suffix added to the extension by each compression
+    COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+    # partition_by values and the column they are taken from
+    PARTITION_COLUMNS = {"channel": "convo_id", "day": "msg_datetime"}
+    # Replaced in the partition folder names
+    UNSAFE_CHARACTERS = re.compile(r"[^\w.-]")
+    # State of the file being written, saved and restored when switching between the parts of a partitioned writer
+    PART_ATTRIBUTES = ["file", "raw_file", "part_filename"]
+
+    def __init__(self, filename, headers=None, flush_rows=5000, flush_bytes=4*1024*1024, flush_interval=5, fsync=False, max_queue_size=1000,
+                 compression=None, compression_level=None, max_part_rows=None, max_part_bytes=None, partition_by=None, max_open_parts=64):
+        self.filename = filename
+        self.initialized = False
+        self.headers = headers
+        self.creation_time = datetime.now()
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        # gzip or zstd, applied on the fly by the writer thread
+        self.compression = compression
+        self.compression_level = compression_level
+        # Rotation: a new part every max_part_rows rows or max_part_bytes bytes on disk, and/or separate parts per
+        # partition (channel and/or day), up to max_open_parts parts open at the same time
+        self.max_part_rows = max_part_rows
+        self.max_part_bytes = max_part_bytes
+        self.partition_by = [partition_by] if isinstance(partition_by, str) else partition_by
+        self.max_open_parts = max_open_parts
+        self.parts = {}
+        self.part_numbers = {}
+        self.current_part = None
+        self.partition_indexes = None
+        self.part_filename = None
+        # The parts written, listed in <filename without extension>.manifest.json when the writer is closed
+        self.manifest = []
+        self.manifest_filename = f"{self.get_base_filename()}.manifest.json" if self.is_rotated() else None
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.error = None
+        self.closed = False
+        # Bounded, so producers faster than the disk slow down instead of filling the memory
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        if self.headers is not None:
+            self.init(self.headers)
+        if not self.partition_by:
+            # Opened here, so that errors show up in the caller and the file exists even if nothing is written
+            self.use_part(None)
+        self.thread = threading.Thread(target=self.writer_loop, name=f"writer_{os.path.basename(filename)}", daemon=True)
+        self.thread.start()
+
+    def init(self, headers = None):
+        if not self.initialized and headers is not None:
+            self.headers = headers
+            self.initialized = True
+
+    # Implemented by every format, all of them work on the current part (self.part_filename)
+    def open_file(self):
+        raise NotImplementedError()
+
+    def write_records(self, records):
+        # Returns the number of bytes written
+        raise NotImplementedError()
+
+    def flush_file(self):
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.raw_file.fileno())
+
+    def close_file(self):
+        self.file.close()
+        if self.raw_file is not self.file:
+            self.raw_file.close()
+
+    def open_text_file(self, newline=None):
+        # Text goes through the compressor (if any) straight to the file, nothing is compressed afterwards
+        if self.compression is None:
+            self.file = open(self.part_filename, 'w', newline=newline, encoding='utf-8', buffering=1024*1024)
+            self.raw_file = self.file
+            return
+        self.raw_file = open(self.part_filename, 'wb')
+        if self.compression == "gzip":
+            # Level 6 instead of gzip's default 9: nearly the same size for a fraction of the CPU time
+            stream = gzip.GzipFile(fileobj=self.raw_file, mode='wb', compresslevel=self.compression_level or 6)
+        elif self.compression == "zstd":
+            if zstandard is None:
+                raise ImportError("zstd compression needs zstandard, install it with: pip install zstandard")
+            stream = zstandard.ZstdCompressor(level=self.compression_level or 3).stream_writer(self.raw_file)
+        else:
+            raise ValueError(f"Unknown compression {self.compression}, use gzip or zstd")
+        self.file = io.TextIOWrapper(stream, encoding='utf-8', newline=newline, write_through=False)
+
+    def is_rotated(self):
+        return bool(self.partition_by or self.max_part_rows or self.max_part_bytes)
+
+    def get_suffix(self):
+        return self.extension + SlackWriter.COMPRESSION_SUFFIXES.get(self.compression, "")
+
+    def get_base_filename(self):
+        suffix = self.get_suffix()
+        return self.filename[:-len(suffix)] if suffix and self.filename.endswith(suffix) else self.filename
+
+    def get_part_filename(self, partition, number):
+        # Without rotation the only part is the file itself, parts go in a folder named after it otherwise:
+        # messages_all_<time>/channel=C123/day=2024-01-31/part-00000.csv.gz
+        if not self.is_rotated():
+            return self.filename
+        folders = [column + "=" + SlackWriter.UNSAFE_CHARACTERS.sub("_", str(value)) for column, value in partition or []]
+        return os.path.join(self.get_base_filename(), *folders, f"part-{number:05d}{self.get_suffix()}")
+
+    def get_partition(self, record):
+        if self.partition_indexes is None:
+            # Only the partition columns this export has (e.g. members have no day)
+            self.partition_indexes = [(column, SlackWriter.PARTITION_COLUMNS[column], self.headers.index(SlackWriter.PARTITION_COLUMNS[column]))
+                                      for column in self.partition_by if SlackWriter.PARTITION_COLUMNS[column] in self.headers]
+        partition = []
+        for column, header, index in self.partition_indexes:
+            value = record.get(header, None) if isinstance(record, dict) else record[index]
+            partition.append((column, str(value)[:10] if column == "day" else value))
+        return tuple(partition)
+
+    def use_part(self, partition):
+        # Makes the (open) part of a partition the current one
+        if self.current_part is not None:
+            if self.current_part["partition"] == partition:
+                return
+            for attribute in self.PART_ATTRIBUTES:
+                self.current_part[attribute] = getattr(self, attribute, None)
+        # Re-inserted at the end: the first part of the dict is the least recently used
+        part = self.parts.pop(partition, None)
+        if part is None:
+            while len(self.parts) >= self.max_open_parts:
+                self.close_part(next(iter(self.parts)))
+            number = self.part_numbers.get(partition, 0)
+            self.part_numbers[partition] = number + 1
+            part = {"partition": partition, "number": number, "rows": 0, "bytes": 0}
+            self.part_filename = self.get_part_filename(partition, number)
+            folder = os.path.dirname(self.part_filename)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self.open_file()
+            for attribute in self.PART_ATTRIBUTES:
+                part[attribute] = getattr(self, attribute, None)
+        else:
+            for attribute in self.PART_ATTRIBUTES:
+                setattr(self, attribute, part[attribute])
+        self.parts[partition] = part
+        self.current_part = part
+
+    def close_part(self, partition):
+        self.use_part(partition)
+        self.close_file()
+        part = self.parts.pop(partition)
+        self.current_part = None
+        if self.manifest_filename is not None:
+            self.manifest.append({
+                "path": os.path.relpath(part["part_filename"], os.path.dirname(self.manifest_filename) or "."),
+                "partition": dict(partition or []),
+                "rows": part["rows"],
+                "bytes": os.path.getsize(part["part_filename"]) if os.path.exists(part["part_filename"]) else None,
+            })
+
+    def get_part_size(self):
+        # Bytes on disk of the current part (what the compressor already handed over), written bytes if unknown
+        try:
+            return self.raw_file.tell()
+        except (AttributeError, OSError, ValueError):
+            return self.current_part["bytes"]
+
+    def write_parts(self, records):
+        # Writes a batch of records to the parts of their partitions, starting new parts when they are full
+        if self.partition_by:
+            groups = {}
+            for record in records:
+                groups.setdefault(self.get_partition(record), []).append(record)
+        else:
+            groups = {None: records}
+        written = 0
+        for partition, partition_records in groups.items():
+            start = 0
+            while start < len(partition_records):
+                self.use_part(partition)
+                part = self.current_part
+                count = len(partition_records) - start
+                if self.max_part_rows:
+                    count = min(count, self.max_part_rows - part["rows"])
+                part_written = self.write_records(partition_records[start:start+count])
+                part["rows"] += count
+                part["bytes"] += part_written
+                written += part_written
+                start += count
+                if (self.max_part_rows and part["rows"] >= self.max_part_rows) or (self.max_part_bytes and self.get_part_size() >= self.max_part_bytes):
+                    self.close_part(partition)
+        return written
+
+    def flush_parts(self):
+        for partition in list(self.parts):
+            self.use_part(partition)
+            self.flush_file()
+
+    def close_parts(self):
+        for partition in list(self.parts):
+            self.close_part(partition)
+        if self.manifest_filename is not None:
+            self.write_manifest()
+
+    def write_manifest(self):
+        manifest = {"filename": self.get_base_filename(), "headers": self.headers, "rows": sum([part["rows"] for part in self.manifest]), "parts": self.manifest}
+        tmp_filename = f"{self.manifest_filename}.tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+            json.dump(manifest, outfile, indent=1)
+        os.replace(tmp_filename, self.manifest_filename)
+
+    def to_records(self, data_list, formatter=None, **kwargs):
+        # Called by the producers: turns the exported Slack objects into the records queued for the writer thread
+        return self.rows_to_records(data_list, [data if formatter is None else formatter(data, **kwargs) for data in data_list])
+
+    def rows_to_records(self, data_list, rows_list):
+        # rows_list: the rows of every item of data_list
+        records = []
+        for rows in rows_list:
+            records += rows
+        return records
+
+    def get_batch(self):
+        # Returns all the records already queued (waiting at most flush_interval for the first ones)
+        # and the flush/close marker that ended the batch, if any
+        records = []
+        try:
+            item = self.queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return records, False
+        while True:
+            if item is None or isinstance(item, threading.Event):
+                return records, item
+            records += item
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return records, False
+
+    def writer_loop(self):
+        pending_rows = 0
+        pending_bytes = 0
+        last_flush = time.monotonic()
+        while True:
+            records, marker = self.get_batch()
+            try:
+                if len(records) > 0:
+                    written = self.write_parts(records)
+                    pending_rows += len(records)
+                    pending_bytes += written
+                    self.rows_written += len(records)
+                    self.bytes_written += written
+                if marker is not False or \
+                        (self.flush_rows is not None and pending_rows >= self.flush_rows) or \
+                        (self.flush_bytes is not None and pending_bytes >= self.flush_bytes) or \
+                        (pending_rows > 0 and time.monotonic() - last_flush >= self.flush_interval):
+                    self.flush_parts()
+                    pending_rows = 0
+                    pending_bytes = 0
+                    last_flush = time.monotonic()
+                if marker is None:
+                    self.close_parts()
+            except Exception as e:
+                # Raised again in the producers by the next write_data/flush/close
+                self.error = e
+            if marker is None:
+                return
+            if marker is not False:
+                marker.set()
+
+    def check_error(self):
+        if self.error is not None:
+            raise IOError(f"Error writing to {self.filename}: {self.error}")
+
+    def write_data(self, data_list, formatter=None, **kwargs):
+        self.check_error()
+        if not isinstance(data_list, list):
+            data_list = [data_list]
+        records = self.to_records(data_list, formatter, **kwargs)
+        if len(records) > 0:
+            self.queue.put(records)
+
+    def write_data_batch(self, data_list, batch_formatter, **kwargs):
+        # Same as write_data, with a formatter that formats the whole data_list in one call (see message_formatter.py)
+        self.check_error()
+        records = self.rows_to_records(data_list, batch_formatter(data_list, **kwargs))
+        if len(records) > 0:
+            self.queue.put(records)
+
+    def flush(self):
+        # Blocks until every record queued so far is on disk (e.g. before saving a checkpoint)
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+        self.check_error()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.check_error()
+
+    def ts_to_dt(ts):
+        return message_formatter.ts_to_dt(ts)
+        
+    def format_reaction(reaction, users_list=None, prefix=None):
+        prefix = prefix if prefix != None else []
+        users_list = users_list if users_list != None else []
+        rows = []
+        for user in reaction["users"]:
+            try:
+                row = []
+                try:
+                    row.append(reaction["name"])
+                except Exception as e:
+                    row.append("None")
+                try:
+                    row.append(user)
+                except Exception as e:
+                    row.append("None")            
+                try:
+                    row.append(users_list.get(user, "None"))
+                except:
+                    row.append("None")
+                # print(f"{self.ts_to_dt(message['ts'])}\t{message['client_msg_id']}\t{message['type']}\t{message['user']}\t{message['team']}\t{message['text']}")
+                rows.append(prefix+row)
+            except Exception as e:
+                print(f"Error while writing to file: {e}")
+        return rows
+
+    def format_file(file, entry=None, path=None, status=None, prefix=None):
+        # entry: index entry of the file in the FileStore, None if it was not downloaded
+        prefix = prefix if prefix != None else []
+        entry = entry if entry != None else {}
+        return [prefix + [file.get("id", "None"), file.get("name", "None"), file.get("mimetype", "None"), file.get("size", "None"),
+                          entry.get("sha256", "None"), path if path != None else "None", status if status != None else "None"]]
+
+    def format_member(member, users_list=None, prefix=None):
+        # The co-membership graph (members_as_graph) is built by MembersGraph, see members_graph.py
+        prefix = prefix if prefix != None else []
+        users_list = users_list if users_list != None else {}
+        return [prefix + [member, users_list.get(member, "None")]]
+
+
+class SlackCSVWriter(SlackWriter):
+    extension = ".csv"
+
+    def open_file(self):
+        self.open_text_file(newline='')
+        # Every part starts with the header
+        if self.headers is not None:
+            csv.writer(self.file, delimiter=',', quoting=csv.QUOTE_ALL).writerow(self.headers)
+
+    def write_records(self, records):
+        # One csv formatting pass and a single write call for the whole batch
+        buffer = io.StringIO()
+        csv.writer(buffer, delimiter=',', quoting=csv.QUOTE_ALL).writerows(records)
+        data = buffer.getvalue()
+        self.file.write(data)
+        return len(data)
+
+
+class SlackJSONLWriter(SlackWriter):
+    extension = ".jsonl"
+
+    def __init__(self, filename, headers=None, compression=None, include_raw=True, **kwargs):
+        self.include_raw = include_raw
+        super().__init__(filename, headers, compression=compression, **kwargs)
+
+    def open_file(self):
+        self.open_text_file()
+
+    def rows_to_records(self, data_list, rows_list):
+        # The formatted columns, plus the untouched Slack object (blocks, files, threads...) on the first record it produced
+        records = []
+        for data, rows in zip(data_list, rows_list):
+            for idx, row in enumerate(rows):
+                record = dict(zip(self.headers, row)) if self.headers is not None else {"row": row}
+                if self.include_raw and idx == 0 and isinstance(data, dict):
+                    record["raw"] = data
+                records.append(record)
+        return records
+
+    def write_records(self, records):
+        data = "".join([json.dumps(record, ensure_ascii=False) + "\n" for record in records])
+        self.file.write(data)
+        return len(data)
+
+
+class SlackParquetWriter(SlackWriter):
+    extension = ".parquet"
+    # Every other column is a string. Slack timestamps are exact decimals (microseconds), not floats
+    COLUMN_TYPES = {
+        "msg_datetime": "timestamp",
+        "msg_timestamp": "ts",
+        "msg_thread_ts": "ts",
+        "file_size": "int",
+    }
+    # Pages are compressed by parquet itself (zstd). Rows are written in row groups of flush_rows rows or about
+    # flush_bytes bytes (of text, before compression), whichever comes first: write_records returns the bytes of the
+    # row groups it wrote, which is what max_part_bytes and the byte metrics count
+    PART_ATTRIBUTES = ["file", "raw_file", "pending", "pending_bytes", "schema", "part_filename"]
+
+    def open_file(self):
+        if pyarrow is None:
+            raise ImportError("The parquet format needs pyarrow, install it with: pip install pyarrow")
+        self.file = None
+        self.raw_file = None
+        self.pending = []
+        self.pending_bytes = 0
+
+    def get_column_type(column):
+        column_type = SlackParquetWriter.COLUMN_TYPES.get(column, None)
+        if column_type == "timestamp":
+            return pyarrow.timestamp("s")
+        if column_type == "ts":
+            return pyarrow.decimal128(16, 6)
+        if column_type == "int":
+            return pyarrow.int64()
+        return pyarrow.string()
+
+    def get_schema(self):
+        return pyarrow.schema([pyarrow.field(column, SlackParquetWriter.get_column_type(column)) for column in self.headers])
+
+    def write_records(self, records):
+        # Rows are kept until there is a whole row group
+        self.pending += records
+        self.pending_bytes += sum([len(str(value)) for record in records for value in record])
+        if (self.flush_rows is not None and len(self.pending) >= self.flush_rows) or (self.flush_bytes is not None and self.pending_bytes >= self.flush_bytes):
+            return self.write_batch()
+        return 0
+
+    def open_parquet_writer(self):
+        # Through our own sink, so the bytes written can be read from its position
+        self.schema = self.get_schema()
+        self.raw_file = pyarrow.OSFile(self.part_filename, 'wb')
+        self.file = pyarrow.parquet.ParquetWriter(self.raw_file, self.schema, compression="zstd")
+
+    def write_batch(self):
+        # Returns the number of bytes written
+        if len(self.pending) == 0:
+            return 0
+        if self.file is None:
+            self.open_parquet_writer()
+        position = self.raw_file.tell()
+        columns = []
+        for idx, field in enumerate(self.schema):
+            values = [None if row[idx] is None or row[idx] == "None" else row[idx] for row in self.pending]
+            if pyarrow.types.is_timestamp(field.type):
+                values = [None if value is None else datetime.strptime(value, '%Y-%m-%d %H:%M:%S') for value in values]
+            elif pyarrow.types.is_decimal(field.type):
+                values = [None if value is None else Decimal(str(value)) for value in values]
+            elif pyarrow.types.is_integer(field.type):
+                values = [None if value is None else int(value) for value in values]
+            else:
+                values = [None if value is None else str(value) for value in values]
+            columns.append(pyarrow.array(values, type=field.type))
+        self.file.write_batch(pyarrow.RecordBatch.from_arrays(columns, schema=self.schema))
+        self.pending = []
+        self.pending_bytes = 0
+        return self.raw_file.tell() - position
+
+    def flush_file(self):
+        # A parquet file is only readable once its footer is written by close_file, writing the pending rows here
+        # would not make them durable and would only cut small row groups: they wait for flush_rows rows or the close
+        pass
+
+    def close_file(self):
+        self.write_batch()
+        if self.file is None:
+            # Nothing was exported, still leave a valid (empty) file behind
+            self.open_parquet_writer()
+        self.file.close()
+        self.raw_file.close()
+
+
+class SlackSQLiteWriter(SlackWriter):
+    # All the export types (and all the exports) share one database: rows are upserted on their natural keys,
+    # so exporting the same conversations again updates them instead of adding duplicates
+    extension = ".db"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY, name TEXT, type TEXT);
+        CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, name TEXT);
+        CREATE TABLE IF NOT EXISTS messages (channel_id TEXT NOT NULL, ts TEXT NOT NULL, user_id TEXT, subtype TEXT, text TEXT,
+                                             datetime TEXT, thread_ts TEXT, PRIMARY KEY (channel_id, ts));
+        CREATE TABLE IF NOT EXISTS reactions (channel_id TEXT NOT NULL, ts TEXT NOT NULL, name TEXT NOT NULL, user_id TEXT NOT NULL,
+                                              PRIMARY KEY (channel_id, ts, name, user_id));
+        CREATE TABLE IF NOT EXISTS members (channel_id TEXT NOT NULL, user_id TEXT NOT NULL, PRIMARY KEY (channel_id, user_id));
+        CREATE TABLE IF NOT EXISTS files (channel_id TEXT NOT NULL, ts TEXT NOT NULL, file_id TEXT NOT NULL, name TEXT, mimetype TEXT,
+                                          size INTEGER, sha256 TEXT, path TEXT, status TEXT, PRIMARY KEY (channel_id, ts, file_id));
+        CREATE INDEX IF NOT EXISTS messages_user_id ON messages (user_id, ts);
+        CREATE INDEX IF NOT EXISTS reactions_user_id ON reactions (user_id);
+        CREATE INDEX IF NOT EXISTS members_user_id ON members (user_id);
+        CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+    """
+    # Header that identifies the rows of each export type -> table, primary key, {table column: header}
+    TABLES = {
+        "msg_subtype": ("messages", ["channel_id", "ts"], {"channel_id": "convo_id", "ts": "msg_timestamp", "user_id": "msg_user_id", "subtype": "msg_subtype",
+                                                           "text": "msg_text", "datetime": "msg_datetime", "thread_ts": "msg_thread_ts"}),
+        "reaction_name": ("reactions", ["channel_id", "ts", "name", "user_id"], {"channel_id": "convo_id", "ts": "msg_timestamp", "name": "reaction_name", "user_id": "reaction_user"}),
+        "file_id": ("files", ["channel_id", "ts", "file_id"], {"channel_id": "convo_id", "ts": "msg_timestamp", "file_id": "file_id", "name": "file_name", "mimetype": "file_mimetype",
+                                                              "size": "file_size", "sha256": "file_sha256", "path": "file_path", "status": "file_status"}),
+        "user_id": ("members", ["channel_id", "user_id"], {"channel_id": "convo_id", "user_id": "user_id"}),
+    }
+    # (user ID, user name) headers, the users table is filled from the rows of every export type
+    USER_HEADERS = [("msg_user_id", "msg_user_name"), ("reaction_user", "reaction_username"), ("user_id", "user_name")]
+
+    def __init__(self, filename, headers=None, database=None, **kwargs):
+        # database: the shared database file, instead of one file per export type. A database is neither compressed nor rotated
+        self.statements = None
+        for key in ["compression", "compression_level", "max_part_rows", "max_part_bytes", "partition_by"]:
+            kwargs.pop(key, None)
+        super().__init__(database or filename, headers, **kwargs)
+
+    def create_schema(connection):
+        connection.executescript(SlackSQLiteWriter.SCHEMA)
+
+    def open_file(self):
+        folder = os.path.dirname(self.filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # Opened here but only used by the writer thread. Several writers (and shard processes) can share the
+        # database: with WAL they wait for each other's transactions instead of failing
+        self.connection = sqlite3.connect(self.filename, timeout=300, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"PRAGMA synchronous={'FULL' if self.fsync else 'NORMAL'}")
+        SlackSQLiteWriter.create_schema(self.connection)
+        self.connection.commit()
+
+    def get_upsert(table, key, columns):
+        updates = [column for column in columns if column not in key]
+        conflict = f"DO UPDATE SET {', '.join([f'{column}=excluded.{column}' for column in updates])}" if updates else "DO NOTHING"
+        return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))}) ON CONFLICT ({', '.join(key)}) {conflict}"
+
+    def get_statements(self):
+        # (statement, header indexes) of the table of this writer's rows, then of its users and conversations
+        if self.statements is None:
+            table_key = next((header for header in SlackSQLiteWriter.TABLES if header in self.headers), None)
+            if table_key is None:
+                raise ValueError(f"No SQLite table for the columns {self.headers}")
+            table, key, columns = SlackSQLiteWriter.TABLES[table_key]
+            users = next(((self.headers.index(user_id), self.headers.index(user_name)) for user_id, user_name in SlackSQLiteWriter.USER_HEADERS
+                          if user_id in self.headers and user_name in self.headers), None)
+            self.statements = {
+                "rows": (SlackSQLiteWriter.get_upsert(table, key, list(columns)), [self.headers.index(header) for header in columns.values()]),
+                # A missing name (None) never replaces a known one
+                "users": ("INSERT INTO users (id, name) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET name=coalesce(excluded.name, users.name)", users),
+                "conversations": (SlackSQLiteWriter.get_upsert("conversations", ["id"], ["id", "name", "type"]),
+                                  [self.headers.index(header) for header in ["convo_id", "convo_name", "convo_type"]]),
+            }
+        return self.statements
+
+    def write_records(self, records):
+        statements = self.get_statements()
+        rows = [[None if value == "None" else value for value in record] for record in records]
+        statement, indexes = statements["rows"]
+        values = [[row[idx] for idx in indexes] for row in rows]
+        statement_users, users = statements["users"]
+        statement_conversations, conversations = statements["conversations"]
+        # One transaction for the whole batch
+        with self.connection:
+            self.connection.executemany(statement_conversations, list({row[conversations[0]]: [row[idx] for idx in conversations] for row in rows}.values()))
+            if users is not None:
+                self.connection.executemany(statement_users, [(user_id, user_name) for user_id, user_name in {row[users[0]]: row[users[1]] for row in rows if row[users[0]] is not None}.items()])
+            self.connection.executemany(statement, values)
+        return 0
+
+    def flush_file(self):
+        # Every batch is already committed by write_records
+        pass
+
+    def close_file(self):
+        self.connection.close()
+
+
+def get_writer_class(output_format="csv"):
+    # Returns the writer class and the extra arguments for the given output_format
+    if output_format == "csv":
+        return SlackCSVWriter, {}
+    if output_format == "csv.gz":
+        return SlackCSVWriter, {"compression": "gzip"}
+    if output_format == "csv.zst":
+        return SlackCSVWriter, {"compression": "zstd"}
+    if output_format == "jsonl":
+        return SlackJSONLWriter, {}
+    if output_format == "jsonl.gz":
+        return SlackJSONLWriter, {"compression": "gzip"}
+    if output_format == "jsonl.zst":
+        return SlackJSONLWriter, {"compression": "zstd"}
+    if output_format == "parquet":
+        return SlackParquetWriter, {}
+    if output_format == "sqlite":
+        return SlackSQLiteWriter, {}
+    raise ValueError(f"Unknown output format {output_format}, use one of csv, csv.gz, csv.zst, jsonl, jsonl.gz, jsonl.zst, parquet, sqlite")
+
+
+def open_writer(filename, headers=None, output_format="csv", **kwargs):
+    # filename without extension, the one of the format is added here
+    writer_class, writer_args = get_writer_class(output_format)
+    extension = writer_class.extension
+    if output_format.endswith(".gz"):
+        extension += ".gz"
+    elif output_format.endswith(".zst"):
+        extension += ".zst"
+    return writer_class(filename + extension, headers, **writer_args, **kwargs)
+
+
+def get_part_filenames(filename):
+    # The parts listed in a manifest (rotated writers), or the file itself
+    if not filename.endswith(".manifest.json"):
+        return [filename]
+    with open(filename, 'r', encoding='utf-8') as infile:
+        manifest = json.load(infile)
+    return [os.path.join(os.path.dirname(filename), part["path"]) for part in manifest["parts"]]
+
+
+def open_compressed(filename, mode, compression):
+    # Binary stream of a (possibly) compressed file, mode is 'rb' or 'wb'
+    if compression == "gzip":
+        return gzip.open(filename, mode)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression needs zstandard, install it with: pip install zstandard")
+        if mode == 'rb':
+            return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'))
+        return zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+    return open(filename, mode)
+
+
+def merge_files(filenames, output_filename, output_format="csv"):
+    # Concatenates files written by writers of the same output_format (e.g. the shards of a sharded export)
+    # CSV files keep the header of the first file only, gzip members and zstd frames can simply be appended
+    # Manifests of rotated writers (.manifest.json) stand for all their parts
+    filenames = [part_filename for filename in filenames for part_filename in get_part_filenames(filename)]
+    if output_format == "sqlite":
+        connection = sqlite3.connect(output_filename)
+        SlackSQLiteWriter.create_schema(connection)
+        tables = ["conversations", "users"] + [table for table, key, columns in SlackSQLiteWriter.TABLES.values()]
+        for filename in sorted(set(filenames)):
+            connection.execute("ATTACH DATABASE ? AS shard", (filename,))
+            with connection:
+                for table in tables:
+                    connection.execute(f"INSERT OR REPLACE INTO main.{table} SELECT * FROM shard.{table}")
+            connection.execute("DETACH DATABASE shard")
+        connection.close()
+        return output_filename
+    if output_format == "parquet":
+        if pyarrow is None:
+            raise ImportError("Merging parquet files needs pyarrow, install it with: pip install pyarrow")
+        parquet_writer = None
+        for filename in filenames:
+            table = pyarrow.parquet.read_table(filename)
+            if parquet_writer is None:
+                parquet_writer = pyarrow.parquet.ParquetWriter(output_filename, table.schema, compression="zstd")
+            parquet_writer.write_table(table)
+        if parquet_writer is not None:
+            parquet_writer.close()
+        return output_filename
+    compression = {".gz": "gzip", ".zst": "zstd"}.get(os.path.splitext(output_format)[1], None)
+    with open(output_filename, 'wb') as outfile:
+        for idx, filename in enumerate(filenames):
+            if output_format.startswith("csv") and idx > 0 and compression is not None:
+                # The header is inside the compressed stream: the rest of the file is compressed again as a new member/frame
+                with open_compressed(filename, 'rb', compression) as infile:
+                    reader = io.BufferedReader(infile) if compression == "zstd" else infile
+                    reader.readline()
+                    if compression == "gzip":
+                        compressed = gzip.GzipFile(fileobj=outfile, mode='wb', compresslevel=6)
+                    else:
+                        compressed = zstandard.ZstdCompressor().stream_writer(outfile, closefd=False)
+                    with compressed:
+                        shutil.copyfileobj(reader, compressed, 1024*1024)
+                continue
+            with open(filename, 'rb') as infile:
+                if output_format == "csv" and idx > 0:
+                    infile.readline()
+                shutil.copyfileobj(infile, outfile, 1024*1024)
+    return output_filename
@@ -0,0 +1,134 @@
+"""
+Workspace user directory, persisted to disk and answered from memory.
+
+The whole users.list is paged through (large workspaces do not fit in a single page) and saved to a JSON file
+together with the time it was downloaded. While the file is younger than `ttl` seconds nothing is downloaded at all.
+users.list has no "changed since" filter, so a refresh still pages through every user, but only the users whose
+`updated` timestamp moved are replaced (and the users csv is only rewritten when something changed).
+
+Member and mention lookups never hit the network, except for the users.info fallback on IDs the
+directory does not know (e.g. users of other workspaces in shared channels), which are then cached as well.
+Those are saved once per batch of lookups (save_changes) and when the export is closed, not one by one.
+"""
+
+import json
+import os
+import threading
+import time
+from slack_sdk.errors import SlackApiError
+
+
+class UserDirectory():
+    # The fields of users.list we keep for every user, the rest of the profile is not needed by the exports
+    USER_FIELDS = ["id", "name", "real_name", "deleted", "is_bot", "updated", "tz"]
+    PROFILE_FIELDS = ["display_name", "real_name_normalized"]
+
+    def __init__(self, exporter, filename="slack_users_directory.json", ttl=24*60*60):
+        self.exporter = exporter
+        self.filename = filename
+        self.ttl = ttl
+        self.users = {}
+        self.names = {}
+        self.fetched_at = 0
+        # Users fetched one by one since the last save
+        self.unsaved = 0
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as infile:
+                data = json.load(infile)
+            self.fetched_at = data.get("fetched_at", 0)
+            for user in data.get("users", []):
+                self.add_user(user)
+            print(f"Loaded {len(self.users)} users from {self.filename}")
+        except (IOError, ValueError) as e:
+            print(f"Error reading users directory {self.filename}: {e}")
+
+    def save(self):
+        if self.filename is None:
+            return
+        # One temporary file per process, sharded exports share the same cache files
+        tmp_filename = f"{self.filename}.{os.getpid()}.tmp"
+        # Threads of the same process save one at a time, through the same temporary file
+        with self.save_lock:
+            with self.lock:
+                users = list(self.users.values())
+                self.unsaved = 0
+            with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+                json.dump({"fetched_at": self.fetched_at, "users": users}, outfile)
+            os.replace(tmp_filename, self.filename)
+
+    def save_changes(self):
+        # Saves the users fetched since the last save, if any
+        if self.unsaved > 0:
+            self.save()
+
+    def user_fetched(self, user):
+        # A user looked up with users.info, saved by the next save_changes
+        if self.add_user(user):
+            with self.lock:
+                self.unsaved += 1
+
+    def is_stale(self):
+        return time.time() - self.fetched_at > self.ttl
+
+    def to_record(self, user):
+        record = {key: user[key] for key in UserDirectory.USER_FIELDS if key in user}
+        profile = user.get("profile", {})
+        for key in UserDirectory.PROFILE_FIELDS:
+            if key in profile:
+                record[key] = profile[key]
+        return record
+
+    def add_user(self, user):
+        # Returns True if the user is new or changed since we last saw it
+        record = self.to_record(user)
+        with self.lock:
+            current = self.users.get(record["id"], None)
+            if current is not None and current.get("updated", 0) >= record.get("updated", 0):
+                return False
+            self.users[record["id"]] = record
+            self.names[record["id"]] = record.get("name", "None")
+            return True
+
+    def refresh(self, force=False):
+        if not force and not self.is_stale():
+            return 0
+        print(f"Downloading user directory to {self.filename}")
+        changed = 0
+        try:
+            for members in self.exporter.iter_data(self.exporter.client.users_list, {}, response_key="members"):
+                for user in members:
+                    changed += self.add_user(user)
+        except SlackApiError as e:
+            print(f"Error downloading the user directory: {e}")
+            return changed
+        self.fetched_at = time.time()
+        self.save()
+        print(f"{changed} users added or updated, {len(self.users)} users in the directory")
+        return changed
+
+    def get(self, user_id, fetch_missing=True):
+        user = self.users.get(user_id, None)
+        if user is None and fetch_missing:
+            user = self.fetch_user(user_id)
+        return user
+
+    def get_name(self, user_id, default="None"):
+        return self.names.get(user_id, default)
+
+    def fetch_user(self, user_id):
+        try:
+            result, waited, elapsed = self.exporter.call_method(self.exporter.client.users_info, {"user": user_id})
+        except SlackApiError as e:
+            print(f"Error in retreiving user {user_id}: {e}")
+            return None
+        if "user" not in result:
+            return None
+        self.user_fetched(result["user"])
+        return self.users.get(user_id, None)